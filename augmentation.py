@@ -0,0 +1,117 @@
+import numpy as np
+
+from silbidopy.render import normalize3
+
+
+class Augmenter:
+    def __init__(self, seed = None, time_shift = 0, freq_shift = 0, gain = 0.0, contrast = 0.0,
+                 noise = None, noise_probability = 0.0, noise_weight = (0.0, 1.0),
+                 spec_clip_min = 0, spec_clip_max = 6):
+        '''
+        Augments batches of patches as they are read, so that augmented copies never need to
+        be generated or stored. Every operation is applied to the whole batch at once, and the
+        augmentations depend only on the seed and on the order of the calls.
+
+        Patches are moved in time and frequency, with data and label moved together. Patches
+        read with augment_strips are cropped elsewhere from their strip. Other patches are
+        rolled, i.e. what leaves one side comes back on the other. The spectrogram values are
+        then mapped back to log magnitudes, negative patches are mixed in, their gain and
+        contrast are jittered and they are clipped and normalized again as by getSpectrogram.
+        Values that were clipped at generation stay at the bounds of the clipping range.
+
+        :param seed: the seed of the augmentations
+        :param time_shift: frames, the most columns by which a patch is moved in time
+        :param freq_shift: frames, the most rows by which a patch is moved in frequency
+        :param gain: the most log10 magnitude added to or taken from a patch, e.g. 0.5 for about 10 dB
+        :param contrast: the most fraction by which the log magnitudes of a patch are scaled about the
+                         middle of the clipping range, e.g. 0.2 for scales from 0.8 to 1.2
+        :param noise: patches without whistles to mix in, e.g. the data dataset of the negative
+                      file from split_hdf5_positive_negative.py or MemmapPatches(...).data, of
+                      the same patch shape
+        :param noise_probability: the chance that a patch has a noise patch mixed into it
+        :param noise_weight: the (low, high) range of the weight of the noise's magnitude
+        :param spec_clip_min: log magnitude spectrogram min-max normalization, minimum value, as at generation
+        :param spec_clip_max: log magnitude spectrogram min-max normalization, maximum value, as at generation
+        '''
+        self.rng = np.random.default_rng(seed)
+        self.time_shift = time_shift
+        self.freq_shift = freq_shift
+        self.gain = gain
+        self.contrast = contrast
+        self.noise = noise
+        self.noise_probability = noise_probability if noise is not None else 0.0
+        self.noise_weight = noise_weight
+        self.spec_clip_min = spec_clip_min
+        self.spec_clip_max = spec_clip_max
+
+    def shifts(self, num_patches):
+        '''
+        Draws how far each patch of a batch is moved.
+
+        :returns: an array with one (freq_shift, time_shift) row per patch, in frames
+        '''
+        freq_shifts = self.rng.integers(-self.freq_shift, self.freq_shift + 1, num_patches)
+        time_shifts = self.rng.integers(-self.time_shift, self.time_shift + 1, num_patches)
+        return np.stack((freq_shifts, time_shifts), axis=1)
+
+    def __call__(self, data, label):
+        '''
+        Augments a batch of patches, rolling each within itself.
+
+        :param data: the spectrogram of each patch, of shape (patches, rows, columns)
+        :param label: the label of each patch, of the same shape
+
+        :returns: augmented copies as a tuple: (data, label, positive_flag)
+        '''
+        data, label = np.asarray(data), np.asarray(label)
+        shifts = self.shifts(len(data))
+
+        # Value [b, r, c] of a rolled patch is taken from [b, r - freq_shift, c - time_shift]
+        rows = (np.arange(data.shape[1]) - shifts[:, 0:1]) % data.shape[1]
+        columns = (np.arange(data.shape[2]) - shifts[:, 1:2]) % data.shape[2]
+        patches = np.arange(len(data))[:, np.newaxis, np.newaxis]
+        data = data[patches, rows[:, :, np.newaxis], columns[:, np.newaxis, :]]
+        label = label[patches, rows[:, :, np.newaxis], columns[:, np.newaxis, :]]
+        return self._jitter(data, label)
+
+    def augment_strips(self, dataset, indices):
+        '''
+        Reads and augments a batch of patches of a strip_dataset.StripDataset, cropping each
+        from its strip moved by up to time_shift and freq_shift frames, though never past
+        the edges of the strip.
+
+        :param dataset: the StripDataset
+        :param indices: the patches of the batch
+
+        :returns: augmented patches as a tuple: (data, label, positive_flag)
+        '''
+        data, label, _ = dataset.get_batch(indices, shifts=self.shifts(len(indices)))
+        return self._jitter(data, label)
+
+    def _jitter(self, data, label):
+        # Mixes in noise and jitters the gain and contrast of every patch, in log magnitudes
+        num_patches = len(data)
+        scale = self.spec_clip_max - self.spec_clip_min
+        magnitude = data.astype(np.float64) * scale + self.spec_clip_min
+
+        mixed = self.rng.random(num_patches) < self.noise_probability
+        weights = self.rng.uniform(self.noise_weight[0], self.noise_weight[1], num_patches)
+        noise_rows = self.rng.integers(0, len(self.noise), num_patches) if self.noise is not None else None
+        if mixed.any():
+            # Each noise patch is read once, in increasing order, as h5py requires
+            unique_rows, inverse = np.unique(noise_rows[mixed], return_inverse=True)
+            noise = np.asarray(self.noise[unique_rows], dtype=np.float64)[inverse] * scale + self.spec_clip_min
+            if noise.shape[1:] != data.shape[1:]:
+                raise ValueError(f"Noise patches of shape {noise.shape[1:]} cannot be mixed into patches of shape {data.shape[1:]}.")
+            # Magnitudes add, so the mixture is taken in linear magnitude
+            weight = weights[mixed][:, np.newaxis, np.newaxis]
+            magnitude[mixed] = np.log10(10 ** magnitude[mixed] + weight * 10 ** noise)
+
+        gains = self.rng.uniform(-self.gain, self.gain, num_patches)[:, np.newaxis, np.newaxis]
+        contrasts = 1 + self.rng.uniform(-self.contrast, self.contrast, num_patches)[:, np.newaxis, np.newaxis]
+        middle = (self.spec_clip_min + self.spec_clip_max) / 2
+        magnitude = (magnitude - middle) * contrasts + middle + gains
+
+        data = normalize3(magnitude, self.spec_clip_min, self.spec_clip_max).astype(data.dtype)
+        positive_flag = (label.reshape(num_patches, -1).max(axis=1, initial=0) > 0).astype("f4")
+        return data, label, positive_flag
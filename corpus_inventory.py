@@ -0,0 +1,328 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import math
+import struct
+import argparse
+from fractions import Fraction
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import helper_functions as wav2spec
+from silbidopy.readBinaries import tonalReader
+
+INVENTORY_VERSION = 1
+
+# Bytes per stored value of data, label and positive_flag
+VALUE_SIZE = 4
+
+
+def read_wav_header(filename):
+    '''
+    Reads only the RIFF header of a .wav file.
+
+    :param filename: the .wav file
+
+    :returns: a dictionary with the sample "rate", number of "channels",
+              "sampwidth" in bytes and number of "nframes"
+    '''
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as file:
+        riff, _, wave = struct.unpack('<4sI4s', file.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f"{filename} is not a RIFF WAVE file.")
+
+        fmt = None
+        while True:
+            chunk_header = file.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f"{filename} has no data chunk.")
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+
+            if chunk_id == b'fmt ':
+                _, channels, rate, _, block_align, bits = struct.unpack('<HHIIHH', file.read(16))
+                fmt = {"rate": rate, "channels": channels, "sampwidth": (bits + 7) // 8}
+                file.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f"{filename} has a data chunk before its fmt chunk.")
+                # Streaming writers may leave the data size unset, so trust the file size over it
+                data_size = min(chunk_size, file_size - file.tell())
+                fmt["nframes"] = data_size // block_align
+                return fmt
+            else:
+                file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def read_contour_bounds(filename):
+    '''
+    Reads the time-frequency bounding box of every contour in a silbido .bin file.
+
+    :param filename: the .bin file
+
+    :returns: a list with one (start_time, end_time, min_freq, max_freq) tuple
+              per contour, in seconds and Hz
+    '''
+    with tonalReader(filename) as reader:
+        toc = reader.getTableOfContents()
+    toc = toc[toc["nodes"] > 0]
+    return [tuple(map(float, row)) for row in zip(toc["start_time"], toc["end_time"], toc["min_freq"], toc["max_freq"])]
+
+
+def _read_entry(kind, filename):
+    if kind == "wav":
+        return read_wav_header(filename)
+    return {"contours": read_contour_bounds(filename)}
+
+
+def build_inventory(wav_files, bin_files, cache_file=None, workers=None):
+    '''
+    Reads the headers of each .wav file and the contour bounds of each .bin file.
+    Files are read in parallel, and the results are cached in cache_file so that
+    unchanged files are not read again.
+
+    :param wav_files: the .wav files
+    :param bin_files: the .bin files, one for each .wav file
+    :param cache_file: a .json file in which the inventory is cached. None disables caching
+    :param workers: the number of processes reading files. None uses one per CPU
+
+    :returns: a list with one dictionary per recording, holding the "wav_file" and "bin_file",
+              the .wav header fields as returned by read_wav_header and the "contours" bounds
+              as returned by read_contour_bounds
+    '''
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as file:
+            stored = json.load(file)
+        if stored.get("version") == INVENTORY_VERSION:
+            cache = stored["files"]
+
+    # Only files that changed since they were cached are read
+    stale = []
+    for kind, files in (("wav", wav_files), ("bin", bin_files)):
+        for filename in files:
+            key = os.path.abspath(filename)
+            stat = os.stat(filename)
+            entry = cache.get(key)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                stale.append((kind, filename, key, stat))
+
+    if len(stale) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_read_entry, [s[0] for s in stale], [s[1] for s in stale])
+            for (kind, filename, key, stat), result in zip(stale, results):
+                result["size"] = stat.st_size
+                result["mtime_ns"] = stat.st_mtime_ns
+                cache[key] = result
+
+        if cache_file is not None:
+            with open(cache_file, 'w') as file:
+                json.dump({"version": INVENTORY_VERSION, "files": cache}, file)
+
+    inventory = []
+    for wav_file, bin_file in zip(wav_files, bin_files):
+        header = cache[os.path.abspath(wav_file)]
+        inventory.append({
+            "wav_file": wav_file,
+            "bin_file": bin_file,
+            "rate": header["rate"],
+            "channels": header["channels"],
+            "sampwidth": header["sampwidth"],
+            "nframes": header["nframes"],
+            "contours": [tuple(c) for c in cache[os.path.abspath(bin_file)]["contours"]],
+        })
+    return inventory
+
+
+def _count_starts(span, advance):
+    '''The number of k >= 0 for which k * advance < span'''
+    if span <= 0:
+        return 0
+    return math.ceil(span / advance)
+
+
+def patch_starts(nframes, rate, frame_time_span = 8, step_time_span = 2, min_freq = 5000,
+                 max_freq = 50000, time_patch_frames = 64, freq_patch_frames = 64,
+                 time_patch_advance = 64, freq_patch_advance = 64):
+    '''
+    Gets the grid of patches for one recording. All patches have the same size, i.e. the ones
+    near the extremeties that would be smaller are not included. The grid is computed with exact
+    rational arithmetic, so the counts do not depend on floating point accumulation.
+
+    :param nframes: the number of samples in the recording
+    :param rate: Hz, the sample rate of the recording
+    :param frame_time_span: ms, length of time for one time window for dft
+    :param step_time_span: ms, length of time step for spectrogram
+    :param min_freq: Hz, lower bound of frequency for spectrogram
+    :param max_freq: Hz, upper bound of frequency for spectrogram. Lowered to the highest
+                     frequency bin of the recording if its sample rate is too low
+    :param time_patch_frames: number of time frames, the length of each patch
+    :param freq_patch_frames: number of frequency frames, the height of each patch
+    :param time_patch_advance: number of frames, the time distance between patches
+    :param freq_patch_advance: number of frames, the frequency distance between patches
+
+    :returns: A tuple with the start frequency in Hz of each row of patches and the
+              start time in ms of each column of patches: (freq_starts, time_starts)
+    '''
+    freq_resolution = Fraction(1000, frame_time_span)
+    patch_freq_length_hz = freq_resolution * freq_patch_frames
+    freq_patch_advance_hz = freq_resolution * freq_patch_advance
+    patch_time_length_ms = Fraction(step_time_span * time_patch_frames)
+    time_patch_advance_ms = Fraction(step_time_span * time_patch_advance)
+
+    # Bins above the Nyquist frequency do not exist, so no patch may reach past them
+    frame_sample_span = math.floor(Fraction(frame_time_span * rate, 1000))
+    max_freq = min(Fraction(max_freq), (frame_sample_span // 2 + 1) * freq_resolution)
+
+    # Length in ms
+    audio_file_length = Fraction(nframes * 1000, rate)
+
+    num_freq = _count_starts(max_freq - patch_freq_length_hz - min_freq, freq_patch_advance_hz)
+    num_time = _count_starts(audio_file_length - patch_time_length_ms - frame_time_span, time_patch_advance_ms)
+
+    freq_starts = [float(min_freq + k * freq_patch_advance_hz) for k in range(num_freq)]
+    time_starts = [float(k * time_patch_advance_ms) for k in range(num_time)]
+    return freq_starts, time_starts
+
+
+def plan_recording(record, frame_time_span = 8, step_time_span = 2, min_freq = 5000,
+                   max_freq = 50000, time_patch_frames = 64, freq_patch_frames = 64,
+                   time_patch_advance = 64, freq_patch_advance = 64):
+    '''
+    Plans the patches of one recording of an inventory from build_inventory.
+
+    :param record: one recording of the inventory
+    :param ...: the patch parameters, as for patch_starts
+
+    :returns: a dictionary with the "freq_starts" and "time_starts" from patch_starts,
+              the exact "num_patches" and the "num_positive" patches whose bounds
+              overlap the bounding box of at least one contour
+    '''
+    freq_starts, time_starts = patch_starts(
+        record["nframes"], record["rate"], frame_time_span=frame_time_span, step_time_span=step_time_span,
+        min_freq=min_freq, max_freq=max_freq, time_patch_frames=time_patch_frames,
+        freq_patch_frames=freq_patch_frames, time_patch_advance=time_patch_advance,
+        freq_patch_advance=freq_patch_advance)
+
+    # Mark each patch that overlaps the bounding box of a contour
+    overlaps = np.zeros((len(freq_starts), len(time_starts)), dtype=bool)
+    if overlaps.size > 0:
+        freq_resolution = 1000 / frame_time_span
+        freq_advance_hz = freq_resolution * freq_patch_advance
+        freq_length_hz = freq_resolution * freq_patch_frames
+        time_advance_ms = step_time_span * time_patch_advance
+        time_length_ms = step_time_span * time_patch_frames
+        for start_time, end_time, low_freq, high_freq in record["contours"]:
+            first_time = max(0, math.floor((start_time * 1000 - time_length_ms) / time_advance_ms) + 1)
+            last_time = min(len(time_starts), math.ceil(end_time * 1000 / time_advance_ms))
+            first_freq = max(0, math.floor((low_freq - min_freq - freq_length_hz) / freq_advance_hz) + 1)
+            last_freq = min(len(freq_starts), math.ceil((high_freq - min_freq) / freq_advance_hz))
+            overlaps[first_freq:last_freq, first_time:last_time] = True
+
+    return {
+        "freq_starts": freq_starts,
+        "time_starts": time_starts,
+        "num_patches": len(freq_starts) * len(time_starts),
+        "num_positive": int(overlaps.sum()),
+    }
+
+
+def find_recordings(audio_dir, annotation_dir):
+    '''
+    Pairs every .bin file in annotation_dir with the .wav file of the same name in audio_dir.
+
+    :returns: A tuple with the .wav files and the corresponding .bin files: (wav_files, bin_files)
+    '''
+    # collect all .wav files
+    wav_files = wav2spec.find_wav_files(audio_dir)
+    wav_file_dict = {os.path.basename(wav_file) : wav_file for wav_file in wav_files}
+
+    # collect all .bin files.
+    bin_files = wav2spec.findfiles(annotation_dir, fnmatchex='*.bin')
+
+    # find all .wav files that have corresponding .bin files.
+    try:
+        anno_wav_files = [wav_file_dict[wav2spec.bin2wav_filename(bin_file)] for bin_file in bin_files]
+    except KeyError as ex:
+        raise Exception(f"Could not find audio file {str(ex)} corresponding to binary file.")
+    return anno_wav_files, bin_files
+
+
+def add_patch_arguments(parser):
+    '''Adds the arguments that determine the patch grid to an argparse.ArgumentParser'''
+    parser.add_argument('--frame_time_span', type=int, default=8, help='ms, length of time for one time window for dft')
+    parser.add_argument('--step_time_span', type=int, default=2, help='ms, length of time step for spectrogram')
+    parser.add_argument('--min_freq', type=int, default=5000, help='Hz, lower bound of frequency for spectrogram')
+    parser.add_argument('--max_freq', type=int, default=50000, help='Hz, upper bound of frequency for spectrogram')
+    parser.add_argument('--time_patch_frames', type=int, default=64, help='number of time frames, the length of each datum')
+    parser.add_argument('--freq_patch_frames', type=int, default=64, help='number of frequency frames, the height of each datum')
+    parser.add_argument('--time_patch_advance', type=int, default=64, help='number of frames, the time distance between patches')
+    parser.add_argument('--freq_patch_advance', type=int, default=64, help='number of frames, the frequency distance between patches')
+
+
+def add_inventory_arguments(parser):
+    '''Adds the arguments that control how the inventory is read to an argparse.ArgumentParser'''
+    parser.add_argument('--inventory_cache', type=str, default=None, help='a .json file in which to cache the inventory, so that only new or changed files are read again by later runs. Not cached by default')
+    parser.add_argument('--inventory_workers', type=int, default=None, help='the number of processes reading headers for the inventory. Defaults to one per CPU')
+
+
+def patch_parameters(config):
+    '''Gets the patch_starts keyword arguments from parsed arguments'''
+    return {
+        "frame_time_span": config.frame_time_span,
+        "step_time_span": config.step_time_span,
+        "min_freq": config.min_freq,
+        "max_freq": config.max_freq,
+        "time_patch_frames": config.time_patch_frames,
+        "freq_patch_frames": config.freq_patch_frames,
+        "time_patch_advance": config.time_patch_advance,
+        "freq_patch_advance": config.freq_patch_advance,
+    }
+
+
+def inventory_from_arguments(config):
+    '''Builds the inventory of the recordings selected by parsed arguments'''
+    wav_files, bin_files = find_recordings(config.audio_dir, config.annotation_dir)
+    return build_inventory(wav_files, bin_files, cache_file=config.inventory_cache, workers=config.inventory_workers)
+
+
+def print_plan(inventory, plans, freq_patch_frames, time_patch_frames):
+    '''Prints the patch counts and output size of each recording and of the whole corpus'''
+    patch_bytes = 2 * freq_patch_frames * time_patch_frames * VALUE_SIZE + VALUE_SIZE
+
+    total_seconds = 0
+    total_patches = 0
+    total_positive = 0
+    for record, plan in zip(inventory, plans):
+        seconds = record["nframes"] / record["rate"]
+        fraction = plan["num_positive"] / plan["num_patches"] if plan["num_patches"] > 0 else 0
+        print('%s: %.1f s, %d patches, ~%.1f%% positive' % (
+            os.path.basename(record["wav_file"]), seconds, plan["num_patches"], 100 * fraction))
+        total_seconds += seconds
+        total_patches += plan["num_patches"]
+        total_positive += plan["num_positive"]
+
+    fraction = total_positive / total_patches if total_patches > 0 else 0
+    print('Total: %d recordings, %.2f h of audio' % (len(inventory), total_seconds / 3600))
+    print('Total: %d patches, ~%.1f%% positive (~%d patches)' % (total_patches, 100 * fraction, total_positive))
+    print('Total: %.3f GB before compression' % (total_patches * patch_bytes / 1e9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reports the patches that generate_hdf5.py would produce without computing any of them')
+    parser.add_argument('--audio_dir', type=str, required=True, help='the path containing .wav files')
+    parser.add_argument('--annotation_dir', type=str, required=True, help='the path containing .bin files')
+    add_patch_arguments(parser)
+    add_inventory_arguments(parser)
+    config = parser.parse_args()
+
+    inventory = inventory_from_arguments(config)
+    parameters = patch_parameters(config)
+    plans = [plan_recording(record, **parameters) for record in inventory]
+    print_plan(inventory, plans, config.freq_patch_frames, config.time_patch_frames)
+
+
+if __name__ == "__main__":
+    main()
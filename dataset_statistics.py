@@ -0,0 +1,129 @@
+import numpy as np
+
+# Histograms cover the range of normalized spectrogram values
+HISTOGRAM_BINS = 256
+HISTOGRAM_RANGE = (0.0, 1.0)
+
+
+class RunningStatistics:
+    def __init__(self, num_rows, bins = HISTOGRAM_BINS, value_range = HISTOGRAM_RANGE):
+        '''
+        Accumulates, in a single pass, the statistics needed to normalize spectrograms and
+        to weight classes: the count, mean and variance of the values in each frequency row,
+        a histogram of all values and the number of positive label pixels in each row.
+
+        Each block's mean and variance are folded into the running ones with Chan et al.'s
+        parallel update, the batched form of Welford's method, and the statistics of separate
+        recordings are combined the same way, so the results match those of a separate pass
+        up to floating point error.
+
+        :param num_rows: the number of frequency rows
+        :param bins: the number of histogram bins
+        :param value_range: the range covered by the histogram. Values outside of it are
+                            counted in the first or last bin
+        '''
+        self.count = np.zeros(num_rows, dtype=np.int64)
+        self.mean = np.zeros(num_rows)
+        self.m2 = np.zeros(num_rows)
+        self.positive = np.zeros(num_rows, dtype=np.int64)
+        self.histogram = np.zeros(bins, dtype=np.int64)
+        self.edges = np.linspace(value_range[0], value_range[1], bins + 1)
+
+    def update(self, data, label, row_offset = 0):
+        '''
+        Adds a block of spectrogram values and their labels.
+
+        :param data: values with shape (rows, columns) or (patches, rows, columns)
+        :param label: the label of each value, of the same shape as data
+        :param row_offset: the row of these statistics at which the block's first row lies
+        '''
+        data = np.asarray(data, dtype=np.float64)
+        label = np.asarray(label)
+        if data.ndim == 2:
+            data = data[np.newaxis]
+            label = label[np.newaxis]
+        if data.size == 0:
+            return
+
+        # Rows along the first axis and every value of a row along the second
+        rows = data.shape[1]
+        values = data.transpose(1, 0, 2).reshape(rows, -1)
+        block_count = values.shape[1]
+        block_mean = values.mean(axis=1)
+        block_m2 = ((values - block_mean[:, np.newaxis]) ** 2).sum(axis=1)
+
+        selection = slice(row_offset, row_offset + rows)
+        self._merge_rows(selection, np.full(rows, block_count), block_mean, block_m2)
+        self.positive[selection] += (label > 0).sum(axis=(0, 2))
+
+        clipped = np.clip(data, self.edges[0], self.edges[-1])
+        self.histogram += np.histogram(clipped, bins=len(self.histogram), range=(self.edges[0], self.edges[-1]))[0]
+
+    def merge(self, other, row_offset = 0):
+        '''
+        Adds the statistics of other, e.g. those of one recording, to these.
+
+        :param other: a RunningStatistics with the same histogram bins
+        :param row_offset: the row of these statistics at which other's first row lies
+        '''
+        selection = slice(row_offset, row_offset + len(other.count))
+        self._merge_rows(selection, other.count, other.mean, other.m2)
+        self.positive[selection] += other.positive
+        self.histogram += other.histogram
+
+    def _merge_rows(self, selection, count, mean, m2):
+        total = self.count[selection] + count
+        safe_total = np.maximum(total, 1)
+        delta = mean - self.mean[selection]
+        self.mean[selection] += delta * count / safe_total
+        self.m2[selection] += m2 + delta ** 2 * self.count[selection] * count / safe_total
+        self.count[selection] = total
+
+    def variance(self):
+        '''Returns the population variance of each row'''
+        return self.m2 / np.maximum(self.count, 1)
+
+    def overall(self):
+        '''
+        Merges the rows.
+
+        :returns: a dictionary with the "count", "mean" and "variance" of all values
+                  and the "positive_rate", the fraction of label pixels that are positive
+        '''
+        count = self.count.sum()
+        if count == 0:
+            return {"count": 0, "mean": 0.0, "variance": 0.0, "positive_rate": 0.0}
+        mean = (self.mean * self.count).sum() / count
+        m2 = (self.m2 + self.count * (self.mean - mean) ** 2).sum()
+        return {
+            "count": int(count),
+            "mean": float(mean),
+            "variance": float(m2 / count),
+            "positive_rate": float(self.positive.sum() / count),
+        }
+
+    def write(self, group):
+        '''
+        Stores these statistics in an HDF5 group: the per-row and histogram arrays as small
+        datasets and the values from overall as attributes.
+        '''
+        group.create_dataset('row_count', data=self.count)
+        group.create_dataset('row_mean', data=self.mean)
+        group.create_dataset('row_variance', data=self.variance())
+        group.create_dataset('row_positive', data=self.positive)
+        group.create_dataset('histogram', data=self.histogram)
+        group.create_dataset('histogram_edges', data=self.edges)
+        for name, value in self.overall().items():
+            group.attrs[name] = value
+
+    @classmethod
+    def read(cls, group):
+        '''Loads statistics stored with write'''
+        statistics = cls(len(group['row_count']), bins=len(group['histogram']))
+        statistics.count = group['row_count'][:]
+        statistics.mean = group['row_mean'][:]
+        statistics.m2 = group['row_variance'][:] * statistics.count
+        statistics.positive = group['row_positive'][:]
+        statistics.histogram = group['histogram'][:]
+        statistics.edges = group['histogram_edges'][:]
+        return statistics
@@ -4,150 +4,506 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+import json
 import wavio
 import argparse
+import collections
 import numpy as np
-import helper_functions as wav2spec
-from write_images import write_images
+import corpus_inventory
+import memory_budget
+import strip_dataset
+from dataset_statistics import RunningStatistics
+from provenance import provenance_rows, write_provenance
+from hdf5_writer import BlockWriter, patch_dataset_options, compression_executor
 from silbidopy.readBinaries import tonalReader
-from silbidopy.render import getSpectrogram, getAnnotationMask
+from silbidopy.render import getSpectrogram, getStripSpectrogram, normalize3
+from silbidopy.raster import AnnotationRaster
+from silbidopy.cache import SpectrogramCache, MemorySpectrogramCache
+from memory_budget import AudioWindows
 
+# Arguments that select the recordings or that are shared by every configuration, so they may
+# not be set in a file of configurations
+SHARED_ARGUMENTS = ('audio_dir', 'annotation_dir', 'configurations', 'spectrogram_cache', 'spectrogram_cache_size',
+                    'spectrogram_cache_dtype', 'compression_threads', 'dry_run', 'inventory_cache', 'inventory_workers',
+                    'max_memory')
 
+# The most bytes of spectra shared by configurations in memory, without a memory budget
+MEMORY_CACHE_BYTES = 10 ** 9
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--audio_dir', type=str, required=True, help='the path containing .wav files')
-    parser.add_argument('--annotation_dir', type=str, required=True, help='the path containing .bin files')
-    parser.add_argument('--output_file', type=str, required=True, help='The file path and name of the output hdf5 file')
 
-    parser.add_argument('--frame_time_span', type=int, default=8, help='ms, length of time for one time window for dft')
-    parser.add_argument('--step_time_span', type=int, default=2, help='ms, length of time step for spectrogram')
-    parser.add_argument('--spec_clip_min', type=float, default=0, help='log magnitude spectrogram min-max normalization, minimum value')
-    parser.add_argument('--spec_clip_max', type=float, default=6, help='log magnitude spectrogram min-max normalization, maximum value')
-    parser.add_argument('--min_freq', type=int, default=5000, help='Hz, lower bound of frequency for spectrogram')
-    parser.add_argument('--max_freq', type=int, default=50000, help='Hz, upper bound of frequency for spectrogram')
-    parser.add_argument('--time_patch_frames', type=int, default=64, help='number of time frames, the length of each datum')
-    parser.add_argument('--freq_patch_frames', type=int, default=64, help='number of frequency frames, the height of each datum')
-    parser.add_argument('--time_patch_advance', type=int, default=64, help='number of frames, the time distance between patches')
-    parser.add_argument('--freq_patch_advance', type=int, default=64, help='number of frames, the frequency distance between patches')
-    parser.add_argument('--patches_per_block', type=int, default=128, help='the number of patches computed before each write. Does not effect output, only RAM use during execution')
+class PatchWriter:
+    def __init__(self, h5f, inventory, plans, config, cache = None, executor = None, max_pending = 8):
+        '''
+        Writes every planned patch as its own datum in the datasets data, label and positive_flag,
+        and where each came from in the provenance table. Statistics of the patches are
+        accumulated on the way and written to the group statistics.
+        Blocks are written by a background thread while the next block is computed.
 
+        :param h5f: the open HDF5 file
+        :param inventory: the records of corpus_inventory.build_inventory
+        :param plans: the plan of each record from corpus_inventory.plan_recording
+        :param config: the parsed arguments of this configuration
+        :param cache: a SpectrogramCache or MemorySpectrogramCache from which spectrograms are
+                      sliced, or None to compute the spectrogram of each patch from the audio
+        :param executor: a thread pool from hdf5_writer.compression_executor in which chunks
+                         are compressed, or None
+        :param max_pending: the most chunks of each dataset that may be compressing at once
+        '''
+        self.h5f = h5f
+        self.inventory = inventory
+        self.plans = plans
+        self.config = config
+        self.cache = cache
 
-    config = parser.parse_args()
-    ## parameter setting
-    frame_time_span = config.frame_time_span # ms, length of time for one time window to do dft.
-    step_time_span = config.step_time_span # ms, length of time step.
-    spec_clip_min = config.spec_clip_min
-    spec_clip_max = config.spec_clip_max # log magnitude spectrogram min-max normalization parameter
-    min_freq = config.min_freq # Hz, lower bound of frequency for spectrogram
-    max_freq = config.max_freq # Hz, upper bound of frequency for spectrogram
+        freq_patch_frames = config.freq_patch_frames
+        time_patch_frames = config.time_patch_frames
+        patches_per_block = config.patches_per_block
+        total_patches = sum(plan["num_patches"] for plan in plans)
 
-    time_patch_frames = config.time_patch_frames
-    freq_patch_frames = config.freq_patch_frames
-    time_patch_advance = config.time_patch_advance
-    freq_patch_advance = config.freq_patch_advance
-    patches_per_block = config.patches_per_block
+        # The exact number of patches is known, so the datasets are created at their final size
+        patch_options = patch_dataset_options((freq_patch_frames, time_patch_frames), contiguous=config.contiguous)
+        h5f.create_dataset('data', shape=(total_patches, freq_patch_frames, time_patch_frames), dtype="f4", **patch_options)
+        h5f.create_dataset('label', shape=(total_patches, freq_patch_frames, time_patch_frames), dtype="f4", **patch_options)
+        h5f.create_dataset('positive_flag', shape=(total_patches,), dtype="f4", **patch_dataset_options((), contiguous=config.contiguous))
 
+        block_shape = (patches_per_block, freq_patch_frames, time_patch_frames)
+        self.writer = BlockWriter(h5f, {'data': block_shape, 'label': block_shape, 'positive_flag': (patches_per_block,)},
+                                  num_buffers=config.write_buffers, executor=executor, max_pending=max_pending)
+        self.num_patches_processed = 0
+        self.statistics = RunningStatistics(freq_patch_frames)
+        self.recording_statistics = []
+        self.provenance = []
 
-    # collect all .wav files
-    wav_files = wav2spec.find_wav_files(config.audio_dir)
+    def write_recording(self, i, audio, contours):
+        '''
+        Writes the patches of one recording. Recordings must be written in the order of the inventory.
 
-    # collect all .wav filenames
-    wav_names = list(map(os.path.basename, wav_files))
+        :param i: the index of the recording in the inventory
+        :param audio: the wavio.Wav of the recording, its AudioWindows, or its file name if a cache is used
+        :param contours: the contours of the recording from tonalReader.getTimeFrequencyContours
+        '''
+        config = self.config
+        writer = self.writer
 
-    wav_file_dict = {wav_names[i] : wav_files[i] for i in range(len(wav_names))}
+        ## parameter setting
+        frame_time_span = config.frame_time_span # ms, length of time for one time window to do dft.
+        step_time_span = config.step_time_span # ms, length of time step.
+        spec_clip_min = config.spec_clip_min
+        spec_clip_max = config.spec_clip_max # log magnitude spectrogram min-max normalization parameter
+        decimate = config.decimate # band-limit and resample before the dft
 
-    # collect all .bin files.
-    exp_group = os.path.basename(config.annotation_dir)
-    bin_files = wav2spec.findfiles(config.annotation_dir, fnmatchex='*.bin')
+        time_patch_frames = config.time_patch_frames
+        freq_patch_frames = config.freq_patch_frames
+        patches_per_block = config.patches_per_block
 
-    # find all .wav files that have corresponding .bin files.
-    anno_wav_filenames = list(map(wav2spec.bin2wav_filename, bin_files))
-    try:
-        anno_wav_files = [wav_file_dict[filename] for filename in anno_wav_filenames]
-    except KeyError as ex:
-        raise Exception(f"Could not find audio file {str(ex)} corresponding to binary file.")
-    
-    # Useful values
-    freq_resolution = 1000 / frame_time_span
-    patch_freq_length_hz = freq_resolution * freq_patch_frames
-    freq_patch_advance_hz = freq_resolution * freq_patch_advance
-    patch_time_length_ms = step_time_span * time_patch_frames
-    time_patch_advance_ms = step_time_span * time_patch_advance
-    
-    
-
-    # Build hdf5 one wav file at a time
-    h5f = h5py.File(config.output_file, 'w')
-    have_not_added_data = True
-    spectrogram_block = np.zeros((patches_per_block, freq_patch_frames, time_patch_frames), dtype="f4")
-    mask_block = np.zeros((patches_per_block, freq_patch_frames, time_patch_frames), dtype="f4")
-    positive_flag_block = np.zeros((patches_per_block), dtype="f4")
-    num_patches_processed = 0
-    for i in range(0, len(anno_wav_filenames)):
-        print('Processing audio file: %d/%d "%s"' % (i+1, len(anno_wav_filenames), anno_wav_filenames[i]))
-        wav_file = anno_wav_files[i]
-        wav_filename = os.path.basename(wav_file)
-        wav_filename = wav_filename.split('.wav')[0]
-
-        wav = wavio.read(wav_file)
-
-        contours = tonalReader(bin_files[i]).getTimeFrequencyContours()
-    
-        # Length in ms
-        audio_file_length = wav.data.shape[0] / wav.rate * 1000
+        # Useful values
+        freq_resolution = 1000 / frame_time_span
+        patch_freq_length_hz = freq_resolution * freq_patch_frames
+        patch_time_length_ms = step_time_span * time_patch_frames
 
+        plan = self.plans[i]
+        self.recording_statistics.append(RunningStatistics(freq_patch_frames))
+
+        # The annotations are drawn once for the whole recording and each mask is sliced from them
+        raster = AnnotationRaster(contours, frame_time_span=frame_time_span, step_time_span=step_time_span,
+                                  min_freq=config.min_freq)
 
         # For both times & frequencies, each patch's start & end
-        # All patches will be the same size, i.e. the ones near
-        # the extremeties that could be smaller are not included
-        patches = []
-        freq = min_freq
-        while freq < max_freq - patch_freq_length_hz:
-            time = 0
-            while time < audio_file_length - patch_time_length_ms - frame_time_span:
-                patches.append((freq, freq + patch_freq_length_hz, time, time + patch_time_length_ms))
-                time += time_patch_advance_ms
-            freq += freq_patch_advance_hz
+        patches = [(freq, freq + patch_freq_length_hz, time, time + patch_time_length_ms)
+                   for freq in plan["freq_starts"] for time in plan["time_starts"]]
      
         # write to hdf5 in groups of patches defined by patches_per_block
-        for patch in patches:
+        for patch_idx, patch in enumerate(patches):
 
-            block_idx = num_patches_processed % patches_per_block
+            block_idx = patch_idx % patches_per_block
+            if block_idx == 0:
+                block = writer.get_block()
+                spectrogram_block, mask_block, positive_flag_block = block['data'], block['label'], block['positive_flag']
 
             start_freq, end_freq, start_time, end_time = patch
+            source = audio.get(start_time, end_time, frame_time_span, step_time_span) if isinstance(audio, AudioWindows) else audio
 
-            spectrogram, actual_end = getSpectrogram(wav, frame_time_span=frame_time_span,step_time_span=step_time_span,
+            spectrogram, actual_end = getSpectrogram(source, frame_time_span=frame_time_span,step_time_span=step_time_span,
                                         spec_clip_min=spec_clip_min, spec_clip_max=spec_clip_max, min_freq=start_freq,
-                                        max_freq=end_freq, start_time=start_time, end_time=end_time)
-            mask, positive_flag = getAnnotationMask(contours, frame_time_span=frame_time_span,step_time_span=step_time_span,
-                min_freq=start_freq, max_freq=end_freq, start_time=start_time, end_time=end_time)
+                                        max_freq=end_freq, start_time=start_time, end_time=end_time, decimate=decimate, cache=self.cache)
+            mask, positive_flag = raster.getAnnotationMask(min_freq=start_freq, max_freq=end_freq,
+                start_time=start_time, end_time=end_time)
 
             # Save to block
             spectrogram_block[block_idx] = spectrogram
             mask_block[block_idx] = mask
             positive_flag_block[block_idx] = 1.0 if positive_flag else 0.0
 
-            # Save block of patches to hdf5
-            if (block_idx == patches_per_block - 1 or num_patches_processed == len(patches) - 1) and have_not_added_data:
-                h5f.create_dataset('data', data=spectrogram_block[:block_idx+1], compression="gzip", chunks=True, maxshape=(None,freq_patch_frames,time_patch_frames))
-                h5f.create_dataset('label', data=mask_block[:block_idx+1], compression="gzip", chunks=True, maxshape=(None,freq_patch_frames,time_patch_frames))
-                h5f.create_dataset('positive_flag', data=positive_flag_block[:block_idx+1], compression="gzip", chunks=True, maxshape=(None,))
-                have_not_added_data = False
-            elif block_idx == patches_per_block - 1 or num_patches_processed == len(patches) - 1:
-                # Append new data to the hdf5
-                h5f['data'].resize((h5f['data'].shape[0] + block_idx+1), axis=0)
-                h5f['data'][-(block_idx+1):] = spectrogram_block[:block_idx+1]
+            # Hand the block of patches to the writer
+            if block_idx == patches_per_block - 1 or patch_idx == len(patches) - 1:
+                self.recording_statistics[-1].update(spectrogram_block[:block_idx+1], mask_block[:block_idx+1])
+                self.provenance.append(provenance_rows(i, patches[patch_idx-block_idx:patch_idx+1], mask_block[:block_idx+1]))
+
+                writer.put_block(block, self.num_patches_processed, block_idx+1)
+                self.num_patches_processed += block_idx+1
+
+        self.statistics.merge(self.recording_statistics[-1])
+
+    def close(self):
+        '''Waits for every patch to be written and then writes the statistics and provenance'''
+        self.writer.close()
+        write_statistics(self.h5f, self.statistics, self.recording_statistics, self.inventory)
+        write_provenance(self.h5f, np.concatenate(self.provenance) if self.provenance else provenance_rows(0, []),
+                         [os.path.basename(record["wav_file"]) for record in self.inventory])
+
+    def abort(self):
+        '''Stops writing after a failure, leaving the datasets incomplete'''
+        self.writer.abort()
+
+class StripWriter:
+    def __init__(self, h5f, inventory, plans, config, cache = None, executor = None, max_pending = 8):
+        '''
+        Writes the spectrogram and label of each whole recording once, as the datasets data and
+        label of the group recordings/<i>, along with the dataset patch_index of
+        (recording, freq_offset, time_offset) rows, the positive_flag and the provenance table of
+        every planned patch. Read with strip_dataset.StripDataset. Statistics of the strips are
+        accumulated on the way and written to the group statistics, with rows counted down from max_freq.
+
+        :param ...: as for PatchWriter, but cache may only be a SpectrogramCache. Strips are compressed
+                    by h5py, so executor and max_pending are not used
+        '''
+        self.h5f = h5f
+        self.inventory = inventory
+        self.plans = plans
+        self.config = config
+        self.cache = cache
+
+        h5f.attrs["layout"] = "strips"
+        for name, value in corpus_inventory.patch_parameters(config).items():
+            h5f.attrs[name] = value
+        h5f.attrs["spec_clip_min"] = config.spec_clip_min
+        h5f.attrs["spec_clip_max"] = config.spec_clip_max
+
+        self.recordings = h5f.create_group('recordings')
+        self.patch_index = []
+        self.patches = []
+        self.positive_pixels = []
+        self.full_rows = int(config.max_freq * config.frame_time_span // 1000) - int(config.min_freq * config.frame_time_span // 1000)
+        self.statistics = RunningStatistics(self.full_rows)
+        self.recording_statistics = []
+
+    def write_recording(self, i, audio, contours):
+        '''Writes the strip of one recording, as for PatchWriter.write_recording'''
+        config = self.config
+
+        ## parameter setting
+        frame_time_span = config.frame_time_span # ms, length of time for one time window to do dft.
+        step_time_span = config.step_time_span # ms, length of time step.
+        spec_clip_min = config.spec_clip_min
+        spec_clip_max = config.spec_clip_max # log magnitude spectrogram min-max normalization parameter
+        min_freq = config.min_freq # Hz, lower bound of frequency for spectrogram
+        max_freq = config.max_freq # Hz, upper bound of frequency for spectrogram
+        decimate = config.decimate # band-limit and resample before the dft
+
+        time_patch_frames = config.time_patch_frames
+        freq_patch_frames = config.freq_patch_frames
+        freq_resolution = 1000 / frame_time_span
+        # Strips are computed and written this many columns at a time
+        block_columns = max(1, config.patches_per_block * time_patch_frames * freq_patch_frames // 1024)
+
+        record, plan = self.inventory[i], self.plans[i]
+
+        # Recordings with a low sample rate may not reach max_freq
+        strip_max_freq = float(strip_dataset.strip_max_freq(record["rate"], frame_time_span=frame_time_span, max_freq=max_freq))
+        rows, columns = strip_dataset.strip_shape(record["nframes"], record["rate"], frame_time_span=frame_time_span,
+                                                  step_time_span=step_time_span, min_freq=min_freq, max_freq=max_freq)
+        strip_options = {}
+        if not config.contiguous:
+            strip_options = {"compression": "gzip", "chunks": (max(1, min(rows, freq_patch_frames)), max(1, min(columns, 4 * time_patch_frames)))}
+
+        group = self.recordings.create_group(str(i))
+        group.attrs["wav_file"] = os.path.basename(record["wav_file"])
+        group.attrs["bin_file"] = os.path.basename(record["bin_file"])
+        group.attrs["max_freq"] = strip_max_freq
+        group.create_dataset('data', shape=(rows, columns), dtype="f4", **strip_options)
+        group.create_dataset('label', shape=(rows, columns), dtype="f4", **strip_options)
+        self.recording_statistics.append(RunningStatistics(rows))
+
+        # The annotations are drawn once for the whole recording and each mask is sliced from them
+        raster = AnnotationRaster(contours, frame_time_span=frame_time_span, step_time_span=step_time_span,
+                                  min_freq=min_freq)
+
+        freq_offsets, time_offsets = strip_dataset.patch_offsets(plan["freq_starts"], plan["time_starts"],
+            frame_time_span=frame_time_span, step_time_span=step_time_span, max_freq=strip_max_freq,
+            freq_patch_frames=freq_patch_frames)
+        index = np.array([(i, f, t) for f in freq_offsets for t in time_offsets], dtype=np.int64).reshape(-1, 3)
+        # The positive pixels of each patch are counted block by block, so the label is never read back
+        positive_pixels = np.zeros(len(index), dtype=np.int64)
+
+        # Every column is framed and drawn on the grid of the whole recording, so the strip is
+        # the same whatever the size of the blocks
+        for first_column in range(0, columns, block_columns):
+            last_column = min(columns, first_column + block_columns)
+
+            if self.cache is not None:
+                stft, _ = self.cache.get(record["wav_file"], frame_time_span=frame_time_span, step_time_span=step_time_span)
+                bins = slice(int(min_freq // freq_resolution), int(strip_max_freq // freq_resolution))
+                spectrogram = normalize3(np.asarray(stft[first_column:last_column, bins], dtype=np.float64).T[::-1],
+                                         spec_clip_min, spec_clip_max)
+            else:
+                # One more step of audio covers the rounding of the frames' starts
+                source = audio.get(first_column * step_time_span, (last_column + 1) * step_time_span,
+                                   frame_time_span, step_time_span) if isinstance(audio, AudioWindows) else audio
+                spectrogram = getStripSpectrogram(source, frame_time_span=frame_time_span, step_time_span=step_time_span,
+                                                  spec_clip_min=spec_clip_min, spec_clip_max=spec_clip_max, min_freq=min_freq,
+                                                  max_freq=strip_max_freq, first_column=first_column, last_column=last_column,
+                                                  decimate=decimate)
+            mask, positive_flag = raster.getStripMask(min_freq=min_freq, max_freq=strip_max_freq,
+                                                      first_column=first_column, last_column=last_column)
+
+            group['data'][:, first_column:last_column] = spectrogram
+            group['label'][:, first_column:last_column] = mask
+            self.recording_statistics[-1].update(spectrogram, mask)
+            positive_pixels += count_positive_pixels(mask, index[:, 1], index[:, 2] - first_column,
+                                                     freq_patch_frames, time_patch_frames)
+
+        # Strips of recordings that do not reach max_freq lack rows at the top
+        self.statistics.merge(self.recording_statistics[-1], row_offset=self.full_rows - rows)
+
+        self.patch_index.append(index)
+        self.positive_pixels.append(positive_pixels)
+        self.patches.extend((freq, freq + freq_resolution * freq_patch_frames, time, time + step_time_span * time_patch_frames)
+                            for freq in plan["freq_starts"] for time in plan["time_starts"])
+
+    def close(self):
+        '''Writes the patch index, positive_flag, statistics and provenance'''
+        h5f = self.h5f
+
+        patch_index = np.concatenate(self.patch_index) if self.patch_index else np.zeros((0, 3), dtype=np.int64)
+        h5f.create_dataset('patch_index', data=patch_index)
+
+        # Flag the patches with a whistle in them
+        provenance = provenance_rows(0, self.patches)
+        provenance["recording"] = patch_index[:, 0]
+        if self.positive_pixels:
+            provenance["positive_pixels"] = np.concatenate(self.positive_pixels)
+        h5f.create_dataset('positive_flag', data=(provenance["positive_pixels"] > 0).astype("f4"))
+
+        write_statistics(h5f, self.statistics, self.recording_statistics, self.inventory)
+        write_provenance(h5f, provenance, [os.path.basename(record["wav_file"]) for record in self.inventory])
+
+    def abort(self):
+        '''Stops writing after a failure. Strips are written as they are computed, so there is nothing to stop'''
+
+def count_positive_pixels(mask, freq_offsets, time_offsets, freq_patch_frames, time_patch_frames):
+    '''
+    Counts the positive pixels of each patch that lie within a block of columns of a strip's label.
+
+    :param mask: the label of the block, of shape (rows, columns)
+    :param freq_offsets: the first row of each patch
+    :param time_offsets: the first column of each patch, relative to the block's first column.
+                         Patches may start before the block or end after it
+    :param freq_patch_frames: the number of rows of each patch
+    :param time_patch_frames: the number of columns of each patch
+
+    :returns: the number of positive pixels of each patch within the block
+    '''
+    # Summed-area table, so that each patch is counted from its four corners
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(mask > 0, axis=0), axis=1, out=table[1:, 1:])
+    top = np.clip(freq_offsets, 0, mask.shape[0])
+    bottom = np.clip(freq_offsets + freq_patch_frames, 0, mask.shape[0])
+    left = np.clip(time_offsets, 0, mask.shape[1])
+    right = np.clip(time_offsets + time_patch_frames, 0, mask.shape[1])
+    return table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+
+
+def spectrogram_cache(config):
+    '''Gets the SpectrogramCache selected by parsed arguments, or None'''
+    if config.spectrogram_cache is None:
+        return None
+    return SpectrogramCache(config.spectrogram_cache, max_bytes=int(config.spectrogram_cache_size * 1e9),
+                            dtype=config.spectrogram_cache_dtype)
+
+
+def load_configurations(parser, config):
+    '''
+    Gets the parsed arguments of every configuration to generate. Without --configurations,
+    this is config alone. Otherwise, each object of the JSON list in the given file is a
+    configuration, whose keys override the arguments of the command line, e.g.
+    [{"output_file": "8ms.hdf5"}, {"output_file": "16ms.hdf5", "frame_time_span": 16}]
+    '''
+    if config.configurations is None:
+        if config.output_file is None:
+            parser.error('--output_file is required without --configurations')
+        return [config]
+
+    with open(config.configurations) as file:
+        entries = json.load(file)
+    if not isinstance(entries, list) or len(entries) == 0:
+        parser.error(f'{config.configurations} must hold a non-empty list of configurations')
+
+    configurations = []
+    for entry in entries:
+        for name in entry:
+            if name not in vars(config) or name in SHARED_ARGUMENTS:
+                parser.error(f'"{name}" may not be set in a configuration')
+        configuration = argparse.Namespace(**{**vars(config), **entry})
+        if configuration.output_file is None:
+            parser.error(f'a configuration of {config.configurations} has no "output_file"')
+        configurations.append(configuration)
+    if len(set(os.path.abspath(c.output_file) for c in configurations)) < len(configurations):
+        parser.error('every configuration must have its own "output_file"')
+    return configurations
+
+
+def write_statistics(h5f, statistics, recording_statistics, inventory):
+    '''
+    Writes the statistics of all data to the group statistics and those of each
+    recording to the group statistics/recordings/<i>.
+    '''
+    group = h5f.create_group('statistics')
+    statistics.write(group)
+    for i, (record, recording) in enumerate(zip(inventory, recording_statistics)):
+        recording_group = group.create_group(f'recordings/{i}')
+        recording_group.attrs["wav_file"] = os.path.basename(record["wav_file"])
+        recording.write(recording_group)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--audio_dir', type=str, required=True, help='the path containing .wav files')
+    parser.add_argument('--annotation_dir', type=str, required=True, help='the path containing .bin files')
+    parser.add_argument('--output_file', type=str, default=None, help='The file path and name of the output hdf5 file. Required unless given by --configurations')
+    parser.add_argument('--configurations', type=str, default=None, help='a .json file with a list of configurations, each an object of arguments, including "output_file", that override those given here. Every configuration is generated in one pass over the recordings')
+
+    parser.add_argument('--frame_time_span', type=int, default=8, help='ms, length of time for one time window for dft')
+    parser.add_argument('--step_time_span', type=int, default=2, help='ms, length of time step for spectrogram')
+    parser.add_argument('--spec_clip_min', type=float, default=0, help='log magnitude spectrogram min-max normalization, minimum value')
+    parser.add_argument('--spec_clip_max', type=float, default=6, help='log magnitude spectrogram min-max normalization, maximum value')
+    parser.add_argument('--min_freq', type=int, default=5000, help='Hz, lower bound of frequency for spectrogram')
+    parser.add_argument('--max_freq', type=int, default=50000, help='Hz, upper bound of frequency for spectrogram')
+    parser.add_argument('--decimate', action='store_true', help='band-limit and resample the audio to a lower rate covering the frequency band before each dft, where that is estimated to be faster. With the default 64-row patches, about 2x faster at 192 kHz and 3-4x at 384 kHz. Wide bands, e.g. 5-50 kHz, and rates up to 96 kHz gain little or are left as they are. Values differ slightly from those without it')
+    parser.add_argument('--spectrogram_cache', type=str, default=None, help='a directory in which to cache the spectrogram of each whole audio file for reuse across runs with other frequency bands, patch sizes and clipping. Cached spectrograms are framed on one grid for each file, so they differ slightly from uncached ones, see the README. Not cached by default')
+    parser.add_argument('--spectrogram_cache_size', type=float, default=50, help='GB, the most disk space the spectrogram cache may use before the least recently used spectrograms are deleted')
+    parser.add_argument('--spectrogram_cache_dtype', type=str, default='float32', choices=['float32', 'float16'], help='the type in which cached spectrograms are stored')
+    parser.add_argument('--time_patch_frames', type=int, default=64, help='number of time frames, the length of each datum')
+    parser.add_argument('--freq_patch_frames', type=int, default=64, help='number of frequency frames, the height of each datum')
+    parser.add_argument('--time_patch_advance', type=int, default=64, help='number of frames, the time distance between patches')
+    parser.add_argument('--freq_patch_advance', type=int, default=64, help='number of frames, the frequency distance between patches')
+    parser.add_argument('--patches_per_block', type=int, default=128, help='the number of patches computed before each write. Does not effect output, only RAM use during execution. Chosen by --max_memory if given')
+    parser.add_argument('--write_buffers', type=int, default=2, help='the number of blocks of patches that may be in memory at once. One is computed while the others are written in the background')
+    parser.add_argument('--compression_threads', type=int, default=None, help='the number of threads compressing patches. Defaults to one per CPU. 0 compresses them in the writing thread')
+    parser.add_argument('--layout', type=str, default='patches', choices=['patches', 'strips'], help='"patches" stores every patch. "strips" stores the spectrogram and label of each whole audio file once, with an index of patches to be sliced out when read. Sliced patches may differ slightly from those of "patches", see the README')
+    parser.add_argument('--contiguous', action='store_true', help='store the data uncompressed and contiguously, so that memmap_dataset.py can map it with no copies')
+    parser.add_argument('--dry_run', action='store_true', help='only report the number of patches and the output size, without generating anything')
+    corpus_inventory.add_inventory_arguments(parser)
+    memory_budget.add_memory_arguments(parser)
+
+
+    config = parser.parse_args()
+    configurations = load_configurations(parser, config)
+    if config.spectrogram_cache is not None and any(c.decimate for c in configurations):
+        parser.error('--decimate cannot be used with --spectrogram_cache, whose spectrograms are not decimated')
+
+    # Read the headers of every recording and plan all of the patches up front
+    inventory = corpus_inventory.inventory_from_arguments(config)
+    plans = []
+    for configuration in configurations:
+        parameters = corpus_inventory.patch_parameters(configuration)
+        plans.append([corpus_inventory.plan_recording(record, **parameters) for record in inventory])
+        if len(configurations) > 1:
+            print(f'Configuration "{configuration.output_file}":')
+        corpus_inventory.print_plan(inventory, plans[-1], configuration.freq_patch_frames, configuration.time_patch_frames)
+
+    # Configurations with the same dft parameters share the spectra of each span of time they both
+    # request, which are held in memory unless an on-disk cache is used
+    # Strips are framed on one grid for each recording, so they do not share them
+    sharing = [c for c in configurations if not c.decimate and c.layout == 'patches']
+    stft_settings = collections.Counter((c.frame_time_span, c.step_time_span) for c in sharing)
+    shared = [c for c in sharing if stft_settings[(c.frame_time_span, c.step_time_span)] > 1]
+    disk_settings = set((c.frame_time_span, c.step_time_span) for c in configurations)
+
+    # With a memory budget, blocks and audio windows are sized to fit it
+    threads = config.compression_threads if config.compression_threads is not None else os.cpu_count()
+    max_pending = 8
+    audio_window = None
+    memory_cache_bytes = MEMORY_CACHE_BYTES
+    if config.max_memory is not None:
+        try:
+            memory_plan = memory_budget.plan_generation(config.max_memory * 1e9, inventory, configurations, plans, threads,
+                                                        memory_cache=config.spectrogram_cache is None and len(shared) > 0,
+                                                        disk_cache=config.spectrogram_cache is not None)
+        except ValueError as ex:
+            parser.error(str(ex))
+        memory_budget.print_memory_plan(memory_plan)
+        for configuration in configurations:
+            configuration.patches_per_block = memory_plan["patches_per_block"]
+        max_pending = memory_plan["max_pending"]
+        audio_window = memory_plan["audio_window"]
+        memory_cache_bytes = memory_plan["cache_bytes"]
+    if config.dry_run:
+        return
+
+    disk_cache = spectrogram_cache(config)
+    memory_cache = None
+    if disk_cache is None and shared:
+        memory_cache = MemorySpectrogramCache(max_bytes=memory_cache_bytes, min_freq=min(c.min_freq for c in shared), max_freq=max(c.max_freq for c in shared))
+
+    executor = compression_executor(config.compression_threads)
+    h5fs = []
+    writers = []
+    finished = 0
+    try:
+        for configuration, configuration_plans in zip(configurations, plans):
+            if disk_cache is not None:
+                cache = disk_cache
+            elif any(configuration is c for c in shared):
+                cache = memory_cache
+            else:
+                cache = None
+            h5fs.append(h5py.File(configuration.output_file, 'w'))
+            writer_class = StripWriter if configuration.layout == 'strips' else PatchWriter
+            writers.append(writer_class(h5fs[-1], inventory, configuration_plans, configuration, cache=cache, executor=executor,
+                                        max_pending=max_pending))
+
+        # Build the hdf5s one wav file at a time
+        for i, record in enumerate(inventory):
+            print('Processing audio file: %d/%d "%s"' % (i+1, len(inventory), os.path.basename(record["wav_file"])))
+            wav_file = record["wav_file"]
 
-                h5f['label'].resize((h5f['label'].shape[0] + block_idx+1), axis=0)
-                h5f['label'][-(block_idx+1):] = mask_block[:block_idx+1]
+            # Each recording is decoded and its contours parsed once for every configuration.
+            # With an on-disk cache, the audio is only read if a spectrogram is not cached yet.
+            # Audio too large for the memory budget is read a window at a time
+            wav = None
+            if audio_window is not None:
+                wav = AudioWindows(wav_file, audio_window)
+            elif (any(writer.cache is None or writer.cache is memory_cache for writer in writers)
+                    or any(not disk_cache.contains(wav_file, *setting) for setting in disk_settings)):
+                wav = wavio.read(wav_file)
+            if disk_cache is not None:
+                for frame_time_span, step_time_span in disk_settings:
+                    disk_cache.get(wav_file, frame_time_span=frame_time_span, step_time_span=step_time_span, wav=wav)
+            if memory_cache is not None:
+                memory_cache.load(wav_file, wav)
 
-                h5f['positive_flag'].resize((h5f['positive_flag'].shape[0] + block_idx+1), axis=0)
-                h5f['positive_flag'][-(block_idx+1):] = positive_flag_block[:block_idx+1]
+            with tonalReader(record["bin_file"]) as reader:
+                contours = reader.getTimeFrequencyContours()
 
-            num_patches_processed += 1
+            for writer in writers:
+                writer.write_recording(i, wav if writer.cache is None else wav_file, contours)
+            if audio_window is not None:
+                wav.close()
 
-    h5f.close()
+        for writer in writers:
+            writer.close()
+            finished += 1
+    finally:
+        # A failure or an interrupt stops the writers that have not finished and marks their
+        # outputs incomplete, so that a partial file is not mistaken for a whole one
+        for i, h5f in enumerate(h5fs):
+            if i >= finished:
+                if i < len(writers):
+                    writers[i].abort()
+                h5f.attrs["incomplete"] = True
+            h5f.close()
+        if executor is not None:
+            executor.shutdown()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
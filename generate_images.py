@@ -4,7 +4,8 @@ import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import helper_functions as wav2spec
-from write_images import write_images
+from write_images import write_images, write_pyramid
+from silbidopy.cache import SpectrogramCache
 
 import argparse
 
@@ -20,9 +21,19 @@ def main():
     parser.add_argument('--spec_clip_max', type=float, default=6, help='log magnitude spectrogram min-max normalization, maximum value')
     parser.add_argument('--min_freq', type=int, default=5000, help='Hz, lower bound of frequency for spectrogram')
     parser.add_argument('--max_freq', type=int, default=50000, help='Hz, upper bound of frequency for spectrogram')
+    parser.add_argument('--decimate', action='store_true', help='band-limit and resample the audio to a lower rate covering the frequency band before each dft, where that is estimated to be faster. Only bands narrow for the sample rate gain, e.g. 8 kHz bands by about 2x at 192 kHz and 3-4x at 384 kHz. The default 5-50 kHz band is left as it is. Values differ slightly from those without it')
+    parser.add_argument('--spectrogram_cache', type=str, default=None, help='a directory in which to cache the spectrogram of each whole audio file for reuse across runs with other frequency bands, patch sizes and clipping. Cached spectrograms are framed on one grid for each file, so they differ slightly from uncached ones, see the README. Not cached by default')
+    parser.add_argument('--spectrogram_cache_size', type=float, default=50, help='GB, the most disk space the spectrogram cache may use before the least recently used spectrograms are deleted')
+    parser.add_argument('--spectrogram_cache_dtype', type=str, default='float32', choices=['float32', 'float16'], help='the type in which cached spectrograms are stored')
     parser.add_argument('--split_time', type=int, default=3000, help='ms, length of time for each output spectrogram image.')
+    parser.add_argument('--pyramid', action='store_true', help='write, for each audio file, a pyramid of quick-look tiles at several time zooms, indexed in pyramid.json, instead of images of split_time each')
+    parser.add_argument('--tile_frames', type=int, default=1024, help='with --pyramid, the number of time columns of each tile')
+    parser.add_argument('--pyramid_levels', type=int, default=None, help='with --pyramid, the number of levels, each half the time resolution of the one below. Defaults to as many as needed for one tile to hold a whole audio file')
+    parser.add_argument('--pyramid_pooling', type=str, default='max', choices=['max', 'mean'], help='with --pyramid, how spectrogram columns are pooled into each coarser level. Masks are always max-pooled')
 
     config = parser.parse_args()
+    if config.decimate and config.spectrogram_cache is not None:
+        parser.error('--decimate cannot be used with --spectrogram_cache, whose spectrograms are not decimated')
     ## parameter setting
     frame_time_span = config.frame_time_span # ms, length of time for one time window to do dft.
     step_time_span = config.step_time_span # ms, length of time step.
@@ -30,6 +41,11 @@ def main():
     clip_max = config.spec_clip_max # log magnitude spectrogram min-max normalization parameter
     min_freq = config.min_freq # Hz, lower bound of frequency for spectrogram
     max_freq = config.max_freq # Hz, upper bound of frequency for spectrogram
+    decimate = config.decimate # band-limit and resample before the dft
+    cache = None
+    if config.spectrogram_cache is not None:
+        cache = SpectrogramCache(config.spectrogram_cache, max_bytes=int(config.spectrogram_cache_size * 1e9),
+                                 dtype=config.spectrogram_cache_dtype)
     split_time = config.split_time # ms, length of time for each output spectrogram image.
 
 
@@ -64,9 +80,15 @@ def main():
         output_dir = imsave_output_dir + '/' + wav_filename
         wav2spec.check_dir(output_dir)
 
-        count = write_images(anno_wav_files[i], bin_files[i], output_dir, frame_time_span=frame_time_span,step_time_span=step_time_span,
-                                     spec_clip_min=clip_min, spec_clip_max=clip_max, min_freq=min_freq,
-                                     max_freq=max_freq, split_time = split_time)
+        if config.pyramid:
+            count = write_pyramid(anno_wav_files[i], bin_files[i], output_dir, frame_time_span=frame_time_span,step_time_span=step_time_span,
+                                  spec_clip_min=clip_min, spec_clip_max=clip_max, min_freq=min_freq,
+                                  max_freq=max_freq, tile_frames = config.tile_frames, levels = config.pyramid_levels,
+                                  pooling = config.pyramid_pooling, decimate = decimate, cache = cache)
+        else:
+            count = write_images(anno_wav_files[i], bin_files[i], output_dir, frame_time_span=frame_time_span,step_time_span=step_time_span,
+                                         spec_clip_min=clip_min, spec_clip_max=clip_max, min_freq=min_freq,
+                                         max_freq=max_freq, split_time = split_time, decimate = decimate, cache = cache)
         print('number of output: ' + str(count))
 
 
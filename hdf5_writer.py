@@ -0,0 +1,253 @@
+import os
+import zlib
+import queue
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Target size in bytes of each chunk of a dataset of patches before compression
+CHUNK_BYTES = 256 * 1024
+
+
+def patch_dataset_options(row_shape, contiguous = False, itemsize = 4):
+    '''
+    Gets the create_dataset keyword arguments of a dataset whose rows, e.g. patches, are
+    written in order. Datasets are gzip-compressed in chunks of whole rows, which
+    ChunkStager supports, unless contiguous is set, in which case they are stored
+    uncompressed in one contiguous block that memmap_dataset can map.
+
+    :param row_shape: the shape of each row, e.g. (64, 64) for 64x64 patches
+    :param contiguous: whether to store the dataset uncompressed and contiguously.
+                       Contiguous datasets cannot be resized
+    :param itemsize: bytes per value
+    '''
+    if contiguous:
+        return {}
+    row_shape = tuple(row_shape)
+    chunk_rows = max(1, CHUNK_BYTES // (int(np.prod(row_shape, dtype=np.int64)) * itemsize))
+    return {"compression": "gzip", "chunks": (chunk_rows,) + row_shape, "maxshape": (None,) + row_shape}
+
+
+def compression_executor(threads = None):
+    '''
+    Gets a thread pool in which ChunkStagers compress chunks, or None to compress them in the
+    writing thread. zlib releases the GIL, so the threads compress in parallel. The caller
+    shuts the pool down once its writers have finished.
+
+    :param threads: the number of threads. Defaults to one per CPU. 0 compresses in the writing thread
+    '''
+    if threads == 0:
+        return None
+    return ThreadPoolExecutor(max_workers=threads or os.cpu_count(), thread_name_prefix="compress")
+
+
+class ChunkStager:
+    def __init__(self, dataset, executor = None, max_pending = 8):
+        '''
+        Writes rows to a gzip-compressed dataset one whole chunk at a time, compressing each
+        chunk with zlib and storing the bytes with write_direct_chunk. zlib releases the GIL
+        while compressing, whereas HDF5's own filter holds it for the whole write, so this
+        lets compression run alongside computation in other threads. The file is the same
+        as one written through h5py, so any reader can open it.
+
+        Rows must be added in order, starting at row 0, and the dataset must be chunked by
+        whole rows, i.e. each chunk covers every axis but the first in full.
+
+        :param dataset: the h5py dataset
+        :param executor: a thread pool from compression_executor in which chunks are compressed,
+                         or None to compress them in the calling thread. Compressed chunks are
+                         always written by the calling thread, in order
+        :param max_pending: the most chunks that may be compressing at once before add waits
+        '''
+        self.dataset = dataset
+        self.level = dataset.compression_opts
+        self.stage = np.zeros(dataset.chunks, dtype=dataset.dtype)
+        self.staged = 0
+        self.chunk_start = 0
+        self.executor = executor
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+
+    @staticmethod
+    def supports(dataset):
+        '''Whether the dataset is chunked and filtered such that ChunkStager can write it'''
+        return (dataset.chunks is not None and dataset.compression == "gzip"
+                and tuple(dataset.chunks[1:]) == tuple(dataset.shape[1:])
+                and not dataset.shuffle and not dataset.fletcher32 and dataset.scaleoffset is None)
+
+    def add(self, rows, offset):
+        '''Adds rows, which start at row offset of the dataset'''
+        if offset != self.chunk_start + self.staged:
+            raise ValueError(f"Rows must be added in order: expected row {self.chunk_start + self.staged}, got {offset}.")
+        while len(rows) > 0:
+            count = min(len(rows), len(self.stage) - self.staged)
+            self.stage[self.staged:self.staged + count] = rows[:count]
+            self.staged += count
+            rows = rows[count:]
+            if self.staged == len(self.stage):
+                self.flush()
+
+    def flush(self):
+        '''Compresses the staged rows, if any, as a whole chunk padded with zeros'''
+        if self.staged == 0:
+            return
+        self.stage[self.staged:] = 0
+        # The bytes are a copy, so the stage may be filled again while they are compressed
+        data = self.stage.tobytes()
+        offset = (self.chunk_start,) + (0,) * (self.stage.ndim - 1)
+        if self.executor is None:
+            self.dataset.id.write_direct_chunk(offset, zlib.compress(data, self.level))
+        else:
+            self.pending.append((offset, self.executor.submit(zlib.compress, data, self.level)))
+            self._write_compressed(keep=self.max_pending)
+        self.chunk_start += len(self.stage)
+        self.staged = 0
+
+    def finish(self):
+        '''Writes the staged rows and waits for every chunk to be written'''
+        self.flush()
+        self._write_compressed(keep=0)
+
+    def _write_compressed(self, keep):
+        # Writes the compressed chunks in order, waiting until no more than keep are pending
+        while self.pending and (len(self.pending) > keep or self.pending[0][1].done()):
+            offset, future = self.pending.popleft()
+            self.dataset.id.write_direct_chunk(offset, future.result())
+
+
+class RowWriter:
+    def __init__(self, dataset, executor = None, max_pending = 8):
+        '''
+        Writes rows to a dataset in order, through a ChunkStager if the dataset supports one
+        and otherwise through h5py.
+
+        :param dataset: the h5py dataset
+        :param executor: as for ChunkStager
+        :param max_pending: as for ChunkStager
+        '''
+        self.dataset = dataset
+        self.stager = ChunkStager(dataset, executor=executor, max_pending=max_pending) if ChunkStager.supports(dataset) else None
+
+    def write(self, rows, offset):
+        '''Writes rows, which start at row offset of the dataset'''
+        if self.stager is not None:
+            self.stager.add(rows, offset)
+        else:
+            self.dataset[offset:offset + len(rows)] = rows
+
+    def finish(self):
+        '''Waits for every row to be written'''
+        if self.stager is not None:
+            self.stager.finish()
+
+
+class BlockWriter:
+    def __init__(self, h5f, shapes, dtype = "f4", num_buffers = 2, executor = None, max_pending = 8):
+        '''
+        Writes blocks of patches to datasets of an open HDF5 file from a background thread,
+        so that the next block can be computed while the last is compressed and written.
+
+        Blocks are taken from a fixed set of num_buffers buffers. With the default of two,
+        one block is filled while the other is written. Once every buffer is in use,
+        get_block waits for the writer, so memory use stays bounded.
+
+        Datasets that ChunkStager supports are compressed by the writer thread itself, or by
+        the threads of executor, alongside the computation of the next block. Others are
+        written through h5py.
+
+        Any error raised while writing is raised again by the next call to get_block,
+        put_block or close, so a failed write never goes unnoticed.
+
+        :param h5f: the open HDF5 file, with datasets already created
+        :param shapes: the name of each dataset written mapped to the shape of one of its blocks,
+                       e.g. {"data": (128, 64, 64), "positive_flag": (128,)}
+        :param dtype: the type of the block buffers
+        :param num_buffers: the number of blocks that may be in use at once
+        :param executor: a thread pool from compression_executor, or None
+        :param max_pending: the most chunks of each dataset that may be compressing at once, as for ChunkStager
+        '''
+        self.writers = {name: RowWriter(h5f[name], executor=executor, max_pending=max_pending) for name in shapes}
+        self.free = queue.Queue()
+        for _ in range(num_buffers):
+            self.free.put({name: np.zeros(shape, dtype=dtype) for name, shape in shapes.items()})
+
+        # Bounded, so at most every buffer is waiting on the writer
+        self.pending = queue.Queue(maxsize=num_buffers)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="BlockWriter", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                try:
+                    if self.error is None:
+                        for writer in self.writers.values():
+                            writer.finish()
+                except BaseException as ex:
+                    self.error = ex
+                return
+            block, offset, count = item
+            try:
+                if self.error is None:
+                    for name, buffer in block.items():
+                        self.writers[name].write(buffer[:count], offset)
+            except BaseException as ex:
+                self.error = ex
+            # Buffers are always returned, so the producer cannot wait forever on a failed writer
+            self.free.put(block)
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("Writing to the HDF5 file failed.") from self.error
+
+    def get_block(self):
+        '''
+        Waits for a free block.
+
+        :returns: a dictionary of the block buffer of each dataset. Its contents are those
+                  of an earlier block, so every row that is put must be overwritten
+        '''
+        self._check()
+        block = self.free.get()
+        self._check()
+        return block
+
+    def put_block(self, block, offset, count):
+        '''
+        Queues the first count rows of a block from get_block to be written starting at row offset.
+        Blocks must be put in order of their rows. The block must not be modified until it is
+        returned again by get_block.
+        '''
+        self._check()
+        self.pending.put((block, offset, count))
+
+    def close(self):
+        '''Waits for every queued block to be written and stops the writer thread'''
+        self.pending.put(None)
+        self.thread.join()
+        self._check()
+
+    def abort(self, error = None):
+        '''
+        Stops the writer thread without writing the blocks still queued or the staged chunks,
+        e.g. once the producer has failed. The datasets are left incomplete.
+
+        :param error: the reason, raised again by any later call. Any earlier write error is kept
+        '''
+        self.error = self.error or error or RuntimeError("Writing was aborted.")
+        self.pending.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Still stop the writer, but keep the original exception
+            self.abort(exc_value)
@@ -0,0 +1,50 @@
+import h5py
+import numpy as np
+
+
+def memmap_dataset(filename, name):
+    '''
+    Maps a contiguous, uncompressed dataset of an HDF5 file, e.g. one written by
+    generate_hdf5.py with --contiguous, as a read-only np.memmap. Reads then go
+    straight to the page cache, which every process mapping the file shares, with
+    no copies and no calls to the HDF5 library.
+
+    :param filename: the HDF5 file
+    :param name: the path of the dataset within the file
+
+    :returns: a read-only np.memmap with the shape and type of the dataset
+    '''
+    with h5py.File(filename, 'r') as h5f:
+        dataset = h5f[name]
+        if dataset.chunks is not None or dataset.compression is not None:
+            raise ValueError(f"Dataset {name} of {filename} is not stored contiguously and uncompressed.")
+        shape, dtype = dataset.shape, dataset.dtype
+        offset = dataset.id.get_offset()
+
+    if offset is None:
+        # Storage is only allocated once something is written
+        if np.prod(shape, dtype=np.int64) > 0:
+            raise ValueError(f"Dataset {name} of {filename} has never been written.")
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(filename, mode='r', dtype=dtype, shape=shape, offset=offset)
+
+
+class MemmapPatches:
+    def __init__(self, filename):
+        '''
+        The data, label and positive_flag datasets of a contiguous HDF5 file of patches,
+        each mapped with memmap_dataset. Slicing a batch, e.g. patches.data[i:i + 64],
+        returns a view into the mapped file.
+
+        :param filename: the HDF5 file
+        '''
+        self.data = memmap_dataset(filename, 'data')
+        self.label = memmap_dataset(filename, 'label')
+        self.positive_flag = memmap_dataset(filename, 'positive_flag')
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        '''Returns the patches at idx as a tuple: (data, label, positive_flag)'''
+        return self.data[idx], self.label[idx], self.positive_flag[idx]
@@ -0,0 +1,260 @@
+import math
+import wave
+
+import wavio
+
+from hdf5_writer import CHUNK_BYTES
+from provenance import PROVENANCE_DTYPE
+
+# Bytes of each value of the stored patches, and of the float64 arrays they are computed in
+VALUE_SIZE = 4
+COMPUTE_SIZE = 8
+
+# Bytes held by RunningStatistics.update for each value of a block: its float64 copy, the
+# copy regrouped by row, the squared deviations, the clipped copy and the histogram's work
+STATISTICS_BYTES = 5 * COMPUTE_SIZE
+
+# Blocks beyond this many patches write no faster, so the budget does not size them larger
+MAX_PATCHES_PER_BLOCK = 1024
+
+# Estimated bytes held by an AnnotationRaster for each pixel of an annotation
+RASTER_PIXEL_BYTES = 64
+
+
+def add_memory_arguments(parser):
+    '''Adds the --max_memory argument to an argparse.ArgumentParser'''
+    parser.add_argument('--max_memory', type=float, default=None, help='GB, the memory the run may use. Block sizes and audio windows are then chosen to fit, in place of the arguments that set them')
+
+
+def audio_bytes(record, num_samples = None):
+    '''
+    Estimates the peak memory used to read samples of a recording, i.e. the bytes read and the
+    array wavio decodes them into.
+
+    :param record: one recording of corpus_inventory.build_inventory
+    :param num_samples: the number of samples read. Defaults to the whole recording
+    '''
+    if num_samples is None:
+        num_samples = record["nframes"]
+    itemsize = {1: 1, 2: 2}.get(record["sampwidth"], 4)
+    # 24 bit samples are widened through an intermediate array of 4 bytes each
+    widen = 4 if record["sampwidth"] == 3 else 0
+    return num_samples * record["channels"] * (record["sampwidth"] + itemsize + widen)
+
+
+def spectrogram_bytes(columns, rate, frame_time_span = 8, rows = None):
+    '''
+    Estimates the memory used by getSpectrogram to compute columns frames: the frames, their
+    transforms and magnitudes and the normalized spectrogram.
+
+    :param columns: the number of columns computed at once
+    :param rate: Hz, the sample rate of the recording
+    :param frame_time_span: ms, length of time for one time window for dft
+    :param rows: the number of rows kept. Defaults to every bin
+    '''
+    frame_sample_span = int(math.floor(frame_time_span / 1000 * rate))
+    bins = frame_sample_span // 2 + 1
+    rows = bins if rows is None else rows
+    # Frames, as read and as float64, their complex transform and its magnitude, then the kept rows
+    return columns * (frame_sample_span * (2 + COMPUTE_SIZE) + bins * 3 * COMPUTE_SIZE + rows * 3 * COMPUTE_SIZE)
+
+
+def raster_bytes(record, frame_time_span = 8, step_time_span = 2):
+    '''Estimates the memory of the AnnotationRaster of a recording from the bounds of its contours'''
+    freq_resolution = 1000 / frame_time_span
+    pixels = sum(max((end_time - start_time) * 1000 / step_time_span, (high_freq - low_freq) / freq_resolution) + 1
+                 for start_time, end_time, low_freq, high_freq in record["contours"])
+    return int(pixels * RASTER_PIXEL_BYTES)
+
+
+def compression_bytes(num_datasets, max_pending):
+    '''The most memory held by the ChunkStagers of num_datasets datasets: each stage and, for each
+    chunk pending, its bytes and their compressed copy'''
+    return num_datasets * (1 + 2 * max_pending) * CHUNK_BYTES
+
+
+def audio_span_samples(time_span, record, frame_time_span = 8, step_time_span = 2):
+    '''The number of samples getSpectrogram reads for time_span ms of columns, plus one for rounding'''
+    return int(math.ceil((time_span + frame_time_span - step_time_span) / 1000 * record["rate"])) + 1
+
+
+def plan_generation(max_memory, inventory, configurations, plans, threads, memory_cache = False, disk_cache = False):
+    '''
+    Sizes the blocks of generate_hdf5.py and chooses whether to read each recording whole or a
+    window at a time, so that the estimated peak memory fits in max_memory. The estimate accounts
+    for the decoded audio, the spectrogram buffers, the masks and annotation rasters, the
+    blocks of every configuration waiting to be written, the chunks waiting to be compressed,
+    the provenance tables, the statistics of each block and any in-memory spectrogram.
+
+    Audio is read whole, as without a budget, unless it would take more than half of the memory
+    left for it and the blocks. It is then read in windows of a quarter of that memory, which
+    are read again for each row of patches. Recordings are always read whole when decimating
+    or filling a spectrogram cache on disk.
+
+    :param max_memory: bytes, the memory the run may use
+    :param inventory: the records of corpus_inventory.build_inventory
+    :param configurations: the parsed arguments of each configuration
+    :param plans: the plans of each configuration from corpus_inventory.plan_recording
+    :param threads: the number of threads compressing chunks, or 0
+    :param memory_cache: whether a MemorySpectrogramCache holds spectra shared by configurations
+    :param disk_cache: whether spectrograms are read from a SpectrogramCache
+
+    :returns: a dictionary with the "patches_per_block" of every configuration, the "max_pending"
+              chunks of each dataset, the "audio_window" in samples, or None to read recordings
+              whole, the "cache_bytes" of a MemorySpectrogramCache and the estimated bytes of
+              each part of the budget, in "parts"
+    '''
+    if len(inventory) == 0:
+        return {"patches_per_block": MAX_PATCHES_PER_BLOCK, "max_pending": 1, "audio_window": None, "cache_bytes": 0, "parts": {}}
+    max_rate = max(record["rate"] for record in inventory)
+    max_nframes = max(record["nframes"] for record in inventory)
+    # Chunks compressing at once. More than one per thread only waits in the queue
+    max_pending = max(1, threads)
+
+    parts = {"compression": 0, "spectrogram": 0, "raster": 0, "provenance": 0, "cache": 0}
+    per_patch = 0
+    for configuration, configuration_plans in zip(configurations, plans):
+        freq_patch_frames, time_patch_frames = configuration.freq_patch_frames, configuration.time_patch_frames
+        frame_time_span, step_time_span = configuration.frame_time_span, configuration.step_time_span
+        full_rows = int(configuration.max_freq * frame_time_span // 1000) - int(configuration.min_freq * frame_time_span // 1000)
+        parts["raster"] += max(raster_bytes(record, frame_time_span, step_time_span) for record in inventory)
+        # The table, and its copy as it is joined
+        parts["provenance"] += 2 * sum(plan["num_patches"] for plan in configuration_plans) * PROVENANCE_DTYPE.itemsize
+
+        if configuration.layout == 'strips':
+            # Each patch of a block adds T * F / 1024 columns to the strip block
+            columns_per_patch = time_patch_frames * freq_patch_frames / 1024
+            per_patch += columns_per_patch * (spectrogram_bytes(1, max_rate, frame_time_span, full_rows)
+                                              + full_rows * (2 * COMPUTE_SIZE + STATISTICS_BYTES))
+            # The summed-area table of each block's label, counting the positive pixels of its patches
+            per_patch += columns_per_patch * full_rows * COMPUTE_SIZE
+        else:
+            patch_bytes = 2 * freq_patch_frames * time_patch_frames * VALUE_SIZE + VALUE_SIZE
+            # Statistics are taken of each whole block before it is written
+            per_patch += configuration.write_buffers * patch_bytes + freq_patch_frames * time_patch_frames * STATISTICS_BYTES
+            parts["compression"] += compression_bytes(3, max_pending)
+            parts["spectrogram"] += (spectrogram_bytes(time_patch_frames, max_rate, frame_time_span, freq_patch_frames)
+                                     + 2 * freq_patch_frames * time_patch_frames * COMPUTE_SIZE)
+
+    cache_bytes = 0
+    if memory_cache:
+        # Spectra of the shared band are kept for every span of time requested, so overlapping patches
+        # cover a recording several times over. They are kept only up to a quarter of the budget
+        shared = [c for c in configurations if not c.decimate and c.layout == 'patches']
+        min_freq, max_freq = min(c.min_freq for c in shared), max(c.max_freq for c in shared)
+        for c in shared:
+            overlap = max(1, c.time_patch_frames / c.time_patch_advance)
+            cache_bytes += (int(max_nframes / max_rate * 1000 / c.step_time_span) * overlap
+                            * int((max_freq - min_freq) * c.frame_time_span / 1000) * COMPUTE_SIZE)
+        cache_bytes = int(min(cache_bytes, max_memory / 4))
+        parts["cache"] = cache_bytes
+
+    available = max_memory - sum(parts.values())
+    whole_audio = max(audio_bytes(record) for record in inventory)
+    windows_allowed = not disk_cache and not any(c.decimate for c in configurations)
+
+    audio_window = None
+    if windows_allowed and whole_audio > available / 2:
+        # Each window should hold the audio of at least one patch
+        smallest = max(audio_span_samples(c.step_time_span * c.time_patch_frames, record, c.frame_time_span, c.step_time_span)
+                       for record in inventory for c in configurations)
+        largest_record = max(inventory, key=lambda record: audio_bytes(record, 1))
+        audio_window = max(smallest, int(available / 4 / audio_bytes(largest_record, 1)))
+        parts["audio"] = audio_bytes(largest_record, audio_window)
+    else:
+        parts["audio"] = whole_audio
+    available -= parts["audio"]
+
+    patches_per_block = min(MAX_PATCHES_PER_BLOCK, int(available // per_patch)) if per_patch > 0 else MAX_PATCHES_PER_BLOCK
+    if patches_per_block < 1:
+        raise ValueError(f"A memory budget of {_megabytes(max_memory)} is too small: "
+                         + ", ".join(f"{name} {_megabytes(size)}" for name, size in parts.items())
+                         + f" leave no room for one patch of {_megabytes(per_patch)}.")
+    parts["blocks"] = patches_per_block * per_patch
+    return {"patches_per_block": patches_per_block, "max_pending": max_pending, "audio_window": audio_window,
+            "cache_bytes": cache_bytes, "parts": parts}
+
+
+def plan_rows(max_memory, row_bytes, fixed = 0, compressed_datasets = 0, threads = 0):
+    '''
+    Sizes the blocks of rows of a tool that copies rows between HDF5 files, such as
+    split_hdf5_positive_negative.py, so that its estimated peak memory fits in max_memory.
+
+    :param max_memory: bytes, the memory the tool may use
+    :param row_bytes: the bytes held for each row of a block, counting every copy of it
+    :param fixed: the bytes held regardless of the block size, e.g. whole columns read up front
+    :param compressed_datasets: the number of datasets written through ChunkStagers
+    :param threads: the number of threads compressing chunks, or 0
+
+    :returns: a tuple with the rows of each block and the most chunks pending for each dataset:
+              (block_size, max_pending)
+    '''
+    max_pending = max(1, threads)
+    available = max_memory - fixed - compression_bytes(compressed_datasets, max_pending)
+    block_size = int(available // row_bytes)
+    if block_size < 1:
+        raise ValueError(f"A memory budget of {_megabytes(max_memory)} is too small for one row of "
+                         f"{_megabytes(row_bytes)} after {_megabytes(max_memory - available)} of other buffers.")
+    return block_size, max_pending
+
+
+def _megabytes(size):
+    return f"{size / 1e6:.1f} MB"
+
+
+def print_memory_plan(plan):
+    '''Prints how a plan from plan_generation divides the memory budget'''
+    parts = ", ".join(f"{name} {_megabytes(size)}" for name, size in plan["parts"].items() if size > 0)
+    audio = "whole recordings" if plan["audio_window"] is None else f"windows of {plan['audio_window']} samples"
+    print(f'Memory: {parts}. Audio read as {audio}, blocks of {plan["patches_per_block"]} patches')
+
+
+class AudioWindows:
+    def __init__(self, filename, window_samples):
+        '''
+        Reads an audio file a window at a time, in place of wavio.read, for getSpectrogram. Each
+        window is a wavio.Wav of consecutive samples whose offset attribute is the index of its
+        first value in the data of the whole file, flattened, which getSpectrogram reads
+        exactly as it would the whole file.
+
+        :param filename: the audio file in .wav format
+        :param window_samples: the samples read at once. A window is longer if a single request needs it
+        '''
+        self.filename = filename
+        self.window_samples = window_samples
+        self.file = wave.open(filename, 'rb')
+        self.rate = self.file.getframerate()
+        self.channels = self.file.getnchannels()
+        self.sampwidth = self.file.getsampwidth()
+        self.nframes = self.file.getnframes()
+        self.window = None
+        self.first = 0
+        self.last = 0
+
+    def get(self, start_time, end_time, frame_time_span = 8, step_time_span = 2):
+        '''
+        Gets a window holding every sample that getSpectrogram reads for these arguments,
+        reading a new one only if the last does not hold them.
+
+        :returns: the wavio.Wav of the window
+        '''
+        # The same bounds as getSpectrogram, as indices into the flattened data
+        start_frame = int(start_time / 1000 * self.rate)
+        end_frame = int((end_time / 1000 + frame_time_span / 1000 - step_time_span / 1000) * self.rate)
+        first = max(0, start_frame // self.channels)
+        last = min(self.nframes, -(-end_frame // self.channels))
+
+        if self.window is None or first < self.first or last > self.last:
+            self.first = first
+            self.last = min(self.nframes, max(last, first + self.window_samples))
+            self.file.setpos(first)
+            data = self.file.readframes(self.last - first)
+            # wavio decodes the frames as wavio.read does
+            self.window = wavio.Wav(data=wavio._wav2array(self.channels, self.sampwidth, data),
+                                    rate=self.rate, sampwidth=self.sampwidth)
+            self.window.offset = first * self.channels
+        return self.window
+
+    def close(self):
+        self.window = None
+        self.file.close()
@@ -0,0 +1,326 @@
+import argparse
+import threading
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.connection import Listener, Client
+
+import h5py
+import numpy as np
+
+# The datasets served, each with one row per patch
+DATASETS = ("data", "label", "positive_flag")
+
+# Byte alignment of each dataset's slots within the shared memory
+ALIGNMENT = 64
+
+
+def slot_arrays(buffer, layout):
+    '''
+    Gets the arrays of the slots of each dataset within the shared memory of a PatchServer.
+
+    :param buffer: the buffer of the shared memory
+    :param layout: the layout sent by the server to each client
+
+    :returns: a dictionary of the array of each dataset, of shape (slots, block_rows) + row shape
+    '''
+    return {name: np.ndarray((layout["num_slots"], layout["block_rows"]) + tuple(shape), dtype=np.dtype(dtype),
+                             buffer=buffer, offset=offset)
+            for name, dtype, shape, offset in layout["fields"]}
+
+
+def batch_sequence(num_patches, block_rows, window, batch_size, seed = None):
+    '''
+    Yields, forever, the batches a client is served. Each batch is a run of at most batch_size
+    rows of one block. The blocks are taken in order in windows of window blocks, and the batches
+    of each window are shuffled. Every patch is served once per pass over the file, and the
+    sequence depends only on its arguments, so a client sees the same batches whichever
+    other clients are served.
+
+    :param num_patches: the number of rows of the file
+    :param block_rows: the number of rows of each block
+    :param window: the number of blocks whose batches are shuffled together
+    :param batch_size: the most rows of each batch
+    :param seed: the seed of the shuffle
+
+    :returns: a generator of (block, start, stop) tuples, with start and stop rows of the block
+    '''
+    rng = np.random.default_rng(seed)
+    num_blocks = -(-num_patches // block_rows)
+    while True:
+        for first in range(0, num_blocks, window):
+            batches = []
+            for block in range(first, min(first + window, num_blocks)):
+                rows = min(block_rows, num_patches - block * block_rows)
+                batches.extend((block, start, min(start + batch_size, rows)) for start in range(0, rows, batch_size))
+            for i in rng.permutation(len(batches)):
+                yield batches[i]
+
+
+class PatchServer:
+    def __init__(self, filename, address = None, max_memory = 10 ** 9, block_rows = 1024, window = None):
+        '''
+        Serves the patches of an HDF5 file written by generate_hdf5.py to training processes on the
+        same machine, so that each chunk is read and decompressed once for all of them rather than
+        once for each.
+
+        Blocks of rows are read into slots of one multiprocessing.shared_memory buffer. The slot
+        used least recently, and held by no client, is reused for the next block, so the buffer
+        never exceeds max_memory. Clients connect with PatchClient over a local socket, or a named
+        pipe on Windows, and are sent only the slot and rows of each batch, which they view in
+        the shared memory with no copies.
+
+        Each client is served batch_sequence with its own seed. Clients on the same window share
+        its blocks. A client holds the slot of its last batch until it asks for the next one, and
+        a client that exits, or dies, releases it, so the server keeps serving the others.
+
+        Batches are runs of consecutive rows, so a file whose patches are in the order they
+        were generated should first be shuffled with randomize_hdf5.py.
+
+        :param filename: the HDF5 file, in the patches layout
+        :param address: the address to listen on, e.g. a socket file. If None, one is chosen
+        :param max_memory: bytes, the size of the shared memory
+        :param block_rows: the rows read at once into each slot, rounded up to whole chunks.
+                           Also the largest batch clients may ask for
+        :param window: the number of blocks whose batches are shuffled together. Defaults to
+                       half of the slots, so that clients may be a window apart with no rereads
+        '''
+        self.h5f = h5py.File(filename, 'r')
+        if 'data' not in self.h5f:
+            raise ValueError(f"{filename} has no data dataset. Only files in the patches layout may be served.")
+        self.datasets = {name: self.h5f[name] for name in DATASETS}
+        self.num_patches = len(self.datasets["data"])
+
+        # Blocks are whole chunks, so that no chunk is decompressed twice for one block
+        chunks = self.datasets["data"].chunks
+        chunk_rows = chunks[0] if chunks is not None else 1
+        self.block_rows = -(-block_rows // chunk_rows) * chunk_rows
+        num_blocks = max(1, -(-self.num_patches // self.block_rows))
+
+        fields, size = [], 0
+        for name, dataset in self.datasets.items():
+            fields.append((name, dataset.dtype.str, dataset.shape[1:], size))
+            size += self.block_rows * dataset.dtype.itemsize * int(np.prod(dataset.shape[1:], dtype=np.int64))
+            size = -(-size // ALIGNMENT) * ALIGNMENT
+        num_slots = min(int(max_memory // size), num_blocks)
+        if num_slots < 1:
+            raise ValueError(f"max_memory of {max_memory} bytes cannot hold one block of {self.block_rows} rows, "
+                             f"which takes {size} bytes.")
+
+        self.shared_memory = shared_memory.SharedMemory(create=True, size=size * num_slots)
+        self.layout = {
+            "shared_memory": self.shared_memory.name,
+            "num_slots": num_slots,
+            "block_rows": self.block_rows,
+            "num_patches": self.num_patches,
+            # Each dataset's slots are together, at num_slots times its offset within one slot
+            "fields": [(name, dtype, shape, offset * num_slots) for name, dtype, shape, offset in fields],
+        }
+        self.slots = slot_arrays(self.shared_memory.buf, self.layout)
+        self.window = window or max(1, num_slots // 2)
+
+        # The block in each slot, -1 if none, and the slot of each block held
+        self.slot_block = np.full(num_slots, -1, dtype=np.int64)
+        self.block_slot = {}
+        self.slot_refs = np.zeros(num_slots, dtype=np.int64)
+        self.slot_used = np.zeros(num_slots, dtype=np.int64)
+        self.loading = np.zeros(num_slots, dtype=bool)
+        self.uses = 0
+        self.condition = threading.Condition()
+
+        self.listener = Listener(address)
+        self.address = self.listener.address
+        self.closed = False
+
+    def serve_forever(self):
+        '''Accepts clients, serving each from its own thread, until the listener is closed'''
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                if self.closed:
+                    return
+                continue
+            threading.Thread(target=self._serve, args=(connection,), name="PatchServer", daemon=True).start()
+
+    def _serve(self, connection):
+        held = None
+        try:
+            _, seed, batch_size = connection.recv()
+            if batch_size < 1 or batch_size > self.block_rows:
+                connection.send({"error": f"The batch size must be between 1 and {self.block_rows}, not {batch_size}."})
+                return
+            batches = batch_sequence(self.num_patches, self.block_rows, self.window, batch_size, seed)
+            connection.send(self.layout)
+
+            while connection.recv() == "next":
+                # The last batch is released before the next is read, so a client holds one slot at most
+                if held is not None:
+                    self._release(held)
+                    held = None
+                block, start, stop = next(batches)
+                held = self._acquire(block)
+                connection.send((held, start, stop, block * self.block_rows + start))
+        except (EOFError, OSError):
+            # The client exited or died
+            pass
+        finally:
+            if held is not None:
+                self._release(held)
+            connection.close()
+
+    def _acquire(self, block):
+        # Gets the slot of a block, reading it into the least recently used free slot if it is not held
+        with self.condition:
+            while True:
+                slot = self.block_slot.get(block)
+                if slot is not None:
+                    self.slot_refs[slot] += 1
+                    while self.loading[slot]:
+                        self.condition.wait()
+                    if self.slot_block[slot] == block:
+                        self.uses += 1
+                        self.slot_used[slot] = self.uses
+                        return slot
+                    # Reading it failed
+                    self.slot_refs[slot] -= 1
+                    continue
+                free = np.flatnonzero(self.slot_refs == 0)
+                if len(free) > 0:
+                    break
+                # Every slot is held by a client, until one asks for its next batch
+                self.condition.wait()
+
+            slot = int(free[np.argmin(self.slot_used[free])])
+            self.block_slot.pop(int(self.slot_block[slot]), None)
+            self.slot_block[slot] = block
+            self.block_slot[block] = slot
+            self.slot_refs[slot] = 1
+            self.loading[slot] = True
+
+        # Read outside of the lock, so that clients of other slots are served meanwhile
+        try:
+            start = block * self.block_rows
+            count = min(self.block_rows, self.num_patches - start)
+            for name, dataset in self.datasets.items():
+                dataset.read_direct(self.slots[name][slot], np.s_[start:start + count], np.s_[0:count])
+        except BaseException:
+            with self.condition:
+                del self.block_slot[block]
+                self.slot_block[slot] = -1
+                self.slot_refs[slot] -= 1
+                self.loading[slot] = False
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            self.uses += 1
+            self.slot_used[slot] = self.uses
+            self.loading[slot] = False
+            self.condition.notify_all()
+        return slot
+
+    def _release(self, slot):
+        with self.condition:
+            self.slot_refs[slot] -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        '''Stops listening and frees the shared memory. Clients still connected then fail'''
+        self.closed = True
+        self.listener.close()
+        self.slots = None
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+        self.h5f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _attach(name):
+    # Before Python 3.13, attaching registers the shared memory with this process's resource
+    # tracker, which would then free it, for every process, once this one exits
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        memory = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+
+class PatchClient:
+    def __init__(self, address, batch_size = 64, seed = None):
+        '''
+        Gets batches of patches from a PatchServer.
+
+        :param address: the address of the server
+        :param batch_size: the most patches of each batch. Batches at the end of a block are smaller
+        :param seed: the seed of the order of the batches, as for batch_sequence
+        '''
+        self.connection = Client(address)
+        self.connection.send(("hello", seed, batch_size))
+        self.layout = self.connection.recv()
+        if "error" in self.layout:
+            self.connection.close()
+            raise ValueError(self.layout["error"])
+        self.num_patches = self.layout["num_patches"]
+        self.shared_memory = _attach(self.layout["shared_memory"])
+        self.slots = slot_arrays(self.shared_memory.buf, self.layout)
+        self.rows = range(0)
+
+    def __len__(self):
+        return self.num_patches
+
+    def __iter__(self):
+        while True:
+            yield self.next_batch()
+
+    def next_batch(self):
+        '''
+        Gets the next batch. Its arrays are views into the shared memory, and are only valid
+        until next_batch is called again. The rows of the file that it holds are then in rows.
+
+        :returns: the patches of the batch as a tuple: (data, label, positive_flag)
+        '''
+        self.connection.send("next")
+        slot, start, stop, first_row = self.connection.recv()
+        self.rows = range(first_row, first_row + stop - start)
+        return tuple(self.slots[name][slot, start:stop] for name in DATASETS)
+
+    def close(self):
+        '''Releases the last batch. Every view of a batch must be deleted first'''
+        try:
+            self.connection.send("close")
+        except OSError:
+            pass
+        self.connection.close()
+        self.slots = None
+        self.shared_memory.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the patches of an HDF5 file to training processes on this machine through shared memory')
+    parser.add_argument('input_hdf5', type=str, help='an hdf5 file written by generate_hdf5.py in the patches layout, preferably shuffled by randomize_hdf5.py')
+    parser.add_argument('--address', type=str, default=None, help='the socket file, or on Windows the named pipe, on which to listen. Chosen and printed if not given')
+    parser.add_argument('--max_memory', type=float, default=1, help='GB, the size of the shared memory into which patches are read')
+    parser.add_argument('--block_rows', type=int, default=1024, help='the number of patches read at once into the shared memory. Also the largest batch a client may ask for')
+    parser.add_argument('--window', type=int, default=None, help='the number of blocks whose batches are shuffled together for each client. Defaults to half of those that fit in memory')
+    config = parser.parse_args()
+
+    with PatchServer(config.input_hdf5, address=config.address, max_memory=config.max_memory * 1e9,
+                     block_rows=config.block_rows, window=config.window) as server:
+        print(f'Serving {server.num_patches} patches on {server.address} from {server.layout["num_slots"]} blocks of {server.block_rows} in memory')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import argparse
+
+import h5py
+import numpy as np
+
+# One row per patch, in the order of the patches
+PROVENANCE_DTYPE = np.dtype([
+    ("recording", "i4"),       # index of the recording in the provenance's wav_files attribute
+    ("start_time", "f8"),      # ms
+    ("end_time", "f8"),        # ms
+    ("start_freq", "f8"),      # Hz
+    ("end_freq", "f8"),        # Hz
+    ("positive_pixels", "i4"), # number of label pixels above 0
+])
+
+# The columns with a sorted index, i.e. those that may be queried without a scan
+INDEXED_COLUMNS = ("recording", "start_time", "start_freq")
+
+
+def provenance_rows(recording, patches, label = None):
+    '''
+    Gets the provenance of a block of patches of one recording.
+
+    :param recording: the index of the recording
+    :param patches: the (start_freq, end_freq, start_time, end_time) of each patch
+    :param label: the label of each patch, of shape (patches, rows, columns). If None,
+                  positive_pixels is left as 0
+
+    :returns: an array of PROVENANCE_DTYPE with one row per patch
+    '''
+    rows = np.zeros(len(patches), dtype=PROVENANCE_DTYPE)
+    rows["recording"] = recording
+    if len(patches) > 0:
+        patches = np.asarray(patches, dtype=np.float64)
+        rows["start_freq"], rows["end_freq"] = patches[:, 0], patches[:, 1]
+        rows["start_time"], rows["end_time"] = patches[:, 2], patches[:, 3]
+        if label is not None:
+            rows["positive_pixels"] = (np.asarray(label) > 0).reshape(len(patches), -1).sum(axis=1)
+    return rows
+
+
+def write_provenance(h5f, table, wav_files, compression = "gzip"):
+    '''
+    Writes the provenance table as the dataset provenance, with the name of each recording
+    in its wav_files attribute, and then its index with write_provenance_index.
+
+    :param h5f: the open HDF5 file
+    :param table: an array of PROVENANCE_DTYPE with one row per patch
+    :param wav_files: the name of each recording, indexed by the recording column
+    :param compression: the compression of the table, or None
+    '''
+    dataset = h5f.create_dataset('provenance', data=table, compression=compression)
+    dataset.attrs["wav_files"] = [str(name) for name in wav_files]
+    write_provenance_index(h5f)
+
+
+def write_provenance_index(h5f):
+    '''
+    Writes, for each of INDEXED_COLUMNS, the rows of the provenance table sorted by that
+    column and the sorted values, as <column>_order and <column>_sorted in the group
+    provenance_index. Any existing index is replaced, so this must be called again
+    whenever the patches are reordered or subset.
+    '''
+    if 'provenance_index' in h5f:
+        del h5f['provenance_index']
+    table = h5f['provenance'][:]
+    group = h5f.create_group('provenance_index')
+    for column in INDEXED_COLUMNS:
+        order = np.argsort(table[column], kind="stable")
+        group.create_dataset(f'{column}_order', data=order.astype(np.int64))
+        group.create_dataset(f'{column}_sorted', data=table[column][order])
+
+    # Bounds how far before a query's start a matching patch may begin
+    group.attrs["max_duration"] = float((table["end_time"] - table["start_time"]).max(initial=0))
+    group.attrs["max_bandwidth"] = float((table["end_freq"] - table["start_freq"]).max(initial=0))
+
+
+def row_ranges(rows):
+    '''
+    Merges rows into ranges of consecutive rows.
+
+    :param rows: sorted row numbers
+    :returns: a list of (start, stop) ranges, with stop exclusive
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = rows[np.concatenate(([0], breaks))]
+    stops = rows[np.concatenate((breaks - 1, [len(rows) - 1]))] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+# Once a binary search of a sorted column narrows to this many values, they are read at once
+SEARCH_BLOCK = 4096
+
+
+def _search_sorted(values, value):
+    # The first position of the sorted dataset values holding at least value. Only the values
+    # visited by a binary search are read, not the whole column
+    low, high = 0, len(values)
+    while high - low > SEARCH_BLOCK:
+        middle = (low + high) // 2
+        if values[middle] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low + int(np.searchsorted(values[low:high], value, side="left"))
+
+
+def _rows_between(group, column, low, high):
+    # The rows whose value of column lies in [low, high), from the sorted index
+    values = group[f'{column}_sorted']
+    first = _search_sorted(values, low)
+    last = max(first, _search_sorted(values, high))
+    return group[f'{column}_order'][first:last]
+
+
+def query_rows(h5f, recording = None, time_range = None, freq_range = None):
+    '''
+    Finds the patches matching every given predicate using only the provenance table and
+    its index, without reading the data or label datasets.
+
+    :param h5f: the open HDF5 file
+    :param recording: the index or wav file name of a recording
+    :param time_range: ms, a (start, end) range that a patch must overlap
+    :param freq_range: Hz, a (start, end) range that a patch must overlap
+
+    :returns: the matching rows as a list of (start, stop) ranges, with stop exclusive
+    '''
+    group = h5f['provenance_index']
+    table = h5f['provenance']
+    rows = None
+
+    if recording is not None:
+        if isinstance(recording, str):
+            wav_files = list(table.attrs["wav_files"])
+            if recording not in wav_files:
+                return []
+            recording = wav_files.index(recording)
+        rows = _rows_between(group, "recording", recording, recording + 1)
+
+    # A patch overlaps (start, end) if it begins before end and ends after start.
+    # The index narrows the candidates to those beginning within the longest patch of start
+    for column, end_column, bound, value_range in (("start_time", "end_time", "max_duration", time_range),
+                                                   ("start_freq", "end_freq", "max_bandwidth", freq_range)):
+        if value_range is None:
+            continue
+        start, end = value_range
+        candidates = np.sort(_rows_between(group, column, start - group.attrs[bound], end))
+        if len(candidates) > 0:
+            candidates = candidates[table.fields(end_column)[candidates] > start]
+        rows = candidates if rows is None else np.intersect1d(rows, candidates, assume_unique=True)
+
+    if rows is None:
+        rows = np.arange(len(table))
+    return row_ranges(np.sort(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List the row ranges of the patches of an HDF5 file matching the given predicates')
+    parser.add_argument('input_hdf5', type=str, help='an hdf5 file written by generate_hdf5.py')
+    parser.add_argument('--recording', type=str, default=None, help='the index or wav file name of a recording')
+    parser.add_argument('--time_range', type=float, nargs=2, default=None, help='ms, the start and end of a time range that patches must overlap')
+    parser.add_argument('--freq_range', type=float, nargs=2, default=None, help='Hz, the start and end of a frequency range that patches must overlap')
+    config = parser.parse_args()
+
+    recording = config.recording
+    if recording is not None and recording.isdigit():
+        recording = int(recording)
+
+    with h5py.File(config.input_hdf5, 'r') as h5f:
+        ranges = query_rows(h5f, recording=recording, time_range=config.time_range, freq_range=config.freq_range)
+    for start, stop in ranges:
+        print(start, stop)
+    print(f'{sum(stop - start for start, stop in ranges)} patches in {len(ranges)} ranges')
+
+if __name__ == "__main__":
+    main()
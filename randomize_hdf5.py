@@ -1,20 +1,104 @@
+import os
 import argparse
 import random
 import h5py
+import numpy as np
+from hdf5_writer import patch_dataset_options, compression_executor, RowWriter
+from provenance import write_provenance_index, PROVENANCE_DTYPE
+import memory_budget
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('input_hdf5', type=str, help='The hdf5 file to be shuffled')
+    parser.add_argument('--output_file', type=str, default=None, help='If given, a shuffled copy is written here and the input is left unchanged. Otherwise, the input is shuffled in place')
+    parser.add_argument('--seed', type=int, default=None, help='the seed of the shuffle. Random if not given')
+    parser.add_argument('--block_size', type=int, default=1024, help='How many examples may be held in memory at one time while writing a shuffled copy. Chosen by --max_memory if given')
+    parser.add_argument('--compression_threads', type=int, default=None, help='the number of threads compressing the shuffled copy. Defaults to one per CPU. 0 compresses it in the main thread')
+    parser.add_argument('--contiguous', action='store_true', help='store the shuffled copy uncompressed and contiguously, so that memmap_dataset.py can map it with no copies')
+    memory_budget.add_memory_arguments(parser)
     config = parser.parse_args()
-    
-    h5file = h5py.File(config.input_hdf5, "r+")
 
-    seed = random.randrange(1,1e10)
-    for dataset in h5file:
-        random.seed(seed)
-        random.shuffle(h5file[dataset])
+    if config.max_memory is not None and config.output_file is None:
+        # The in-place shuffle swaps two patches at a time, so there is nothing to size
+        parser.error('--max_memory only applies with --output_file')
 
-    h5file.close()
+    # Strip layout files hold whole recordings rather than one row per patch
+    with h5py.File(config.input_hdf5, "r") as h5file:
+        if h5file.attrs.get("layout") == "strips" or 'data' not in h5file:
+            parser.error(f'{config.input_hdf5} has no data dataset. Only files in the patches layout may be shuffled')
+
+    seed = config.seed if config.seed is not None else random.randrange(1,1e10)
+
+    if config.output_file is None:
+        h5file = h5py.File(config.input_hdf5, "r+")
+
+        # Only datasets with one entry per patch are shuffled, not e.g. the statistics group
+        num_patches = len(h5file['data'])
+        for dataset in h5file:
+            if isinstance(h5file[dataset], h5py.Dataset) and len(h5file[dataset]) == num_patches:
+                random.seed(seed)
+                random.shuffle(h5file[dataset])
+        if 'provenance' in h5file:
+            write_provenance_index(h5file)
+
+        h5file.close()
+        return
+
+    input_file = h5py.File(config.input_hdf5, "r")
+    output_file = h5py.File(config.output_file, "w")
+
+    num_patches = len(input_file['data'])
+    executor = compression_executor(config.compression_threads)
+    permutation = np.random.default_rng(seed).permutation(num_patches)
+
+    # With a memory budget, the block size is chosen to fit it
+    block_size = config.block_size
+    max_pending = 8
+    if config.max_memory is not None:
+        # Each row is read in sorted order and then reordered into the block
+        row_bytes = 2 * max(value.dtype.itemsize * int(np.prod(value.shape[1:], dtype=np.int64))
+                            for value in input_file.values() if isinstance(value, h5py.Dataset) and len(value) == num_patches)
+        # The permutation, and the provenance table with the sorted indices rebuilt from it
+        fixed = num_patches * (8 + ('provenance' in input_file) * (PROVENANCE_DTYPE.itemsize + 4 * 8))
+        threads = config.compression_threads if config.compression_threads is not None else os.cpu_count()
+        try:
+            block_size, max_pending = memory_budget.plan_rows(config.max_memory * 1e9, row_bytes, fixed=fixed,
+                                                              compressed_datasets=0 if config.contiguous else 1, threads=threads)
+        except ValueError as ex:
+            parser.error(str(ex))
+        print(f'Memory: blocks of {block_size} patches')
+    for name, value in input_file.items():
+        if name == 'provenance_index':
+            # Rebuilt once the provenance is shuffled
+            continue
+        if not isinstance(value, h5py.Dataset) or len(value) != num_patches:
+            # Kept as is, e.g. the statistics, which do not depend on the order of the patches
+            input_file.copy(value, output_file, name=name)
+            continue
+
+        output = output_file.create_dataset(name, shape=value.shape, dtype=value.dtype,
+                                            **patch_dataset_options(value.shape[1:], contiguous=config.contiguous, itemsize=value.dtype.itemsize))
+        # Chunks are compressed in parallel and written in order
+        writer = RowWriter(output, executor=executor, max_pending=max_pending)
+        for block_start in range(0, num_patches, block_size):
+            # h5py reads increasing indices, so each block is read sorted and reordered in memory
+            indices = permutation[block_start:block_start + block_size]
+            order = np.argsort(indices)
+            block = np.empty((len(indices),) + value.shape[1:], dtype=value.dtype)
+            block[order] = value[indices[order]]
+            writer.write(block, block_start)
+        writer.finish()
+        for attribute, attribute_value in value.attrs.items():
+            output.attrs[attribute] = attribute_value
+    if executor is not None:
+        executor.shutdown()
+    for name, value in input_file.attrs.items():
+        output_file.attrs[name] = value
+    if 'provenance' in output_file:
+        write_provenance_index(output_file)
+
+    input_file.close()
+    output_file.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,281 @@
+import os
+import json
+import math
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import wavio
+
+from silbidopy.render import getMagnitudeSpectra
+
+CACHE_VERSION = 1
+
+# Frames transformed at once while filling a cache entry. Bounds the memory used
+BLOCK_FRAMES = 4096
+
+
+class SpectrogramCache:
+    def __init__(self, cache_dir, max_bytes = 50 * 1024 ** 3, dtype = "float32", max_open = 8):
+        '''
+        An on-disk cache of the full-band, unnormalized log10 magnitude spectrogram of each
+        audio file. Entries depend only on the audio file and on frame_time_span and
+        step_time_span, so they are reused for any frequency band, patch size, clipping and
+        normalization, across runs and tools.
+
+        Entries are keyed by a hash of the file's path, size and modification time and of
+        the spectrogram parameters. Each is a .npy file of shape (frames, bins), read through
+        a memory map, with a .json file of metadata beside it. Once the entries exceed
+        max_bytes, the least recently used are deleted.
+
+        Frame k of an entry starts at sample round(k * step_time_span / 1000 * rate), on one grid
+        for the whole file. getSpectrogram instead spreads the frames of each request evenly
+        between the samples that its start and end times truncate to, so slices of an entry
+        are close to, but not the same as, its spectrograms: some are framed a whole frame
+        apart, and others a few samples apart. MemorySpectrogramCache reproduces them exactly.
+
+        :param cache_dir: the directory holding the entries, preferably on a local disk
+        :param max_bytes: the most bytes the entries may take up
+        :param dtype: "float32" or "float16". float16 halves the size of the cache at a
+                      precision of about 1e-3 in the log magnitude
+        :param max_open: the number of memory maps kept open for reuse
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.max_open = max_open
+        self.open_entries = OrderedDict()
+        self.keyed_file = None
+        self.keys = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, filename, frame_time_span, step_time_span):
+        '''
+        Returns the name of the entry for an audio file and spectrogram parameters. The keys of
+        the last file requested are kept, so that the file is examined only once while its
+        patches are sliced, and again once it is requested after another file.
+        '''
+        if filename != self.keyed_file:
+            self.keyed_file = filename
+            self.keys = {}
+        if (frame_time_span, step_time_span) not in self.keys:
+            stat = os.stat(filename)
+            identity = json.dumps([CACHE_VERSION, os.path.realpath(filename), stat.st_size, stat.st_mtime_ns,
+                                   frame_time_span, step_time_span, self.dtype.str])
+            self.keys[(frame_time_span, step_time_span)] = hashlib.sha256(identity.encode('utf-8')).hexdigest()
+        return self.keys[(frame_time_span, step_time_span)]
+
+    def get(self, filename, frame_time_span = 8, step_time_span = 2, wav = None):
+        '''
+        Gets the spectrogram of an audio file, computing and storing it if it is not cached.
+
+        :param filename: the audio file in .wav format
+        :param frame_time_span: ms, length of time for one time window for dft
+        :param step_time_span: ms, length of time step for spectrogram
+        :param wav: the wavio.Wav of filename, if already read. Only used on a cache miss
+
+        :returns: A tuple with a read-only array of shape (frames, bins) holding the log10
+                  magnitude spectrum of each frame, and a dictionary with the "rate",
+                  "nframes", "frame_sample_span" and "step_sample_span" of the audio file:
+                  (spectrogram, metadata)
+        '''
+        key = self.key(filename, frame_time_span, step_time_span)
+        if key in self.open_entries:
+            self.open_entries.move_to_end(key)
+            return self.open_entries[key]
+
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.exists(path + '.npy'):
+            self._store(path, wav if wav is not None else wavio.read(filename), frame_time_span, step_time_span)
+            self._evict(keep=key)
+
+        # Mark the entry as recently used
+        os.utime(path + '.npy')
+        with open(path + '.json') as file:
+            metadata = json.load(file)
+        entry = (np.load(path + '.npy', mmap_mode='r'), metadata)
+
+        self.open_entries[key] = entry
+        if len(self.open_entries) > self.max_open:
+            self.open_entries.popitem(last=False)
+        return entry
+
+    def contains(self, filename, frame_time_span = 8, step_time_span = 2):
+        '''Whether the spectrogram of an audio file is cached'''
+        key = self.key(filename, frame_time_span, step_time_span)
+        return key in self.open_entries or os.path.exists(os.path.join(self.cache_dir, key + '.npy'))
+
+    def getLogMagnitudes(self, filename, frame_time_span = 8, step_time_span = 2, start_time = 0, end_time = -1,
+                         clip_bottom = 0, clip_top = None):
+        '''
+        Slices the frames and bins of a spectrogram from the cached spectrogram of its audio file.
+        The number of frames is that getSpectrogram computes, but each starts where the frame of
+        the whole file does, which differs from getSpectrogram where a start time falls between samples.
+
+        :param filename: the audio file in .wav format
+        :param frame_time_span: ms, length of time for one time window for dft
+        :param step_time_span: ms, length of time step for spectrogram
+        :param start_time: ms, the beginning of the spectrogram
+        :param end_time: ms, the end of the spectrogram
+        :param clip_bottom: the lowest bin kept
+        :param clip_top: one above the highest bin kept, or None for every bin
+
+        :returns: an array of shape (bins, frames) of log10 magnitudes, lowest bin first
+        '''
+        stft, metadata = self.get(filename, frame_time_span=frame_time_span, step_time_span=step_time_span)
+        rate = metadata["rate"]
+
+        # The same frames as getSpectrogram would split the audio into
+        start_frame = int(start_time / 1000 * rate)
+        end_frame = min(metadata["nframes"], int((end_time / 1000 + frame_time_span / 1000 - step_time_span / 1000)* rate))
+        signal_span = end_frame - start_frame
+        if signal_span < metadata["frame_sample_span"]:
+            num_frames = 0
+        else:
+            num_frames = 1 + round((signal_span - metadata["frame_sample_span"]) / metadata["step_sample_span"])
+        first_frame = int(round(start_time / step_time_span))
+
+        return np.asarray(stft[first_frame:first_frame + num_frames, clip_bottom:clip_top], dtype=np.float64).T
+
+    def _store(self, path, wav, frame_time_span, step_time_span):
+        # Written under a temporary name, so that other processes never see a partial entry
+        temporary = f'{path}.{os.getpid()}.tmp.npy'
+        shape, metadata = spectrogramShape(wav, frame_time_span, step_time_span)
+        spectrogram = np.lib.format.open_memmap(temporary, mode='w+', dtype=self.dtype, shape=shape)
+        computeSpectrogram(wav, frame_time_span, step_time_span, spectrogram)
+        spectrogram.flush()
+        del spectrogram
+
+        with open(f'{path}.{os.getpid()}.tmp.json', 'w') as file:
+            json.dump(metadata, file)
+        os.replace(f'{path}.{os.getpid()}.tmp.json', path + '.json')
+        os.replace(temporary, path + '.npy')
+
+    def _evict(self, keep):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy') and '.tmp' not in name:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name[:-len('.npy')]))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for extension in ('.npy', '.json'):
+                try:
+                    os.remove(os.path.join(self.cache_dir, key + extension))
+                except FileNotFoundError:
+                    # Another process evicted it first
+                    pass
+            self.open_entries.pop(key, None)
+            total -= size
+
+
+class MemorySpectrogramCache:
+    def __init__(self, max_bytes = 10 ** 9, min_freq = 0, max_freq = None):
+        '''
+        Holds in memory the magnitude spectra of the time spans requested from the one audio
+        file given to load, so that patches of the same span, e.g. those of every row of patches
+        and of every configuration with the same frame_time_span and step_time_span, compute
+        their frames only once. Each span is split into frames and transformed exactly as
+        getSpectrogram does for it, so the spectrograms are identical to getSpectrogram's.
+
+        Spans are kept until they take up max_bytes. Those requested after that are computed
+        again each time, so memory stays bounded however long the audio file is.
+
+        :param max_bytes: the most bytes of spectra held
+        :param min_freq: Hz, the lowest frequency that will be requested. Lower bins are not kept
+        :param max_freq: Hz, the highest frequency that will be requested, or None for all.
+                         Higher bins are not kept
+        '''
+        self.max_bytes = max_bytes
+        self.min_freq = min_freq
+        self.max_freq = max_freq
+        self.filename = None
+        self.wav = None
+        self.entries = {}
+        self.bytes = 0
+
+    def load(self, filename, wav):
+        '''
+        Makes filename the audio file whose spectra are held, dropping those of the last.
+
+        :param filename: the audio file in .wav format
+        :param wav: the wavio.Wav of filename, or its memory_budget.AudioWindows. Spectra are
+                    computed when first requested
+        '''
+        self.filename = filename
+        self.wav = wav
+        self.entries = {}
+        self.bytes = 0
+
+    def getLogMagnitudes(self, filename, frame_time_span = 8, step_time_span = 2, start_time = 0, end_time = -1,
+                         clip_bottom = 0, clip_top = None):
+        '''As for SpectrogramCache.getLogMagnitudes, but filename must be the file last loaded'''
+        if filename != self.filename:
+            raise ValueError(f"{filename} is not the audio file loaded in the cache.")
+        key = (frame_time_span, step_time_span, start_time, end_time)
+        entry = self.entries.get(key)
+        if entry is None:
+            wav = self.wav
+            if hasattr(wav, "get"):
+                wav = wav.get(start_time, end_time, frame_time_span, step_time_span)
+            magnitudes = getMagnitudeSpectra(wav, frame_time_span=frame_time_span, step_time_span=step_time_span,
+                                             start_time=start_time, end_time=end_time)
+            # Only the bins between min_freq and max_freq are kept, as getSpectrogram clips them
+            first_bin = int(self.min_freq // (1000 / frame_time_span))
+            last_bin = magnitudes.shape[1] if self.max_freq is None else int(self.max_freq // (1000 / frame_time_span))
+            entry = (np.ascontiguousarray(magnitudes[:, first_bin:last_bin]), first_bin, last_bin)
+            if self.bytes + entry[0].nbytes <= self.max_bytes:
+                self.entries[key] = entry
+                self.bytes += entry[0].nbytes
+
+        # Bins past the last of the dft are left out, as getSpectrogram leaves them out
+        magnitudes, first_bin, last_bin = entry
+        if clip_top is None:
+            clip_top = first_bin + magnitudes.shape[1]
+        if clip_bottom < first_bin or clip_top > last_bin:
+            raise ValueError(f"Bins {clip_bottom} to {clip_top} are not all held by the cache.")
+        return np.log10(magnitudes.T[clip_bottom - first_bin:clip_top - first_bin])
+
+
+def spectrogramShape(wav, frame_time_span = 8, step_time_span = 2):
+    '''
+    Gets the shape of the spectrogram of a whole audio file, as computed by computeSpectrogram.
+
+    :returns: A tuple with the shape, (frames, bins), and a dictionary with the "rate",
+              "nframes", "frame_sample_span" and "step_sample_span" of the audio file:
+              (shape, metadata)
+    '''
+    nframes = len(wav.data)
+    frame_sample_span = int(math.floor(frame_time_span / 1000 * wav.rate))
+    step_sample_span = step_time_span / 1000 * wav.rate
+    num_frames = 0
+    if nframes >= frame_sample_span:
+        num_frames = int(math.floor((nframes - frame_sample_span) / step_sample_span)) + 1
+    metadata = {"rate": wav.rate, "nframes": nframes, "frame_sample_span": frame_sample_span,
+                "step_sample_span": step_sample_span}
+    return (num_frames, frame_sample_span // 2 + 1), metadata
+
+
+def computeSpectrogram(wav, frame_time_span, step_time_span, out):
+    '''
+    Computes the log10 magnitude spectrum of every frame of a whole audio file into out,
+    a few thousand frames at a time. Frame k starts at sample round(k * step_time_span / 1000 * rate).
+
+    :param wav: the wavio.Wav of the audio file
+    :param frame_time_span: ms, length of time for one time window for dft
+    :param step_time_span: ms, length of time step for spectrogram
+    :param out: an array of shape (frames, bins) from spectrogramShape
+    '''
+    signal = wav.data.ravel()
+    frame_sample_span = int(math.floor(frame_time_span / 1000 * wav.rate))
+    step_sample_span = step_time_span / 1000 * wav.rate
+    for first in range(0, len(out), BLOCK_FRAMES):
+        starts = np.round(np.arange(first, min(len(out), first + BLOCK_FRAMES)) * step_sample_span).astype(int)
+        starts = np.minimum(starts, len(signal) - frame_sample_span)
+        frames = signal[starts[:, np.newaxis] + np.arange(frame_sample_span)]
+        out[first:first + len(starts)] = np.log10(np.absolute(np.fft.rfft(frames, frame_sample_span)))
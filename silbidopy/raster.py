@@ -0,0 +1,285 @@
+import math
+
+import numpy as np
+from silbidopy.render import getAnnotationMask, drawAnnotation, drawSegment
+
+# Points of the raster this close, in pixels, to where rounding changes are not trusted to
+# round as they would in a mask's own coordinates. Their segments are drawn for each mask
+TOLERANCE = 1e-6
+
+
+class AnnotationRaster:
+    def __init__(self, annotations, frame_time_span = 8, step_time_span = 2, min_freq = 5000):
+        '''
+        Rasterizes annotations once over the time-frequency grid of a whole recording, so that
+        the mask of any patch is sliced from it rather than drawn again. The masks are the same,
+        pixel for pixel, as those from getAnnotationMask, including where getAnnotationMask
+        clips annotations at the edges of the patch.
+
+        The raster holds, sorted by column, the pixels of the line between each pair of
+        consecutive nodes, with rows counted down from min_freq. Lines that getAnnotationMask
+        draws differently depending on the patch are instead drawn for each mask: those
+        whose ends lie outside of the patch, the lines of annotations that go back in time,
+        and the few whose points lie too close to a rounding boundary to be shifted exactly.
+
+        :param annotations: The two dimensional array with contours on the first axis and with
+                            (time_s,freq_hz) nodes on the second axis. As returned from
+                            tonalReader.getTimeFrequencyContours().
+        :param frame_time_span: ms, length of time for one time window for dft
+        :param step_time_span: ms, length of time step for spectrogram
+        :param min_freq: Hz, the frequency from which rows are counted. Masks may have any
+                         frequency range whose max_freq lies a whole number of rows from it
+        '''
+        self.annotations = annotations
+        self.frame_time_span = frame_time_span
+        self.step_time_span = step_time_span
+        self.min_freq = min_freq
+        self.freq_resolution = 1000 / frame_time_span
+
+        self.first_times = np.array([a[0][0] for a in annotations], dtype=np.float64)
+        self.last_times = np.array([a[-1][0] for a in annotations], dtype=np.float64)
+        self.times = [np.array([node[0] for node in a], dtype=np.float64) for a in annotations]
+        self.freqs = [np.array([node[1] for node in a], dtype=np.float64) for a in annotations]
+
+        # Annotations that go back in time are always drawn for each mask
+        self.monotonic = np.array([np.all(np.diff(t) >= 0) for t in self.times], dtype=bool)
+
+        # Segment first_segment[i] + j - 1 joins nodes j - 1 and j of annotation i
+        lengths = np.array([max(0, len(t) - 1) for t in self.times], dtype=np.int64)
+        self.first_segment = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        num_segments = int(lengths.sum())
+
+        if num_segments > 0:
+            times = np.concatenate(self.times)
+            freqs = np.concatenate(self.freqs)
+            # The index within times and freqs of the second node of each segment
+            node_offsets = np.concatenate(([0], np.cumsum([len(t) for t in self.times])[:-1]))
+            ends = np.concatenate([offset + np.arange(1, len(t)) for offset, t in zip(node_offsets, self.times) if len(t) > 1])
+            time_frames = times * 1000 / step_time_span
+            freq_frames = (min_freq - freqs) / self.freq_resolution
+            columns, rows, segments, self.ambiguous = self._rasterize(
+                time_frames[ends - 1], freq_frames[ends - 1], time_frames[ends], freq_frames[ends])
+        else:
+            columns = rows = segments = np.zeros(0, dtype=np.int64)
+            self.ambiguous = np.zeros(0, dtype=bool)
+
+        # Lines of annotations that go back in time are not rastered
+        segment_annotation = np.repeat(np.arange(len(annotations)), lengths)
+        keep = self.monotonic[segment_annotation[segments]] if len(segments) > 0 else np.zeros(0, dtype=bool)
+        order = np.argsort(columns[keep], kind="stable")
+        self.columns = columns[keep][order]
+        self.rows = rows[keep][order]
+        self.segments = segments[keep][order]
+        self.allowed = np.zeros(num_segments, dtype=bool)
+
+        # The pixels of the lines left out of the raster, drawn once for getStripMask when first needed
+        self.segment_annotation = segment_annotation
+        self.extra_columns = None
+        self.extra_rows = None
+
+    @staticmethod
+    def _rasterize(prev_time_frame, prev_freq_frame, time_frame, freq_frame):
+        # Draws every segment as drawSegment would, but in the coordinates of the whole recording
+        time_delta = time_frame - prev_time_frame
+        distance = np.sqrt(time_delta**2 + (freq_frame - prev_freq_frame)**2)
+
+        # Whether a mask would take the vertical branch of drawSegment, or draw a different number
+        # of points, may depend on rounding, so such segments are drawn for each mask
+        ambiguous = (time_delta < TOLERANCE) | (np.abs(distance - np.round(distance)) < TOLERANCE)
+        num_points = np.where(ambiguous, 0, np.ceil(distance).astype(np.int64) + 1)
+
+        # The points of np.linspace(prev_time_frame, time_frame, num_points) for every segment
+        segments = np.repeat(np.arange(len(num_points)), num_points)
+        index = np.arange(len(segments)) - np.repeat(np.cumsum(num_points) - num_points, num_points)
+        divisor = np.maximum(num_points - 1, 1)[segments]
+        t = index * (time_delta[segments] / divisor) + prev_time_frame[segments]
+        t = np.where(index == num_points[segments] - 1, time_frame[segments], t)
+        slope = (prev_freq_frame - freq_frame) / np.where(ambiguous, 1, prev_time_frame - time_frame)
+        f = freq_frame[segments] + slope[segments] * (t - time_frame[segments])
+
+        # Points close to halfway between pixels may round the other way in a mask's coordinates
+        near_half = ((np.abs(t - np.floor(t) - 0.5) < TOLERANCE) |
+                     (np.abs(f - np.floor(f) - 0.5) < TOLERANCE * (1 + np.abs(slope[segments]))))
+        ambiguous[segments[near_half]] = True
+
+        keep = ~ambiguous[segments]
+        return (np.round(t[keep]).astype(np.int64), np.round(f[keep]).astype(np.int64),
+                segments[keep], ambiguous)
+
+    def getAnnotationMask(self, min_freq = 5000, max_freq = 50000, start_time = 0, end_time = -1):
+        '''
+        Gets the same mask as getAnnotationMask with these annotations and parameters.
+
+        :param min_freq: Hz, lower bound of frequency for spectrogram
+        :param max_freq: Hz, upper bound of frequency for spectrogram
+        :param start_time: ms, the beginning of where the audioFile is read
+        :param end_time: ms, the end of where the audioFile is read
+
+        :returns: A tuple with the annotation mask and whether any pixel of it is set: (mask, positive_flag)
+        '''
+        step_time_span = self.step_time_span
+        freq_resolution = self.freq_resolution
+
+        # Get dimensions for mask
+        image_width = int((end_time - start_time) / step_time_span)
+        image_height = int((max_freq - min_freq) * self.frame_time_span/1000)
+        time_span = (end_time - start_time)
+
+        # Masks that do not lie on the grid of the raster are drawn in full
+        column_offset = start_time / step_time_span
+        row_offset = (max_freq - self.min_freq) / freq_resolution
+        if (abs(image_width * step_time_span - time_span) > 1e-9 * max(1, abs(time_span))
+                or abs(column_offset - round(column_offset)) > 1e-9 or abs(row_offset - round(row_offset)) > 1e-9):
+            return getAnnotationMask(self.annotations, frame_time_span=self.frame_time_span, step_time_span=step_time_span,
+                                     min_freq=min_freq, max_freq=max_freq, start_time=start_time, end_time=end_time)
+        column_offset, row_offset = round(column_offset), round(row_offset)
+
+        mask = np.zeros((image_height, image_width))
+
+        # Get only the annotations that will be present in the mask
+        high = np.searchsorted(self.first_times, end_time / 1000, side='left')
+        included = np.flatnonzero((self.last_times[:high] >= start_time / 1000) & (self.first_times[:high] < end_time / 1000))
+        if len(included) == 0:
+            return mask, False
+
+        positive_flag = False
+        allowed = []
+        for i in included:
+            if not self.monotonic[i]:
+                if drawAnnotation(mask, self.annotations[i], start_time, time_span, max_freq, freq_resolution):
+                    positive_flag = True
+                continue
+
+            prev_nodes, nodes, time_frames, freq_frames = self._drawnSegments(i, start_time, time_span, max_freq,
+                                                                              image_width, image_height)
+            # Lines between consecutive nodes are taken from the raster, unless they were left out of it
+            segments = self.first_segment[i] + nodes - 1
+            rastered = (prev_nodes == nodes - 1) & ~self.ambiguous[segments]
+            allowed.append(segments[rastered])
+            for j in np.flatnonzero(~rastered):
+                if drawSegment(mask, time_frames[0][j], freq_frames[0][j], time_frames[1][j], freq_frames[1][j],
+                               self.freqs[i][nodes[j]]):
+                    positive_flag = True
+
+        # The rastered pixels of the lines that getAnnotationMask would draw
+        allowed = np.concatenate(allowed) if allowed else []
+        if len(allowed) > 0:
+            self.allowed[allowed] = True
+            first, last = np.searchsorted(self.columns, [column_offset, column_offset + image_width])
+            columns = self.columns[first:last] - column_offset
+            rows = self.rows[first:last] + row_offset
+            keep = self.allowed[self.segments[first:last]] & (rows >= 0) & (rows < image_height)
+            self.allowed[allowed] = False
+            if keep.any():
+                mask[rows[keep], columns[keep]] = 1
+                positive_flag = True
+
+        return mask, positive_flag
+
+    def getStripMask(self, min_freq = 5000, max_freq = 50000, first_column = 0, last_column = 0):
+        '''
+        Gets columns of the mask of a whole recording, in which the line between every pair of
+        consecutive nodes is drawn as drawSegment would draw it over the whole recording. Unlike
+        the masks of getAnnotationMask, nothing is clipped at the edges of the columns, so the
+        columns are the same however the mask is split into calls. Vertical lines, which
+        drawSegment places at the row of their frequency in Hz, are left out.
+
+        :param min_freq: Hz, lower bound of frequency for spectrogram
+        :param max_freq: Hz, upper bound of frequency for spectrogram. It must lie a whole number
+                         of rows from the min_freq of the raster
+        :param first_column: the first column, i.e. the one that starts at time 0 is column 0
+        :param last_column: one past the last column
+
+        :returns: A tuple with the mask and whether any pixel of it is set: (mask, positive_flag)
+        '''
+        image_height = int((max_freq - min_freq) * self.frame_time_span/1000)
+        row_offset = (max_freq - self.min_freq) / self.freq_resolution
+        if abs(row_offset - round(row_offset)) > 1e-9:
+            raise ValueError(f"max_freq {max_freq} does not lie a whole number of rows from {self.min_freq}.")
+        row_offset = round(row_offset)
+
+        if self.extra_columns is None:
+            self._drawExtraSegments()
+
+        mask = np.zeros((image_height, last_column - first_column))
+        for columns, rows in ((self.columns, self.rows), (self.extra_columns, self.extra_rows)):
+            first, last = np.searchsorted(columns, [first_column, last_column])
+            block_columns = columns[first:last] - first_column
+            block_rows = rows[first:last] + row_offset
+            inside = (block_rows >= 0) & (block_rows < image_height)
+            mask[block_rows[inside], block_columns[inside]] = 1
+        return mask, bool(mask.any())
+
+    def _drawExtraSegments(self):
+        # Draws, in the coordinates of the whole recording, the lines that are not in the raster:
+        # those too close to a rounding boundary and those of annotations that go back in time
+        columns, rows = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        extra = np.flatnonzero(self.ambiguous | ~self.monotonic[self.segment_annotation])
+        for segment in extra:
+            i = self.segment_annotation[segment]
+            j = segment - self.first_segment[i] + 1
+            prev_time_frame, time_frame = self.times[i][j - 1:j + 1] * 1000 / self.step_time_span
+            prev_freq_frame, freq_frame = (self.min_freq - self.freqs[i][j - 1:j + 1]) / self.freq_resolution
+            if time_frame - prev_time_frame < 1e-10:
+                continue
+            distance = np.sqrt((time_frame-prev_time_frame)**2 + (freq_frame - prev_freq_frame)**2)
+            t = np.linspace(prev_time_frame, time_frame, math.ceil(distance) + 1)
+            f = freq_frame + (prev_freq_frame - freq_frame) / (prev_time_frame - time_frame)*(t - time_frame)
+            columns.append(np.round(t).astype(np.int64))
+            rows.append(np.round(f).astype(np.int64))
+
+        columns, rows = np.concatenate(columns), np.concatenate(rows)
+        order = np.argsort(columns, kind="stable")
+        self.extra_columns = columns[order]
+        self.extra_rows = rows[order]
+
+    def _drawnSegments(self, i, start_time, time_span, max_freq, image_width, image_height):
+        '''
+        Follows drawAnnotation through the nodes of annotation i, which must not go back in time,
+        without drawing. drawAnnotation skips nodes before the mask and runs of nodes on one side
+        of it without moving its previous node, so it may join nodes that are not consecutive.
+
+        :returns: A tuple with, for each line drawAnnotation draws, the node it starts from, the
+                  node it ends at and the columns and rows, in the coordinates
+                  of the mask, of its start and of its end: (prev_nodes, nodes, (prev_time_frames,
+                  time_frames), (prev_freq_frames, freq_frames))
+        '''
+        times, freqs = self.times[i], self.freqs[i]
+        none = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), (None, None), (None, None))
+        if len(times) < 2:
+            return none
+
+        first_time_frame = (times[0]*1000 - start_time) * image_width / time_span
+        first_freq_frame = (max_freq - freqs[0]) / self.freq_resolution
+        if first_time_frame >= image_width:
+            return none
+
+        # Nodes well before the mask are skipped, and only the first of them matters
+        low = max(1, int(np.searchsorted(times, (start_time - self.step_time_span) / 1000)) - 1)
+        time_frames = (times[low:]*1000 - start_time) * image_width / time_span
+        freq_frames = (max_freq - freqs[low:]) / self.freq_resolution
+        in_time = np.flatnonzero(time_frames >= -0.5)
+        if len(in_time) == 0:
+            return none
+        first = in_time[0]
+
+        # The nodes that drawAnnotation considers, after the first node
+        nodes = np.concatenate(([0], np.arange(low + first, len(times))))
+        time_frames = np.concatenate(([first_time_frame], time_frames[first:]))
+        freq_frames = np.concatenate(([first_freq_frame], freq_frames[first:]))
+
+        # Consecutive nodes on the same side of the mask are skipped but for the first
+        zone = np.where(freq_frames < -0.5, 1, np.where(freq_frames >= image_height, 2, 0))
+        run_start = np.ones(len(nodes), dtype=bool)
+        run_start[1:] = (zone[1:] == 0) | (zone[1:] != zone[:-1])
+        prev = np.maximum.accumulate(np.where(run_start, np.arange(len(nodes)), 0))
+
+        drawn = np.flatnonzero(run_start[1:]) + 1
+        # Once a drawn node lies past the mask, no more lines are drawn
+        past = np.flatnonzero(time_frames[drawn] >= image_width)
+        if len(past) > 0:
+            drawn = drawn[:past[0] + 1]
+
+        prev_drawn = prev[drawn - 1]
+        return (nodes[prev_drawn], nodes[drawn],
+                (time_frames[prev_drawn], time_frames[drawn]), (freq_frames[prev_drawn], freq_frames[drawn]))
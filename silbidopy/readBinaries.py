@@ -1,11 +1,24 @@
 from datetime import datetime
+import os
 import struct
 
+import numpy as np
+
 SHORT_LEN = 2
 INT_LEN = 4
 DOUBLE_LEN = 8
 LONG_LEN = 8
 
+# One row per tonal, in the order of the file
+TABLE_OF_CONTENTS_DTYPE = np.dtype([
+    ("offset", "i8"),      # byte offset of the tonal in the file
+    ("nodes", "i8"),       # number of time-frequency nodes
+    ("start_time", "f8"),  # s, NaN if the tonal has no nodes or no times
+    ("end_time", "f8"),    # s
+    ("min_freq", "f8"),    # Hz, NaN if the tonal has no nodes or no frequencies
+    ("max_freq", "f8"),    # Hz
+])
+
 class TonalHeader:
     def __init__(self, file):
         '''Given a file object, type being "_io.BufferedReader", reads in
@@ -161,8 +174,14 @@ class TonalHeader:
 
 
 class tonalReader:
-    def __init__(self, filename):
-        '''Creates an itterable object that gets each tonal from a .ann Silbido file'''
+    def __init__(self, filename, toc_file = None):
+        '''Creates an itterable object that gets each tonal from a .ann Silbido file
+
+        :param filename: the silbido file
+        :param toc_file: a .npz file in which the table of contents of filename is cached, e.g.
+                         filename + ".toc.npz". It is rebuilt whenever filename changes. If None,
+                         the table of contents is only held in memory
+        '''
         self.file = open(filename, 'rb')
 
         self.hdr = TonalHeader(self.file)
@@ -170,31 +189,151 @@ class tonalReader:
         self.count = 0
 
         self.filename = filename
+        self.toc_file = toc_file
+        self.toc = None
         if self.hdr.userVersion == -1:
             # No header was present, rewind file and use default assumptions
             self.file.close()
             self.file = open(filename, 'rb')
+        self.dataStart = self.file.tell()
 
     def __iter__(self):
         return self
     def __len__(self):
-
-        length = len([t for t in self])
+        return len(self.getTableOfContents())
+    
+    def close(self):
+        '''Closes the file'''
         self.file.close()
-        self.__init__(self.filename)
 
-        return length
-    
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def getHeader(self):
         '''Returns the header object for the loaded file'''
         return self.hdr
     
     def refresh(self):
         '''Resets the file pointer to the first tonal'''
-        self.file.close()
-        self.__init__(self.filename)
+        self.file.seek(self.dataStart)
+        self.count = 0
+
+    def seek(self, i):
+        '''Moves the file pointer to tonal i, so that it is the next one returned'''
+        toc = self.getTableOfContents()
+        if i < 0:
+            i += len(toc)
+        if i < 0 or i > len(toc):
+            raise IndexError(f"Tonal {i} is out of range for {len(toc)} tonals.")
+        self.file.seek(toc["offset"][i] if i < len(toc) else os.path.getsize(self.filename))
+        self.count = i
+
+    def getTableOfContents(self):
+        '''
+        Returns the table of contents of the file, an array of TABLE_OF_CONTENTS_DTYPE with the
+        byte offset, number of nodes and time-frequency bounding box of each tonal. It is built
+        in one pass over the file the first time it is needed, without decoding any node but
+        its time and frequency, and then kept in memory and in toc_file.
+        '''
+        if self.toc is not None:
+            return self.toc
+
+        stat = os.stat(self.filename)
+        source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        if self.toc_file is not None and os.path.exists(self.toc_file):
+            with np.load(self.toc_file) as stored:
+                if np.array_equal(stored["source"], source):
+                    self.toc = stored["toc"]
+                    return self.toc
+
+        self.toc = self._readTableOfContents()
+        if self.toc_file is not None:
+            # Written whole before it replaces any older table
+            temporary = f'{self.toc_file}.{os.getpid()}.tmp'
+            with open(temporary, 'wb') as file:
+                np.savez(file, toc=self.toc, source=source)
+            os.replace(temporary, self.toc_file)
+        return self.toc
+
+    def _readTableOfContents(self):
+        # The fields of each node, in the order they are written
+        fields = [field for field in (self.hdr.TIME, self.hdr.FREQ, self.hdr.SNR, self.hdr.PHASE, self.hdr.RIDGE)
+                  if (self.hdr.bitMask & field) != 0]
+        node_len = DOUBLE_LEN * len(fields)
+
+        rows = []
+        with open(self.filename, 'rb') as file:
+            file.seek(self.dataStart)
+            while len(file.peek()) > 0:
+                offset = file.tell()
+                if self.hdr.hasConfidence():
+                    file.seek(DOUBLE_LEN, os.SEEK_CUR)
+                if self.hdr.hasScore():
+                    file.seek(DOUBLE_LEN, os.SEEK_CUR)
+                if self.hdr.hasSpecies():
+                    file.seek(int.from_bytes(file.read(2), byteorder = "big"), os.SEEK_CUR)
+                if self.hdr.hasCall():
+                    file.seek(int.from_bytes(file.read(2), byteorder = "big"), os.SEEK_CUR)
+                if self.hdr.getFileFormatVersion() > 2:
+                    file.seek(LONG_LEN, os.SEEK_CUR)
+
+                N = int.from_bytes(file.read(INT_LEN), byteorder = "big")
+                data = file.read(N * node_len)
+                if len(data) != N * node_len:
+                    raise ValueError(f"Tonal {len(rows)} of {self.filename} is truncated.")
+                nodes = np.frombuffer(data, dtype='>f8').reshape(N, len(fields))
+
+                bounds = [np.nan] * 4
+                if N > 0 and self.hdr.TIME in fields:
+                    times = nodes[:, fields.index(self.hdr.TIME)]
+                    bounds[0:2] = times.min(), times.max()
+                if N > 0 and self.hdr.FREQ in fields:
+                    freqs = nodes[:, fields.index(self.hdr.FREQ)]
+                    bounds[2:4] = freqs.min(), freqs.max()
+                rows.append((offset, N, *bounds))
+        return np.array(rows, dtype=TABLE_OF_CONTENTS_DTYPE)
+
+    def indicesIn(self, start_time = None, end_time = None, min_freq = None, max_freq = None):
+        '''
+        Finds the tonals whose bounding box overlaps a time-frequency box, using only the table
+        of contents. Bounds that are None are unbounded. As in getAnnotationMask, a tonal
+        overlaps a range if it ends at or after its start and begins before its end.
+
+        :param start_time: s, the start of the time range
+        :param end_time: s, the end of the time range
+        :param min_freq: Hz, the bottom of the frequency range
+        :param max_freq: Hz, the top of the frequency range
+
+        :returns: the indices of the overlapping tonals, in the order of the file
+        '''
+        toc = self.getTableOfContents()
+        # Tonals without nodes have NaN bounds and so never overlap
+        overlaps = toc["nodes"] > 0
+        if start_time is not None:
+            overlaps &= toc["end_time"] >= start_time
+        if end_time is not None:
+            overlaps &= toc["start_time"] < end_time
+        if min_freq is not None:
+            overlaps &= toc["max_freq"] >= min_freq
+        if max_freq is not None:
+            overlaps &= toc["min_freq"] < max_freq
+        return np.flatnonzero(overlaps)
+
+    def contoursIn(self, start_time = None, end_time = None, min_freq = None, max_freq = None):
+        '''
+        Returns the contours whose bounding box overlaps a time-frequency box, as for
+        getTimeFrequencyContours, decoding only those tonals. The file pointer is left
+        after the last of them. Parameters are as for indicesIn.
+        '''
+        contours = []
+        for i in self.indicesIn(start_time, end_time, min_freq, max_freq):
+            self.seek(i)
+            contours.append([(n["time"], n["freq"]) for n in next(self)["tfnodes"]])
+        return contours
 
-    
     def getTimeFrequencyContours(self):
         '''Given the current state of the file pointer, returns contours for
         all succeeding contours in the form of a list of lists of
@@ -1,16 +1,28 @@
 import numpy as np
-from silbidopy.sigproc import magspec, frame_signal
+from silbidopy.sigproc import magspec, frame_signal, lowpass_filter, polyphase_branches, heterodyne_decimate
 import wavio
 import math
+import functools
+
+# Estimated work per input sample of a decimated spectrogram, in floating point operations of the fft:
+# that of each filter tap of a decimated sample, and that of mixing and framing each decimated sample,
+# as measured with numpy's fft and matrix product
+FILTER_TAP_COST = 2
+DECIMATED_SAMPLE_COST = 200
+# Signals are only decimated when that is estimated to take at most this fraction of the work of
+# the plain spectrogram, as the estimate is rough and small savings do not cover the filter's setup
+DECIMATION_SAVING = 0.8
 
 def getSpectrogram(audioFile, frame_time_span = 8, step_time_span = 2, spec_clip_min = 0,
                    spec_clip_max = 6, min_freq = 5000, max_freq = 50000,
-                   start_time = 0, end_time=-1):
+                   start_time = 0, end_time=-1, decimate = False, cache = None):
     '''
     Gets and returns a two-dimensional list in which the values encode a spectrogram.
 
     :param audioFile: the audio file in .wav format for which a spectrogram is generated.
-                      This may either be an audio file of time wavio.Wav or a file name
+                      This may either be an audio file of time wavio.Wav or a file name.
+                      A wavio.Wav with an offset attribute holds only the part of the file
+                      from that index of its flattened data on, e.g. from AudioWindows
     :param frame_time_span: ms, length of time for one time window for dft
     :param step_time_span: ms, length of time step for spectrogram
     :param spec_clip_min: log magnitude spectrogram min-max normalization, minimum value
@@ -20,6 +32,15 @@ def getSpectrogram(audioFile, frame_time_span = 8, step_time_span = 2, spec_clip
     :param start_time: ms, the beginning of where the audioFile is read
     :param end_time: ms, the end of where the audioFile is read. If end > the length of
                      of the file, then the file is read only to its end.
+    :param decimate: if True, the min_freq to max_freq band is shifted down to 0 Hz and
+                     resampled to a lower rate that still holds it before the DFT, if
+                     decimation_parameters estimates that to be faster. Each frame then has
+                     fewer samples and bins to transform, while the frequency resolution,
+                     and so the shape of the spectrogram, stays the same.
+    :param cache: a silbidopy.cache.SpectrogramCache. If given, audioFile must be a file
+                  name, and the spectrogram is sliced from the cached spectrogram of the
+                  whole file, which is computed only if it is not cached yet. Cached
+                  spectrograms are not decimated, so decimate must then be False.
 
     :returns: A tuple with both the spectrogram and the time at which the
               spectrogram ended in ms: (spectogram, end_time)
@@ -27,6 +48,13 @@ def getSpectrogram(audioFile, frame_time_span = 8, step_time_span = 2, spec_clip
 
     freq_resolution = 1000 / frame_time_span
 
+    if cache is not None:
+        if decimate:
+            raise ValueError("Spectrograms sliced from a cache cannot be decimated.")
+        return getCachedSpectrogram(cache, audioFile, frame_time_span=frame_time_span, step_time_span=step_time_span,
+                                    spec_clip_min=spec_clip_min, spec_clip_max=spec_clip_max, min_freq=min_freq,
+                                    max_freq=max_freq, start_time=start_time, end_time=end_time)
+
     # Load audio file
     if type(audioFile) == wavio.Wav:
         wav_data = audioFile
@@ -47,31 +75,170 @@ def getSpectrogram(audioFile, frame_time_span = 8, step_time_span = 2, spec_clip
 
     frame_sample_span = int(math.floor(frame_time_span / 1000 * wav_data.rate))
     step_sample_span = step_time_span / 1000 * wav_data.rate
+
+    clip_bottom = int(min_freq // freq_resolution)
+    clip_top = int(max_freq // freq_resolution) 
+
+    factor = 1
+    if decimate:
+        factor, center_bin, taps, branches = decimation_filter(frame_sample_span, step_sample_span, clip_bottom, clip_top)
+
+    if factor > 1:
+        # Band-limit and resample so that the frames hold only the bins kept below
+        signal_span = wav_data.data[start_frame:end_frame].shape[0]
+        signal = heterodyne_decimate(wav_data.data.ravel(), factor, taps, center_bin, frame_sample_span,
+                                     start=start_frame, stop=start_frame + signal_span, branches=branches)
+        frame_sample_span //= factor
+        step_sample_span /= factor
+
+        # No frames if the audio file is too short
+        if signal.shape[0] < frame_sample_span:
+            frames = []
+        else:
+            frames = frame_signal(signal, frame_sample_span, step_sample_span)
+
+        # #
+        # Make spectrogram
+        # #
+        NFFT = len(frames[0])
+
+        # Compute magnitude spectra
+        singal_magspec = magspec(frames, NFFT)
+
+        # Include only the desired frequency range
+        # Bin k of the shifted signal holds frequency bin center_bin + k of the original
+        spectrogram = singal_magspec.T[np.arange(clip_bottom - center_bin, clip_top - center_bin) % NFFT]
+    else:
+        singal_magspec = getMagnitudeSpectra(wav_data, frame_time_span=frame_time_span, step_time_span=step_time_span,
+                                             start_time=start_time, end_time=end_time)
+
+        # Include only the desired frequency range
+        spectrogram = singal_magspec.T[clip_bottom:clip_top]
+    spectrogram = np.log10(spectrogram)
+
+    # Flip spectrogram to match expectations for display
+    # Also normalize
+    spectrogram = normalize3(spectrogram[::-1,], spec_clip_min, spec_clip_max)
+
+
+
+    actual_end_time = start_time + spectrogram.shape[1] * step_time_span
+    return spectrogram, actual_end_time
+
+def getMagnitudeSpectra(wav_data, frame_time_span = 8, step_time_span = 2, start_time = 0, end_time = -1):
+    '''
+    Splits the audio from start_time to end_time into overlapping frames and gets the magnitude
+    spectrum of each, exactly as getSpectrogram does without decimation.
+
+    :param wav_data: the wavio.Wav of the audio file, or of a window of it with an offset attribute
+    :param ...: as for getSpectrogram
+
+    :returns: an array of shape (frames, bins) holding every bin of the dft of each frame
+    '''
+    start_frame = int(start_time / 1000 * wav_data.rate)
+    end_frame = int((end_time / 1000 + frame_time_span / 1000 - step_time_span / 1000)* wav_data.rate)
+
+    # Windows of a file are indexed as the whole file would be
+    offset = getattr(wav_data, "offset", 0)
+
+    frame_sample_span = int(math.floor(frame_time_span / 1000 * wav_data.rate))
+    step_sample_span = step_time_span / 1000 * wav_data.rate
+
+    signal = wav_data.data.ravel()[start_frame - offset:end_frame - offset]
+
     # No frames if the audio file is too short
-    if wav_data.data[start_frame:end_frame].shape[0] < frame_sample_span:
+    if signal.shape[0] < frame_sample_span:
         frames = []
     else:
-        frames = frame_signal(wav_data.data.ravel()[start_frame:end_frame], frame_sample_span, step_sample_span)
-    
-    # #
-    # Make spectrogram
-    # #
+        frames = frame_signal(signal, frame_sample_span, step_sample_span)
+
     NFFT = len(frames[0])
+    return magspec(frames, NFFT)
+
+def getStripSpectrogram(wav_data, frame_time_span = 8, step_time_span = 2, spec_clip_min = 0,
+                        spec_clip_max = 6, min_freq = 5000, max_freq = 50000,
+                        first_column = 0, last_column = 0, decimate = False):
+    '''
+    Gets columns of the spectrogram of a whole audio file, in which column k is the frame that
+    starts at sample round(k * step_time_span / 1000 * rate), as in a silbidopy.cache.SpectrogramCache.
+    Unlike those of getSpectrogram, whose frames are spread over the span requested, the columns
+    are the same however the spectrogram is split into calls.
+
+    :param wav_data: the wavio.Wav of the audio file, or of a window of it with an offset attribute
+                     that holds every sample of the columns
+    :param first_column: the first column
+    :param last_column: one past the last column
+    :param decimate: as for getSpectrogram. Frames then start at the nearest decimated sample.
+                     Windows of a file may not be decimated
+    :param ...: as for getSpectrogram
+
+    :returns: the spectrogram, of shape (bins, last_column - first_column), highest frequency first
+    '''
+    freq_resolution = 1000 / frame_time_span
 
-    # Compute magnitude spectra
-    singal_magspec = magspec(frames, NFFT)
+    frame_sample_span = int(math.floor(frame_time_span / 1000 * wav_data.rate))
+    step_sample_span = step_time_span / 1000 * wav_data.rate
 
-    # Include only the desired frequency range
     clip_bottom = int(min_freq // freq_resolution)
     clip_top = int(max_freq // freq_resolution) 
-    spectrogram = singal_magspec.T[clip_bottom:clip_top]
+
+    factor = 1
+    if decimate:
+        factor, center_bin, taps, branches = decimation_filter(frame_sample_span, step_sample_span, clip_bottom, clip_top)
+
+    columns = np.arange(first_column, last_column)
+    if factor > 1:
+        # Each decimated sample depends only on its index, so the frames are those of the whole file
+        NFFT = frame_sample_span // factor
+        starts = np.round(columns * (step_sample_span / factor)).astype(int)
+        first = int(starts[0]) if len(starts) > 0 else 0
+        last = int(starts[-1]) + NFFT if len(starts) > 0 else 0
+        signal = heterodyne_decimate(wav_data.data.ravel(), factor, taps, center_bin, frame_sample_span,
+                                     start=first * factor, stop=last * factor, branches=branches)
+        frames = signal[(starts - first)[:, np.newaxis] + np.arange(NFFT)]
+        # Bin k of the shifted signal holds frequency bin center_bin + k of the original
+        spectrogram = magspec(frames, NFFT).T[np.arange(clip_bottom - center_bin, clip_top - center_bin) % NFFT]
+    else:
+        # Windows of a file are indexed as the whole file would be
+        offset = getattr(wav_data, "offset", 0)
+        signal = wav_data.data.ravel()
+        starts = np.round(columns * step_sample_span).astype(int) - offset
+        starts = np.minimum(starts, len(signal) - frame_sample_span)
+        frames = signal[starts[:, np.newaxis] + np.arange(frame_sample_span)]
+        spectrogram = magspec(frames, frame_sample_span).T[clip_bottom:clip_top]
     spectrogram = np.log10(spectrogram)
 
     # Flip spectrogram to match expectations for display
     # Also normalize
-    spectrogram = normalize3(spectrogram[::-1,], spec_clip_min, spec_clip_max)
+    return normalize3(spectrogram[::-1,], spec_clip_min, spec_clip_max)
 
+def getCachedSpectrogram(cache, audioFile, frame_time_span = 8, step_time_span = 2, spec_clip_min = 0,
+                         spec_clip_max = 6, min_freq = 5000, max_freq = 50000,
+                         start_time = 0, end_time=-1):
+    '''
+    Gets the spectrogram of getSpectrogram from the log magnitudes held in cache. Clipping and
+    normalization are applied to the slice. The spectrogram is the same as that of getSpectrogram
+    with a MemorySpectrogramCache, but framed on the grid of the whole file, and so slightly
+    different, with a SpectrogramCache.
 
+    :param cache: a silbidopy.cache.SpectrogramCache or MemorySpectrogramCache
+    :param audioFile: the file name of the audio file in .wav format
+    :param ...: as for getSpectrogram
+
+    :returns: A tuple with both the spectrogram and the time at which the
+              spectrogram ended in ms: (spectogram, end_time)
+    '''
+    freq_resolution = 1000 / frame_time_span
+
+    # Include only the desired frequency range
+    clip_bottom = int(min_freq // freq_resolution)
+    clip_top = int(max_freq // freq_resolution) 
+    spectrogram = cache.getLogMagnitudes(audioFile, frame_time_span=frame_time_span, step_time_span=step_time_span,
+                                         start_time=start_time, end_time=end_time, clip_bottom=clip_bottom, clip_top=clip_top)
+
+    # Flip spectrogram to match expectations for display
+    # Also normalize
+    spectrogram = normalize3(spectrogram[::-1,], spec_clip_min, spec_clip_max)
 
     actual_end_time = start_time + spectrogram.shape[1] * step_time_span
     return spectrogram, actual_end_time
@@ -111,7 +278,7 @@ def getAnnotationMask(annotations, frame_time_span = 8, step_time_span = 2,
 
     # if no annotations to plot
     if len(annotations) == 0:
-         return mask
+         return mask, False
 
     freq_resolution = 1000 / frame_time_span
     time_span = (end_time - start_time)
@@ -120,71 +287,166 @@ def getAnnotationMask(annotations, frame_time_span = 8, step_time_span = 2,
 
     # plot the portions of annotations that are within the time-frequency range
     for annotation in annotations:
-        prev_time_frame = 0
-        prev_freq_frame = 0
-        first_flag = True
-        for time, freq in annotation:
-            # get approximate pixel frame for timestamp & frequency
-            time_frame = (time*1000 - start_time) * image_width / time_span
-            freq_frame = (max_freq - freq) / freq_resolution
-
-            if first_flag:
-                prev_time_frame = time_frame
-                prev_freq_frame = freq_frame
-                first_flag = False
-                continue
-            
-            # If the time frame is above image width,
-            # all future ones will be in this annotation
-            if prev_time_frame >= image_width:
-                break
-            
-            # If time frame is before the image
-            if time_frame < -0.5:
-                continue
-
-            # If both are prev and curr are outside image
-            if ((freq_frame < -0.5 and prev_freq_frame < -0.5) or
-                    (freq_frame >= image_height and prev_freq_frame >= image_height)):
-                continue
-
-            # Interpolating line function
-            freq_time_line = (
-                lambda x: freq_frame + (prev_freq_frame - freq_frame) / 
-                (prev_time_frame - time_frame)*(x - time_frame) )
-
-            distance = np.sqrt((time_frame-prev_time_frame)**2 + (freq_frame - prev_freq_frame)**2)
-            # Draw interpolating line
-            for t in np.linspace(prev_time_frame, time_frame, math.ceil(distance) + 1):
-                
-                t_rounded = round(t)
-                # check that time is within the image
-                if t_rounded < 0 or t_rounded >= image_width:
-                    continue
-
-                # get frequency from interpolation line.
-                if time_frame - prev_time_frame < 1e-10:
-                    curr_freq_rounded = round(freq)
-                else:
-                    curr_freq_rounded = round(freq_time_line(t))
-                
-                # Check that frequency is within the image
-                if curr_freq_rounded < 0 or curr_freq_rounded >= image_height:
-                    continue
-                
-                # Draw pixel
-                mask[curr_freq_rounded, t_rounded] = 1
-                positive_flag = True
+        if drawAnnotation(mask, annotation, start_time, time_span, max_freq, freq_resolution):
+            positive_flag = True
+    
+    return mask, positive_flag
+
+def drawAnnotation(mask, annotation, start_time, time_span, max_freq, freq_resolution):
+    '''
+    Draws the portion of one annotation that is within a mask, as getAnnotationMask does.
 
+    :param mask: the mask, of shape (image_height, image_width)
+    :param annotation: the (time_s, freq_hz) nodes of the annotation
+    :param start_time: ms, the time of the first column of the mask
+    :param time_span: ms, the time spanned by the mask
+    :param max_freq: Hz, the frequency of the first row of the mask
+    :param freq_resolution: Hz, the frequency spanned by each row
+
+    :returns: whether any pixel was drawn
+    '''
+    image_height, image_width = mask.shape
+    positive_flag = False
+    prev_time_frame = 0
+    prev_freq_frame = 0
+    first_flag = True
+    for time, freq in annotation:
+        # get approximate pixel frame for timestamp & frequency
+        time_frame = (time*1000 - start_time) * image_width / time_span
+        freq_frame = (max_freq - freq) / freq_resolution
+
+        if first_flag:
             prev_time_frame = time_frame
             prev_freq_frame = freq_frame
+            first_flag = False
+            continue
+        
+        # If the time frame is above image width,
+        # all future ones will be in this annotation
+        if prev_time_frame >= image_width:
+            break
+        
+        # If time frame is before the image
+        if time_frame < -0.5:
+            continue
+
+        # If both are prev and curr are outside image
+        if ((freq_frame < -0.5 and prev_freq_frame < -0.5) or
+                (freq_frame >= image_height and prev_freq_frame >= image_height)):
+            continue
+
+        if drawSegment(mask, prev_time_frame, prev_freq_frame, time_frame, freq_frame, freq):
+            positive_flag = True
+
+        prev_time_frame = time_frame
+        prev_freq_frame = freq_frame
+    return positive_flag
+
+def drawSegment(mask, prev_time_frame, prev_freq_frame, time_frame, freq_frame, freq):
+    '''
+    Draws the interpolating line between two nodes of an annotation, as getAnnotationMask does.
+
+    :param mask: the mask, of shape (image_height, image_width)
+    :param prev_time_frame: the column, unrounded, of the previous node
+    :param prev_freq_frame: the row, unrounded, of the previous node
+    :param time_frame: the column, unrounded, of the node
+    :param freq_frame: the row, unrounded, of the node
+    :param freq: Hz, the frequency of the node
+
+    :returns: whether any pixel was drawn
+    '''
+    image_height, image_width = mask.shape
+
+    distance = np.sqrt((time_frame-prev_time_frame)**2 + (freq_frame - prev_freq_frame)**2)
+    # Draw interpolating line
+    t = np.linspace(prev_time_frame, time_frame, math.ceil(distance) + 1)
+    t_rounded = np.round(t)
+
+    # get frequency from interpolation line.
+    if time_frame - prev_time_frame < 1e-10:
+        freq_rounded = np.full(len(t), round(freq))
+    else:
+        freq_rounded = np.round(freq_frame + (prev_freq_frame - freq_frame) / 
+                                (prev_time_frame - time_frame)*(t - time_frame))
+
+    # check that the points are within the image
+    inside = ((t_rounded >= 0) & (t_rounded < image_width) &
+              (freq_rounded >= 0) & (freq_rounded < image_height))
     
-    return mask, positive_flag
+    # Draw pixels
+    mask[freq_rounded[inside].astype(int), t_rounded[inside].astype(int)] = 1
+    return bool(inside.any())
 
 
 
 ####### UTILITY #######
 
+def decimation_parameters(frame_sample_span, step_sample_span, clip_bottom, clip_top, guard = 0.1):
+    '''
+    Chooses how far a signal is decimated once the frequency bins clip_bottom up to,
+    but not including, clip_top are shifted to be centred on 0 Hz.
+
+    The factor always divides frame_sample_span so that the decimated frames keep the
+    original frequency resolution. The kept band must fill at most 1 / (1 + guard) of
+    the decimated bandwidth, leaving the rest for the transition of the low-pass filter.
+    The narrower the transition, the longer the filter, so of the factors allowed the one
+    with the least estimated work is chosen, and none unless it saves enough of the work
+    of the plain spectrogram, as set by DECIMATION_SAVING.
+
+    :param frame_sample_span: the number of samples in one frame at the original rate
+    :param step_sample_span: the number of samples between frames at the original rate
+    :param clip_bottom: the lowest frequency bin to be kept
+    :param clip_top: one above the highest frequency bin to be kept
+
+    :returns: A tuple with the decimation factor, 1 if the signal is not decimated, the
+              frequency bin moved to 0 Hz and the number of filter taps: (factor, center_bin, num_taps)
+    '''
+    center_bin = (clip_bottom + clip_top) // 2
+    half_width = max(center_bin - clip_bottom, clip_top - 1 - center_bin) + 0.5
+
+    # Work per input sample of the dft of each frame: a real fft, or a complex one once decimated
+    def fft_cost(length, complex_input):
+        return (5 if complex_input else 2.5) * length * math.log2(max(length, 2)) / step_sample_span
+
+    factor, num_taps = 1, 0
+    least_cost = DECIMATION_SAVING * fft_cost(frame_sample_span, False)
+    for candidate in range(2, frame_sample_span + 1):
+        if frame_sample_span % candidate != 0:
+            continue
+        if frame_sample_span / candidate / 2 < half_width * (1 + guard):
+            break
+        transition = 1 / candidate - 2 * half_width / frame_sample_span
+        candidate_taps = int(math.ceil(5.0 / transition)) | 1
+        cost = (fft_cost(frame_sample_span // candidate, True)
+                + (FILTER_TAP_COST * candidate_taps + DECIMATED_SAMPLE_COST) / candidate)
+        if cost < least_cost:
+            factor, num_taps, least_cost = candidate, candidate_taps, cost
+
+    return factor, center_bin, num_taps
+
+@functools.lru_cache(maxsize=128)
+def decimation_filter(frame_sample_span, step_sample_span, clip_bottom, clip_top):
+    '''
+    Gets the decimation chosen by decimation_parameters along with its filter, built once for
+    each frame, step and band and then reused by every spectrogram that asks for them.
+
+    :param ...: as for decimation_parameters
+
+    :returns: A tuple with the decimation factor, 1 if the signal is not decimated, the frequency
+              bin moved to 0 Hz, the read-only filter taps and their polyphase_branches, None if the
+              signal is not decimated: (factor, center_bin, taps, branches)
+    '''
+    factor, center_bin, num_taps = decimation_parameters(frame_sample_span, step_sample_span, clip_bottom, clip_top)
+    if factor == 1:
+        return factor, center_bin, None, None
+
+    taps = lowpass_filter(num_taps, 0.5 / factor) * factor
+    branches = polyphase_branches(taps, factor, center_bin, frame_sample_span)
+    taps.flags.writeable = False
+    branches.flags.writeable = False
+    return factor, center_bin, taps, branches
+
+
 # Credit to Pu Li https://github.com/Paul-LiPu/DeepWhistle
 # min-max normalization
 def normalize3(mat, min_v, max_v):
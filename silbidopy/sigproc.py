@@ -36,6 +36,7 @@ def frame_signal(signal, frame_len: int, frame_step: float):
 
 def magspec(frames,NFFT):
     """Compute the magnitude spectrum of each frame in frames. If frames is an NxD matrix, output will be Nx(NFFT/2+1).
+    Complex frames, e.g. from heterodyne_decimate, get a full complex FFT and the output is NxNFFT instead.
 
     :param frames: the array of frames. Each row is a frame.
     :param NFFT: the FFT length to use. If NFFT > frame_len, the frames are zero-padded.
@@ -43,8 +44,104 @@ def magspec(frames,NFFT):
     """
     if np.shape(frames)[1] > NFFT:
         logging.warn('frame length (%d) is greater than FFT size (%d), frame will be truncated. Increase NFFT to avoid.', numpy.shape(frames)[1], NFFT)
-    complex_spec = np.fft.rfft(frames,NFFT)
+    if np.iscomplexobj(frames):
+        complex_spec = np.fft.fft(frames,NFFT)
+    else:
+        complex_spec = np.fft.rfft(frames,NFFT)
     return np.absolute(complex_spec)
 
 
+def lowpass_filter(num_taps: int, cutoff: float, beta: float = 8.0):
+    """Design a linear-phase low-pass FIR filter with the Kaiser-windowed sinc method.
 
+    :param num_taps: the number of coefficients. Must be odd so that the filter delay is a whole number of samples.
+    :param cutoff: the cutoff frequency as a fraction of the sampling rate, 0 < cutoff < 0.5.
+    :param beta: the Kaiser window shape. 8.0 gives roughly 80 dB of stopband attenuation.
+    :returns: the filter coefficients, scaled to unit gain at 0 Hz.
+    """
+    if num_taps % 2 == 0:
+        raise ValueError("num_taps must be odd.")
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = np.sinc(2 * cutoff * n) * np.kaiser(num_taps, beta)
+    return taps / taps.sum()
+
+
+def polyphase_branches(taps, factor: int, center_bin: int, NFFT: int):
+    """Shift a low-pass filter up to a frequency band and split it into polyphase branches, as heterodyne_decimate uses it.
+    Building them once and passing them to every call saves doing so for each.
+
+    :param taps: odd-length low-pass filter coefficients, as from lowpass_filter.
+    :param factor: the integer decimation factor.
+    :param center_bin: the frequency moved to 0 Hz, as a bin of an NFFT point DFT at the original rate.
+    :param NFFT: the DFT length that center_bin refers to.
+    :returns: a real array of shape (factor, 2 * branch_len). Column j holds the real parts of the shifted taps
+              j * factor up to (j + 1) * factor, and column branch_len + j their imaginary parts.
+    """
+    half = (len(taps) - 1) // 2
+    omega = 2 * np.pi * center_bin / NFFT
+    band_taps = taps * np.exp(-1j * omega * (np.arange(len(taps)) - half))
+
+    # Zero-pad the filter to whole branches; branch p holds taps p, p + factor, p + 2 * factor, ...
+    branch_len = -(-len(taps) // factor)
+    padded_taps = np.zeros(branch_len * factor, dtype=np.complex128)
+    padded_taps[:len(taps)] = band_taps
+    return np.concatenate((padded_taps.real.reshape(branch_len, factor).T,
+                           padded_taps.imag.reshape(branch_len, factor).T), axis=1)
+
+
+def heterodyne_decimate(signal, factor: int, taps, center_bin: int, NFFT: int, start: int = 0, stop: int = None,
+                        block_len: int = 1 << 14, branches = None):
+    """Shift a frequency band of a real signal down to 0 Hz, low-pass filter it and keep every factor-th sample.
+    Only the kept samples are ever computed, with the filter split into factor polyphase branches.
+
+    Output sample i is centred on signal[start + i * factor]. Samples of signal outside of its bounds are taken to be 0.
+    The mixing phase is taken from the absolute sample index, and each output sample is computed the same way
+    wherever it lies in a call, so that overlapping calls give identical samples.
+
+    :param signal: the one-dimensional real signal.
+    :param factor: the integer decimation factor.
+    :param taps: odd-length low-pass filter coefficients, as from lowpass_filter.
+    :param center_bin: the frequency moved to 0 Hz, as a bin of an NFFT point DFT at the original rate.
+    :param NFFT: the DFT length that center_bin refers to.
+    :param start: the index of the first sample at which to centre an output sample.
+    :param stop: one past the last index at which an output sample may be centred. Defaults to len(signal).
+    :param block_len: the most output samples computed at once. Bounds the memory used.
+    :param branches: polyphase_branches(taps, factor, center_bin, NFFT), if already built.
+    :returns: a complex array of ceil((stop - start) / factor) samples at a rate of rate / factor.
+    """
+    if stop is None:
+        stop = len(signal)
+    if branches is None:
+        branches = polyphase_branches(taps, factor, center_bin, NFFT)
+    half = (len(taps) - 1) // 2
+    branch_len = branches.shape[1] // 2
+    num_out = max(0, -(-(stop - start) // factor))
+    out = np.empty(num_out, dtype=np.complex128)
+
+    # Mixing commutes with the filter by instead shifting the filter up to the band, so that
+    # only a real signal is filtered and the mixing runs at the lower rate afterwards
+    omega = 2 * np.pi * center_bin / NFFT
+
+    for first in range(0, num_out, block_len):
+        count = min(block_len, num_out - first)
+        # Input span needed for this block, including the filter's reach on both sides
+        lo = start + first * factor - half
+        hi = lo + (count + branch_len - 1) * factor
+
+        segment = np.zeros(hi - lo)
+        valid_lo, valid_hi = max(lo, 0), min(hi, len(signal))
+        if valid_lo < valid_hi:
+            segment[valid_lo - lo:valid_hi - lo] = signal[valid_lo:valid_hi]
+
+        # Row r of products holds each branch applied to the factor input samples of row r, all in one
+        # matrix product. Output sample i then sums branch j of row i + j, along a diagonal
+        products = segment.reshape(-1, factor) @ branches
+        row_stride, column_stride = products.strides
+        diagonals = (row_stride, row_stride + column_stride)
+        real = np.lib.stride_tricks.as_strided(products, shape=(count, branch_len), strides=diagonals).sum(axis=1)
+        imag = np.lib.stride_tricks.as_strided(products[:, branch_len:], shape=(count, branch_len), strides=diagonals).sum(axis=1)
+
+        centers = start + (first + np.arange(count)) * factor
+        out[first:first + count] = (real + 1j * imag) * np.exp(-1j * omega * (centers % NFFT))
+
+    return out
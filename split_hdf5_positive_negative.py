@@ -1,3 +1,4 @@
+import os
 import h5py
 
 
@@ -9,6 +10,10 @@ import helper_functions as wav2spec
 from write_images import write_images
 from silbidopy.readBinaries import tonalReader
 from silbidopy.render import getSpectrogram, getAnnotationMask
+from dataset_statistics import RunningStatistics
+from hdf5_writer import patch_dataset_options, compression_executor, RowWriter
+from provenance import write_provenance, PROVENANCE_DTYPE
+import memory_budget
 
 
 
@@ -18,75 +23,92 @@ def main():
     parser.add_argument('output_dir', type=str, help='The folder into which the two new hdf5 will be written')
     parser.add_argument('--positive_file_name', type=str, default="pos.hdf5", help='The name of the output hdf5 file that contains the positive data')
     parser.add_argument('--negative_file_name', type=str, default="neg.hdf5", help='The name of the output hdf5 file that contains the negative data')
-    parser.add_argument('--block_size', type=int, default=128, help='How many examples may be held in memory at one time before a write occurres')
+    parser.add_argument('--block_size', type=int, default=128, help='How many examples may be held in memory at one time before a write occurres. Chosen by --max_memory if given')
+    parser.add_argument('--compression_threads', type=int, default=None, help='the number of threads compressing the outputs. Defaults to one per CPU. 0 compresses them in the main thread')
+    parser.add_argument('--contiguous', action='store_true', help='store the outputs uncompressed and contiguously, so that memmap_dataset.py can map them with no copies')
+    memory_budget.add_memory_arguments(parser)
     config = parser.parse_args()    
 
-    half_block_size = config.block_size // 2
-
     input_file = h5py.File(config.input_hdf5)
 
     height, width = input_file['data'].shape[1], input_file['data'].shape[2]
-    
+    flags = input_file['positive_flag'][:] == 1
+
+    # With a memory budget, the block size is chosen to fit it
+    block_size = config.block_size
+    max_pending = 8
+    if config.max_memory is not None:
+        value_size = input_file['data'].dtype.itemsize
+        # Each row is read, selected into its half and has its statistics taken
+        row_bytes = 2 * 2 * height * width * value_size + height * width * memory_budget.STATISTICS_BYTES
+        # The flags, as read and compared, and the provenance table and each half of it
+        fixed = len(flags) * (value_size + 1) + ('provenance' in input_file) * 2 * len(flags) * PROVENANCE_DTYPE.itemsize
+        threads = config.compression_threads if config.compression_threads is not None else os.cpu_count()
+        try:
+            block_size, max_pending = memory_budget.plan_rows(config.max_memory * 1e9, row_bytes, fixed=fixed,
+                                                              compressed_datasets=0 if config.contiguous else 4, threads=threads)
+        except ValueError as ex:
+            parser.error(str(ex))
+        print(f'Memory: blocks of {block_size} patches')
+
     # The hdf5 outputs for both positive (True) and negative (False) examples
     hdf5s = {
         True: h5py.File(config.output_dir + config.positive_file_name, 'w'),
         False: h5py.File(config.output_dir + config.negative_file_name, 'w')
         }
-    have_not_added_data = {
-        True: True,
-        False : True
-    }
-    block_idx = {
+    # The number of patches of each output is known from the flags, so its datasets are created at their final size
+    for flag, file in hdf5s.items():
+        count = int((flags == flag).sum())
+        patch_options = patch_dataset_options((height, width), contiguous=config.contiguous)
+        file.create_dataset('data', shape=(count, height, width), dtype="f4", **patch_options)
+        file.create_dataset('label', shape=(count, height, width), dtype="f4", **patch_options)
+        file.create_dataset('positive_flag', data=np.full(count, flag, dtype="f4"), **patch_dataset_options((), contiguous=config.contiguous))
+    written = {
         True: 0,
         False: 0
     }
-    spectrogram_block = {
-        True: np.zeros((half_block_size, height, width), dtype="f4"),
-        False: np.zeros((half_block_size, height, width), dtype="f4")
-    }
-    mask_block = {
-        True: np.zeros((half_block_size, height, width), dtype="f4"),
-        False: np.zeros((half_block_size, height, width), dtype="f4")
+    # Chunks are compressed in parallel and written in order
+    executor = compression_executor(config.compression_threads)
+    writers = {flag: {name: RowWriter(file[name], executor=executor, max_pending=max_pending) for name in ('data', 'label')}
+               for flag, file in hdf5s.items()}
+    # The statistics of the input do not hold for either half, so they are recomputed as it is written
+    statistics = {
+        True: RunningStatistics(height),
+        False: RunningStatistics(height)
     }
 
-    num_processed = 0
-    added = 0
-    for spectrogram, mask, flag in zip(input_file['data'], input_file['label'], input_file['positive_flag']):
-
-        flag = True if flag == 1 else False
-
-        spectrogram_block[flag][block_idx[flag]] = spectrogram
-        mask_block[flag][block_idx[flag]] = mask
-
-        # Save block of patches to hdf5
-        if (block_idx[flag] == half_block_size - 1 or num_processed == input_file['data'].shape[0] - 1) and have_not_added_data[flag]:
-            # create datasets
-            hdf5s[flag].create_dataset('data', data=spectrogram_block[flag][:block_idx[flag]+1], compression="gzip", chunks=True, maxshape=(None, height, width))
-            hdf5s[flag].create_dataset('label', data=mask_block[flag][:block_idx[flag]+1], compression="gzip", chunks=True, maxshape=(None,height, width))
-            have_not_added_data[flag] = False
-        elif block_idx[flag] == half_block_size - 1:
-            # Append new data to the hdf5
-            hdf5s[flag]['data'].resize((hdf5s[flag]['data'].shape[0] + spectrogram_block[flag].shape[0]), axis=0)
-            hdf5s[flag]['data'][-spectrogram_block[flag].shape[0]:] = spectrogram_block[flag]
-
-            hdf5s[flag]['label'].resize((hdf5s[flag]['label'].shape[0] + mask_block[flag].shape[0]), axis=0)
-            hdf5s[flag]['label'][-mask_block[flag].shape[0]:] = mask_block[flag]
-        
-        elif num_processed == input_file['data'].shape[0] - 1:
-            # if end of data, write remaining to both files
-            for flag in (b for b in (True, False) if block_idx[b] != half_block_size - 1):
-                hdf5s[flag]['data'].resize((hdf5s[flag]['data'].shape[0] + block_idx[flag]), axis=0)
-                hdf5s[flag]['data'][-(block_idx[flag] + 1):] = spectrogram_block[flag][:block_idx[flag]+1]
-
-                hdf5s[flag]['label'].resize((hdf5s[flag]['label'].shape[0] + block_idx[flag]), axis=0)
-                hdf5s[flag]['label'][-(block_idx[flag] + 1):] = mask_block[flag][:block_idx[flag]+1]
-
-        block_idx[flag] = (block_idx[flag] + 1) % half_block_size
-        num_processed += 1
+    for block_start in range(0, len(flags), block_size):
+        block = slice(block_start, block_start + block_size)
+        spectrogram_block = input_file['data'][block]
+        mask_block = input_file['label'][block]
+
+        # Save the patches of the block with each flag to their hdf5
+        for flag in (True, False):
+            selected = flags[block] == flag
+            count = int(selected.sum())
+            if count == 0:
+                continue
+            writers[flag]['data'].write(spectrogram_block[selected], written[flag])
+            writers[flag]['label'].write(mask_block[selected], written[flag])
+            statistics[flag].update(spectrogram_block[selected], mask_block[selected])
+            written[flag] += count
+
+    for flag_writers in writers.values():
+        for writer in flag_writers.values():
+            writer.finish()
+    if executor is not None:
+        executor.shutdown()
+
+    # The provenance of the patches is kept, with an index of each half
+    if 'provenance' in input_file:
+        provenance = input_file['provenance'][:]
+        for flag, file in hdf5s.items():
+            write_provenance(file, provenance[flags == flag], input_file['provenance'].attrs["wav_files"])
 
     # Close files
     input_file.close()
-    for _, file in hdf5s.items():
+    for flag, file in hdf5s.items():
+        statistics[flag].write(file.create_group('statistics'))
         file.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+import math
+from fractions import Fraction
+
+import h5py
+import numpy as np
+
+# Default size of the chunk cache of each strip. Overlapping patches decompress each chunk only once
+CHUNK_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def strip_max_freq(rate, frame_time_span = 8, max_freq = 50000):
+    '''
+    Gets the upper bound of frequency of the strip of a recording, which is max_freq
+    unless the recording's sample rate is too low to hold all of the bins below it.
+
+    :param rate: Hz, the sample rate of the recording
+    :param frame_time_span: ms, length of time for one time window for dft
+    :param max_freq: Hz, upper bound of frequency for spectrogram
+    '''
+    freq_resolution = Fraction(1000, frame_time_span)
+    frame_sample_span = math.floor(Fraction(frame_time_span * rate, 1000))
+    return min(Fraction(max_freq), (frame_sample_span // 2 + 1) * freq_resolution)
+
+
+def strip_shape(nframes, rate, frame_time_span = 8, step_time_span = 2, min_freq = 5000, max_freq = 50000):
+    '''
+    Gets the shape of the spectrogram of a whole recording, i.e. of the spectrogram from
+    getSpectrogram with start_time = 0, end_time = number of columns * step_time_span and
+    max_freq from strip_max_freq.
+
+    :param nframes: the number of samples in the recording
+    :param rate: Hz, the sample rate of the recording
+    :param frame_time_span: ms, length of time for one time window for dft
+    :param step_time_span: ms, length of time step for spectrogram
+    :param min_freq: Hz, lower bound of frequency for spectrogram
+    :param max_freq: Hz, upper bound of frequency for spectrogram
+
+    :returns: the shape of the strip: (rows, columns)
+    '''
+    freq_resolution = Fraction(1000, frame_time_span)
+    max_freq = strip_max_freq(rate, frame_time_span=frame_time_span, max_freq=max_freq)
+    rows = math.floor(max_freq / freq_resolution) - math.floor(min_freq / freq_resolution)
+
+    # Every column needs a full frame of audio after its start
+    audio_file_length = Fraction(nframes * 1000, rate)
+    if audio_file_length < frame_time_span:
+        return rows, 0
+    return rows, math.floor((audio_file_length - frame_time_span) / step_time_span) + 1
+
+
+def patch_offsets(freq_starts, time_starts, frame_time_span = 8, step_time_span = 2,
+                  max_freq = 50000, freq_patch_frames = 64):
+    '''
+    Gets where each patch of a grid from corpus_inventory.patch_starts lies in its strip.
+    Rows are counted down from max_freq, the top of the strip from strip_max_freq,
+    because spectrograms are flipped for display.
+
+    :returns: A tuple with the first row of each row of patches and the first column of
+              each column of patches: (freq_offsets, time_offsets)
+    '''
+    freq_resolution = Fraction(1000, frame_time_span)
+    top = math.floor(max_freq / freq_resolution)
+    patch_freq_length_hz = freq_resolution * freq_patch_frames
+    freq_offsets = [top - math.floor((Fraction(freq) + patch_freq_length_hz) / freq_resolution) for freq in freq_starts]
+    time_offsets = [round(Fraction(time) / step_time_span) for time in time_starts]
+    return freq_offsets, time_offsets
+
+
+class StripDataset:
+    def __init__(self, filename, time_patch_frames = None, freq_patch_frames = None,
+                 time_patch_advance = None, freq_patch_advance = None, chunk_cache_bytes = CHUNK_CACHE_BYTES):
+        '''
+        Reads patches from an HDF5 file written by generate_hdf5.py with --layout strips.
+        Patches are sliced from the stored strips when requested, so any patch size and
+        advance may be chosen here without generating the file again.
+
+        :param filename: the HDF5 file
+        :param time_patch_frames: number of time frames, the length of each patch
+        :param freq_patch_frames: number of frequency frames, the height of each patch
+        :param time_patch_advance: number of frames, the time distance between patches
+        :param freq_patch_advance: number of frames, the frequency distance between patches
+        :param chunk_cache_bytes: the size of the chunk cache kept for each strip
+
+        If all of the patch parameters are None, the patches planned at generation are used.
+        Otherwise, those left as None take their value from generation.
+        '''
+        self.file = h5py.File(filename, 'r', rdcc_nbytes=chunk_cache_bytes)
+        if self.file.attrs.get("layout") != "strips":
+            raise ValueError(f"{filename} was not written with the strips layout.")
+
+        self.recordings = [self.file['recordings'][str(i)] for i in range(len(self.file['recordings']))]
+
+        parameters = (time_patch_frames, freq_patch_frames, time_patch_advance, freq_patch_advance)
+        self.time_patch_frames = time_patch_frames or int(self.file.attrs["time_patch_frames"])
+        self.freq_patch_frames = freq_patch_frames or int(self.file.attrs["freq_patch_frames"])
+        if all(p is None for p in parameters):
+            self.index = self.file['patch_index'][:]
+        else:
+            self.index = self.build_index(self.time_patch_frames, self.freq_patch_frames,
+                                          time_patch_advance or int(self.file.attrs["time_patch_advance"]),
+                                          freq_patch_advance or int(self.file.attrs["freq_patch_advance"]))
+
+    def build_index(self, time_patch_frames, freq_patch_frames, time_patch_advance, freq_patch_advance):
+        '''
+        Gets every patch that lies fully within a strip. Like at generation, rows of patches
+        start at the bottom of the strip, i.e. at min_freq, and columns start at time 0.
+
+        :returns: an array with one (recording, freq_offset, time_offset) row per patch
+        '''
+        index = []
+        for i, recording in enumerate(self.recordings):
+            rows, columns = recording['data'].shape
+            freq_offsets = range(rows - freq_patch_frames, -1, -freq_patch_advance)
+            time_offsets = range(0, columns - time_patch_frames + 1, time_patch_advance)
+            index.extend((i, f, t) for f in freq_offsets for t in time_offsets)
+        return np.array(index, dtype=np.int64).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        '''Returns the patch at idx as a tuple: (data, label)'''
+        return self._read(*self.index[idx])
+
+    def _read(self, recording, freq_offset, time_offset):
+        rows = slice(freq_offset, freq_offset + self.freq_patch_frames)
+        columns = slice(time_offset, time_offset + self.time_patch_frames)
+        strip = self.recordings[recording]
+        return strip['data'][rows, columns], strip['label'][rows, columns]
+
+    def get_batch(self, indices, shifts = None):
+        '''
+        Materializes several patches at once. They are read in strip order so that
+        overlapping patches are served from the chunk cache.
+
+        :param indices: the patches to read
+        :param shifts: if given, an array with one (freq_shift, time_shift) row per patch, in frames,
+                       by which each patch is moved within its strip, e.g. from augmentation.Augmenter.
+                       Patches are never moved past the edges of their strip
+
+        :returns: A tuple of arrays: (data, label, positive_flag)
+        '''
+        indices = np.asarray(indices)
+        index = self.index[indices]
+        if shifts is not None:
+            index = index.copy()
+            limits = np.array([[recording['data'].shape[0] - self.freq_patch_frames,
+                                recording['data'].shape[1] - self.time_patch_frames] for recording in self.recordings],
+                              dtype=np.int64).reshape(-1, 2)
+            index[:, 1:] = np.clip(index[:, 1:] + np.asarray(shifts), 0, limits[index[:, 0]])
+        data = np.zeros((len(indices), self.freq_patch_frames, self.time_patch_frames), dtype="f4")
+        label = np.zeros((len(indices), self.freq_patch_frames, self.time_patch_frames), dtype="f4")
+        for i in np.lexsort(index.T[::-1]):
+            data[i], label[i] = self._read(*index[i])
+        positive_flag = (label.reshape(len(indices), -1).max(axis=1) > 0).astype("f4")
+        return data, label, positive_flag
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,64 @@
+import os
+import sys
+import subprocess
+
+import numpy as np
+import pytest
+import wavio
+
+# The tests import the repository's modules as the scripts do, from its root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from silbidopy.writeBinaries import writeTimeFrequencyBinary
+
+# Each synthetic recording: its sample rate, its length in s and the (start_s, end_s, start_hz, end_hz) of each whistle
+RECORDINGS = {
+    "a": (96000, 2.5, [(0.3, 1.5, 12000, 20000), (1.0, 2.0, 30000, 31000)]),
+    "b": (48000, 2.0, [(0.2, 1.2, 8000, 14000), (1.4, 1.9, 16000, 9000)]),
+}
+
+
+@pytest.fixture(scope="session")
+def corpus(tmp_path_factory):
+    '''A small corpus of recordings of chirps in noise and their .bin annotations'''
+    directory = tmp_path_factory.mktemp("corpus")
+    audio_dir, annotation_dir = directory / "audio", directory / "anno"
+    audio_dir.mkdir()
+    annotation_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for name, (rate, seconds, whistles) in RECORDINGS.items():
+        t = np.arange(int(rate * seconds)) / rate
+        signal = rng.normal(0, 200, len(t))
+        contours = []
+        for start, end, start_freq, end_freq in whistles:
+            inside = (t >= start) & (t < end)
+            freq = start_freq + (end_freq - start_freq) * (t[inside] - start) / (end - start)
+            signal[inside] += 4000 * np.sin(2 * np.pi * np.cumsum(freq) / rate)
+            times = np.arange(start, end, 0.01)
+            contours.append([(float(time), float(start_freq + (end_freq - start_freq) * (time - start) / (end - start)))
+                             for time in times])
+        wavio.write(str(audio_dir / f"{name}.wav"), signal.astype(np.int16).reshape(-1, 1), rate, sampwidth=2)
+        writeTimeFrequencyBinary(str(annotation_dir / f"{name}.bin"), contours)
+    return {"audio_dir": str(audio_dir), "annotation_dir": str(annotation_dir)}
+
+
+@pytest.fixture(scope="session")
+def run_script():
+    '''Runs one of the repository's scripts with the given arguments, failing the test if it fails'''
+    def run(script, *args):
+        result = subprocess.run([sys.executable, os.path.join(ROOT, script), *map(str, args)],
+                                cwd=ROOT, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+        return result.stdout
+    return run
+
+
+@pytest.fixture(scope="session")
+def strips(corpus, run_script, tmp_path_factory):
+    '''The corpus in the strip layout'''
+    output_file = tmp_path_factory.mktemp("strips") / "strips.hdf5"
+    run_script("generate_hdf5.py", "--audio_dir", corpus["audio_dir"], "--annotation_dir", corpus["annotation_dir"],
+               "--output_file", output_file, "--layout", "strips", "--time_patch_advance", 16, "--freq_patch_advance", 32,
+               "--patches_per_block", 3)
+    return str(output_file)
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from augmentation import Augmenter
+from strip_dataset import StripDataset
+
+
+@pytest.fixture
+def batch():
+    # Spectrogram values within the clipping range, and labels with a few whistle pixels
+    rng = np.random.default_rng(3)
+    data = rng.uniform(0.05, 0.95, (6, 16, 24)).astype("f4")
+    label = (rng.random((6, 16, 24)) < 0.05).astype("f4")
+    label[0] = 0
+    return data, label
+
+
+def test_roll_moves_data_and_label_together(batch):
+    data, label = batch
+    augmented_data, augmented_label, positive_flag = Augmenter(seed=1, time_shift=5, freq_shift=3)(data, label)
+    # The shifts are the first draws of the seed
+    shifts = Augmenter(seed=1, time_shift=5, freq_shift=3).shifts(len(data))
+    assert np.abs(shifts[:, 0]).max() <= 3 and np.abs(shifts[:, 1]).max() <= 5 and shifts.any()
+
+    for i, (freq_shift, time_shift) in enumerate(shifts):
+        assert np.allclose(augmented_data[i], np.roll(data[i], (freq_shift, time_shift), axis=(0, 1)), atol=1e-6)
+        assert np.array_equal(augmented_label[i], np.roll(label[i], (freq_shift, time_shift), axis=(0, 1)))
+    assert augmented_data.dtype == data.dtype
+    assert np.array_equal(positive_flag, label.reshape(len(label), -1).max(axis=1).astype("f4"))
+
+    # The augmentations depend only on the seed
+    again = Augmenter(seed=1, time_shift=5, freq_shift=3)(data, label)
+    assert np.array_equal(again[0], augmented_data) and np.array_equal(again[1], augmented_label)
+
+
+def test_strip_crops_stay_within_the_strip(strips):
+    dataset = StripDataset(strips)
+    indices = np.arange(0, len(dataset), 7)
+    data, label, positive_flag = Augmenter(seed=2, time_shift=40, freq_shift=20).augment_strips(dataset, indices)
+    shifts = Augmenter(seed=2, time_shift=40, freq_shift=20).shifts(len(indices))
+
+    clipped = 0
+    for i, (recording, freq_offset, time_offset) in enumerate(dataset.index[indices]):
+        strip = dataset.recordings[recording]
+        # The crop is moved by the shift, but no further than the edges of its strip
+        freq_start = min(max(freq_offset + shifts[i, 0], 0), strip["data"].shape[0] - dataset.freq_patch_frames)
+        time_start = min(max(time_offset + shifts[i, 1], 0), strip["data"].shape[1] - dataset.time_patch_frames)
+        clipped += (freq_start, time_start) != (freq_offset + shifts[i, 0], time_offset + shifts[i, 1])
+        rows = slice(freq_start, freq_start + dataset.freq_patch_frames)
+        columns = slice(time_start, time_start + dataset.time_patch_frames)
+        assert np.allclose(data[i], strip["data"][rows, columns], atol=1e-6)
+        assert np.array_equal(label[i], strip["label"][rows, columns])
+        assert positive_flag[i] == (label[i].max() > 0)
+    # Some crops are moved past the edges, and some are not
+    assert 0 < clipped < len(indices)
+    dataset.close()
+
+
+def test_noise_is_mixed_in_linear_magnitude(batch):
+    data, label = batch
+    noise = np.full((1,) + data.shape[1:], 0.5, dtype="f4")
+    augment = Augmenter(seed=4, noise=noise, noise_probability=1.0, noise_weight=(0.5, 0.5))
+    augmented_data, augmented_label, _ = augment(data, label)
+
+    magnitude = data.astype(np.float64) * 6
+    expected = np.clip(np.log10(10 ** magnitude + 0.5 * 10 ** 3.0), 0, 6) / 6
+    assert np.allclose(augmented_data, expected, atol=1e-6)
+    assert np.array_equal(augmented_label, label)
+
+    # With no chance of mixing, no patch is mixed, and noise of another shape is refused
+    unmixed, _, _ = Augmenter(seed=4, noise=noise, noise_probability=0.0)(data, label)
+    assert np.allclose(unmixed, data, atol=1e-6)
+    with pytest.raises(ValueError):
+        Augmenter(noise=noise[:, :8], noise_probability=1.0)(data, label)
+
+
+def test_gain_and_contrast_are_clipped_and_normalized(batch):
+    data, label = batch
+    clipped_values = 0
+    for gain, contrast in ((0.5, 0.0), (0.0, 0.4)):
+        augmented_data, _, _ = Augmenter(seed=5, gain=gain, contrast=contrast)(data, label)
+        assert augmented_data.dtype == data.dtype
+        assert augmented_data.min() >= 0 and augmented_data.max() <= 1
+
+        for before, after in zip(data, augmented_data):
+            inside = (after > 0) & (after < 1)
+            if gain:
+                # One gain per patch, in log magnitude, i.e. in sixths of the normalized range
+                offset = after[inside] - before[inside]
+                assert np.ptp(offset) < 1e-5 and abs(offset[0]) <= gain / 6 + 1e-6
+                expected = np.clip(before + offset[0], 0, 1)
+            else:
+                # One scale per patch about the middle of the clipping range
+                away = inside & (np.abs(before - 0.5) > 0.05)
+                scale = (after[away] - 0.5) / (before[away] - 0.5)
+                assert np.ptp(scale) < 1e-4 and abs(scale[0] - 1) <= contrast + 1e-6
+                expected = np.clip((before - 0.5) * scale[0] + 0.5, 0, 1)
+            assert np.allclose(after, expected, atol=1e-5)
+            clipped_values += (~inside).sum()
+    # Some values are moved past the clipping range and clipped to its bounds
+    assert clipped_values > 0
@@ -0,0 +1,53 @@
+import json
+
+import h5py
+import numpy as np
+import pytest
+
+# Configurations a and b share their spectra, as do c and d, and e is framed alone
+CONFIGURATIONS = {
+    "a": {"time_patch_advance": 16},
+    "b": {"time_patch_advance": 24, "freq_patch_advance": 32, "min_freq": 10000},
+    "c": {"frame_time_span": 16, "step_time_span": 4, "time_patch_frames": 32, "freq_patch_frames": 32},
+    "d": {"frame_time_span": 16, "step_time_span": 4, "layout": "strips"},
+    "e": {"step_time_span": 1, "time_patch_frames": 32, "contiguous": True},
+}
+
+
+def read_all(filename):
+    # Every dataset of a file by its path, and every attribute of its root
+    datasets = {}
+    with h5py.File(filename, "r") as h5f:
+        h5f.visititems(lambda name, item: datasets.__setitem__(name, item[()]) if isinstance(item, h5py.Dataset) else None)
+        attributes = {name: np.asarray(value).tolist() for name, value in h5f.attrs.items()}
+    return datasets, attributes
+
+
+@pytest.mark.parametrize("max_memory", [None, 0.03])
+def test_configurations_match_separate_runs(corpus, run_script, tmp_path, max_memory):
+    arguments = ["--audio_dir", corpus["audio_dir"], "--annotation_dir", corpus["annotation_dir"], "--patches_per_block", 5]
+    if max_memory is not None:
+        arguments += ["--max_memory", max_memory]
+
+    configurations_file = tmp_path / "configurations.json"
+    configurations_file.write_text(json.dumps([{"output_file": str(tmp_path / f"shared_{name}.hdf5"), **options}
+                                               for name, options in CONFIGURATIONS.items()]))
+    run_script("generate_hdf5.py", *arguments, "--configurations", configurations_file)
+
+    for name, options in CONFIGURATIONS.items():
+        separate_file = tmp_path / f"separate_{name}.hdf5"
+        flags = [argument for option, value in options.items()
+                 for argument in ((f"--{option}",) if value is True else (f"--{option}", value))]
+        run_script("generate_hdf5.py", *arguments, *flags, "--output_file", separate_file)
+
+        shared_datasets, shared_attributes = read_all(tmp_path / f"shared_{name}.hdf5")
+        separate_datasets, separate_attributes = read_all(separate_file)
+        assert shared_attributes == separate_attributes
+        assert shared_datasets.keys() == separate_datasets.keys()
+        for path, value in separate_datasets.items():
+            if max_memory is not None and path.startswith("statistics/") and value.dtype.kind == "f":
+                # The budget gives the configurations smaller blocks than a separate run, and the
+                # statistics are accumulated block by block
+                assert np.allclose(shared_datasets[path], value, rtol=1e-12, atol=0), f"{name}: {path} differs"
+            else:
+                assert np.array_equal(shared_datasets[path], value), f"{name}: {path} differs"
@@ -0,0 +1,45 @@
+import numpy as np
+
+from dataset_statistics import RunningStatistics
+
+
+def test_merged_statistics_match_numpy():
+    rng = np.random.default_rng(0)
+    rows = 12
+    blocks = [rng.random((n, 4, 16)) * 1.2 - 0.1 for n in (3, 1, 7, 5)]
+    labels = [rng.random(block.shape) > 0.8 for block in blocks]
+
+    # Two recordings, each of two blocks, the second of which covers the lower rows only
+    statistics = RunningStatistics(rows)
+    for offset, pair in ((0, (0, 1)), (8, (2, 3))):
+        recording = RunningStatistics(4)
+        for i in pair:
+            recording.update(blocks[i], labels[i])
+        statistics.merge(recording, row_offset=offset)
+    statistics.update(blocks[0][0], labels[0][0], row_offset=4)
+
+    expected_rows = {0: [blocks[0], blocks[1]], 4: [blocks[0][:1]], 8: [blocks[2], blocks[3]]}
+    expected_labels = {0: [labels[0], labels[1]], 4: [labels[0][:1]], 8: [labels[2], labels[3]]}
+    for offset, data in expected_rows.items():
+        values = np.concatenate(data).transpose(1, 0, 2).reshape(4, -1)
+        positive = (np.concatenate(expected_labels[offset]) > 0).sum(axis=(0, 2))
+        assert np.array_equal(statistics.count[offset:offset + 4], [values.shape[1]] * 4)
+        assert np.allclose(statistics.mean[offset:offset + 4], values.mean(axis=1))
+        assert np.allclose(statistics.variance()[offset:offset + 4], values.var(axis=1))
+        assert np.array_equal(statistics.positive[offset:offset + 4], positive)
+
+    every = np.concatenate([np.concatenate(data).transpose(1, 0, 2).reshape(4, -1) for data in expected_rows.values()], axis=1)
+    overall = statistics.overall()
+    assert overall["count"] == every.size
+    assert np.isclose(overall["mean"], every.mean())
+    assert np.isclose(overall["variance"], every.var())
+
+    histogram = np.histogram(np.clip(every, 0, 1), bins=len(statistics.histogram), range=(0, 1))[0]
+    assert np.array_equal(statistics.histogram, histogram)
+
+
+def test_empty_rows_stay_empty():
+    statistics = RunningStatistics(3)
+    statistics.update(np.ones((2, 1, 5)), np.zeros((2, 1, 5)), row_offset=1)
+    assert np.array_equal(statistics.count, [0, 10, 0])
+    assert np.array_equal(statistics.variance(), [0, 0, 0])
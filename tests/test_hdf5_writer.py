@@ -0,0 +1,77 @@
+import h5py
+import numpy as np
+import pytest
+
+from hdf5_writer import BlockWriter, ChunkStager, RowWriter, compression_executor, patch_dataset_options
+
+
+@pytest.fixture
+def rows():
+    # Enough rows for several chunks and a partial last one
+    rng = np.random.default_rng(0)
+    shape = (8, 16)
+    chunk_rows = patch_dataset_options(shape)["chunks"][0]
+    return rng.random((3 * chunk_rows + 5,) + shape).astype("f4")
+
+
+def write_plain(path, rows):
+    with h5py.File(path, "w") as h5f:
+        h5f.create_dataset("data", data=rows, **patch_dataset_options(rows.shape[1:]))
+
+
+def read(path):
+    with h5py.File(path, "r") as h5f:
+        return h5f["data"][:], h5f["data"].chunks, h5f["data"].compression
+
+
+@pytest.mark.parametrize("threads", [0, 2])
+def test_row_writer_matches_h5py(tmp_path, rows, threads):
+    write_plain(tmp_path / "plain.h5", rows)
+
+    executor = compression_executor(threads)
+    with h5py.File(tmp_path / "staged.h5", "w") as h5f:
+        dataset = h5f.create_dataset("data", shape=rows.shape, dtype="f4", **patch_dataset_options(rows.shape[1:]))
+        assert ChunkStager.supports(dataset)
+        writer = RowWriter(dataset, executor=executor, max_pending=2)
+        # Blocks that do not line up with the chunks
+        for offset in range(0, len(rows), 7):
+            writer.write(rows[offset:offset + 7], offset)
+        writer.finish()
+    if executor is not None:
+        executor.shutdown()
+
+    staged, plain = read(tmp_path / "staged.h5"), read(tmp_path / "plain.h5")
+    assert np.array_equal(staged[0], plain[0])
+    assert staged[1:] == plain[1:]
+
+
+def test_rows_must_be_added_in_order(tmp_path, rows):
+    with h5py.File(tmp_path / "staged.h5", "w") as h5f:
+        dataset = h5f.create_dataset("data", shape=rows.shape, dtype="f4", **patch_dataset_options(rows.shape[1:]))
+        stager = ChunkStager(dataset)
+        stager.add(rows[:3], 0)
+        with pytest.raises(ValueError):
+            stager.add(rows[4:6], 4)
+
+
+@pytest.mark.parametrize("contiguous", [False, True])
+def test_block_writer_matches_h5py(tmp_path, rows, contiguous):
+    flags = (rows.reshape(len(rows), -1).max(axis=1) > 0.5).astype("f4")
+    executor = compression_executor(2)
+    block_rows = 10
+    with h5py.File(tmp_path / "blocks.h5", "w") as h5f:
+        h5f.create_dataset("data", shape=rows.shape, dtype="f4", **patch_dataset_options(rows.shape[1:], contiguous))
+        h5f.create_dataset("positive_flag", shape=flags.shape, dtype="f4")
+        with BlockWriter(h5f, {"data": (block_rows,) + rows.shape[1:], "positive_flag": (block_rows,)},
+                         executor=executor) as writer:
+            for offset in range(0, len(rows), block_rows):
+                count = min(block_rows, len(rows) - offset)
+                block = writer.get_block()
+                block["data"][:count] = rows[offset:offset + count]
+                block["positive_flag"][:count] = flags[offset:offset + count]
+                writer.put_block(block, offset, count)
+    executor.shutdown()
+
+    with h5py.File(tmp_path / "blocks.h5", "r") as h5f:
+        assert np.array_equal(h5f["data"][:], rows)
+        assert np.array_equal(h5f["positive_flag"][:], flags)
@@ -0,0 +1,45 @@
+import h5py
+import numpy as np
+import pytest
+
+from memmap_dataset import MemmapPatches, memmap_dataset
+
+
+@pytest.fixture(scope="module")
+def contiguous_file(corpus, run_script, tmp_path_factory):
+    output_file = tmp_path_factory.mktemp("memmap") / "contiguous.hdf5"
+    run_script("generate_hdf5.py", "--audio_dir", corpus["audio_dir"], "--annotation_dir", corpus["annotation_dir"],
+               "--output_file", output_file, "--time_patch_advance", 32, "--contiguous")
+    return str(output_file)
+
+
+def test_memmap_reads_match_h5py(contiguous_file):
+    patches = MemmapPatches(contiguous_file)
+    with h5py.File(contiguous_file, "r") as h5f:
+        assert len(patches) == len(h5f["data"])
+        for name in ("data", "label", "positive_flag"):
+            assert np.array_equal(getattr(patches, name), h5f[name][:])
+        data, label, positive_flag = patches[3:9]
+        assert np.array_equal(data, h5f["data"][3:9])
+        assert np.array_equal(label, h5f["label"][3:9])
+        assert np.array_equal(positive_flag, h5f["positive_flag"][3:9])
+    assert positive_flag.dtype == np.float32 and not data.flags.writeable
+
+
+def test_shuffled_copy_maps_like_h5py(contiguous_file, run_script, tmp_path):
+    shuffled_file = tmp_path / "shuffled.hdf5"
+    run_script("randomize_hdf5.py", contiguous_file, "--output_file", shuffled_file, "--contiguous", "--seed", 1)
+    patches = MemmapPatches(str(shuffled_file))
+    with h5py.File(shuffled_file, "r") as h5f:
+        assert np.array_equal(patches.data, h5f["data"][:])
+        assert np.array_equal(patches.label, h5f["label"][:])
+
+
+def test_compressed_and_empty_datasets(tmp_path):
+    filename = str(tmp_path / "datasets.hdf5")
+    with h5py.File(filename, "w") as h5f:
+        h5f.create_dataset("compressed", data=np.ones((4, 2, 2), dtype="f4"), compression="gzip")
+        h5f.create_dataset("empty", shape=(0, 2, 2), dtype="f4")
+    with pytest.raises(ValueError):
+        memmap_dataset(filename, "compressed")
+    assert memmap_dataset(filename, "empty").shape == (0, 2, 2)
@@ -0,0 +1,81 @@
+import multiprocessing
+import threading
+
+import h5py
+import numpy as np
+import pytest
+
+from patch_server import PatchClient, PatchServer, batch_sequence
+
+NUM_PATCHES = 50
+
+
+@pytest.fixture
+def patches_file(tmp_path):
+    # Every value of a patch is its row, so each row served can be checked against the file
+    filename = str(tmp_path / "patches.hdf5")
+    rows = np.arange(NUM_PATCHES)
+    with h5py.File(filename, "w") as h5f:
+        h5f.create_dataset("data", data=np.broadcast_to(rows[:, None, None], (NUM_PATCHES, 6, 5)).astype("f4"),
+                           chunks=(4, 6, 5), compression="gzip")
+        h5f.create_dataset("label", data=np.broadcast_to(-rows[:, None, None], (NUM_PATCHES, 6, 5)).astype("f4"),
+                           chunks=(4, 6, 5))
+        h5f.create_dataset("positive_flag", data=rows % 2, dtype="i1", chunks=(4,))
+    return filename
+
+
+def test_batch_sequence_serves_every_patch_once_per_pass():
+    batches = batch_sequence(NUM_PATCHES, 8, 2, 3, seed=5)
+    for _ in range(2):
+        rows = []
+        while len(rows) < NUM_PATCHES:
+            block, start, stop = next(batches)
+            assert 0 < stop - start <= 3
+            rows.extend(range(block * 8 + start, block * 8 + stop))
+        assert sorted(rows) == list(range(NUM_PATCHES))
+
+
+def consume(address, seed, batch_size, results):
+    # A training process, which reads two passes over the file and checks each batch against its rows
+    try:
+        with PatchClient(address, batch_size=batch_size, seed=seed) as client:
+            rows = []
+            while len(rows) < 2 * len(client):
+                data, label, positive_flag = client.next_batch()
+                expected = np.array(client.rows)
+                assert np.all(data == expected[:, None, None]) and np.all(label == -data)
+                assert np.array_equal(positive_flag, expected % 2)
+                rows.extend(client.rows)
+                del data, label, positive_flag
+        results.put((seed, rows))
+    except BaseException as error:
+        results.put((seed, repr(error)))
+
+
+@pytest.mark.parametrize("max_memory", [10 ** 6, 4000])
+def test_each_client_sees_every_patch(patches_file, max_memory):
+    # With 4000 bytes only two of the seven blocks fit, so slots are reused while clients hold others
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    with PatchServer(patches_file, max_memory=max_memory, block_rows=8) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        clients = [context.Process(target=consume, args=(server.address, seed, batch_size, results))
+                   for seed, batch_size in [(0, 3), (1, 8), (2, 5)]]
+        for client in clients:
+            client.start()
+        seen = dict(results.get(timeout=60) for _ in clients)
+        for client in clients:
+            client.join(60)
+
+    assert sorted(seen) == [0, 1, 2]
+    for rows in seen.values():
+        assert not isinstance(rows, str), rows
+        assert sorted(rows[:NUM_PATCHES]) == list(range(NUM_PATCHES))
+        assert sorted(rows[NUM_PATCHES:]) == list(range(NUM_PATCHES))
+
+
+def test_batch_size_beyond_a_block_is_refused(patches_file):
+    with PatchServer(patches_file, block_rows=8) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        with pytest.raises(ValueError):
+            PatchClient(server.address, batch_size=9)
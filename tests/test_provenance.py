@@ -0,0 +1,41 @@
+import h5py
+import numpy as np
+import pytest
+
+import provenance
+from provenance import PROVENANCE_DTYPE, query_rows, row_ranges, write_provenance
+
+
+def linear_scan(table, recording = None, time_range = None, freq_range = None):
+    keep = np.ones(len(table), dtype=bool)
+    if recording is not None:
+        keep &= table["recording"] == recording
+    if time_range is not None:
+        keep &= (table["start_time"] < time_range[1]) & (table["end_time"] > time_range[0])
+    if freq_range is not None:
+        keep &= (table["start_freq"] < freq_range[1]) & (table["end_freq"] > freq_range[0])
+    return row_ranges(np.flatnonzero(keep))
+
+
+@pytest.mark.parametrize("search_block", [provenance.SEARCH_BLOCK, 8])
+def test_query_rows_matches_linear_scan(tmp_path, monkeypatch, search_block):
+    monkeypatch.setattr(provenance, "SEARCH_BLOCK", search_block)
+    rng = np.random.default_rng(0)
+    table = np.zeros(5000, dtype=PROVENANCE_DTYPE)
+    table["recording"] = rng.integers(0, 4, len(table))
+    # Times and frequencies on a grid, so that queries fall on patch edges
+    table["start_time"] = rng.integers(0, 200, len(table)) * 16.0
+    table["end_time"] = table["start_time"] + 128
+    table["start_freq"] = 5000 + rng.integers(0, 40, len(table)) * 1000.0
+    table["end_freq"] = table["start_freq"] + 8000
+
+    with h5py.File(tmp_path / "provenance.h5", "w") as h5f:
+        write_provenance(h5f, table, ["a.wav", "b.wav", "c.wav", "d.wav"])
+        for _ in range(100):
+            recording = rng.choice([None, 0, 1, 3])
+            time_range = None if rng.random() < 0.3 else tuple(np.sort(rng.integers(-10, 210, 2)) * 16.0)
+            freq_range = None if rng.random() < 0.3 else tuple(5000 + np.sort(rng.integers(-5, 50, 2)) * 1000.0)
+            assert (query_rows(h5f, recording=recording, time_range=time_range, freq_range=freq_range)
+                    == linear_scan(table, recording, time_range, freq_range))
+        assert query_rows(h5f, recording="b.wav") == linear_scan(table, recording=1)
+        assert query_rows(h5f, recording="missing.wav") == []
@@ -0,0 +1,84 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import wavio
+from PIL import Image
+
+from silbidopy.readBinaries import tonalReader
+from silbidopy.render import getAnnotationMask, getSpectrogram
+from write_images import write_pyramid
+
+TILE_FRAMES = 64
+
+
+def read_level(output_dir, level):
+    # The columns of every tile of a level, side by side, and the width of each tile
+    spectrograms, masks = [], []
+    for i in range(len(level["tiles"])):
+        spectrograms.append(np.asarray(Image.open(os.path.join(output_dir, level["directory"], f"{i}-spectogram.png"))))
+        masks.append(np.asarray(Image.open(os.path.join(output_dir, level["directory"], f"{i}-mask.png"))))
+    return np.concatenate(spectrograms, axis=1), np.concatenate(masks, axis=1), [s.shape[1] for s in spectrograms]
+
+
+@pytest.fixture(scope="module")
+def pyramid(corpus, tmp_path_factory):
+    output_dir = str(tmp_path_factory.mktemp("pyramid"))
+    audio_file, binary_file = os.path.join(corpus["audio_dir"], "a.wav"), os.path.join(corpus["annotation_dir"], "a.bin")
+    count = write_pyramid(audio_file, binary_file, output_dir, tile_frames=TILE_FRAMES)
+    with open(os.path.join(output_dir, "pyramid.json")) as file:
+        index = json.load(file)
+    return audio_file, binary_file, output_dir, index, count
+
+
+def test_index_lists_the_tiles_written(pyramid):
+    _, _, output_dir, index, count = pyramid
+    levels = index["levels"]
+    assert count == sum(len(level["tiles"]) for level in levels)
+    # Levels are added until one tile holds the whole recording
+    assert len(levels[-1]["tiles"]) == 1 and len(levels[-2]["tiles"]) > 1
+
+    for k, level in enumerate(levels):
+        assert level["column_time_span"] == index["step_time_span"] * 2 ** k
+        assert sorted(os.listdir(os.path.join(output_dir, level["directory"]))) == \
+            sorted(f"{i}-{kind}.png" for i in range(len(level["tiles"])) for kind in ("spectogram", "mask"))
+
+        spectrogram, mask, widths = read_level(output_dir, level)
+        assert all(width == TILE_FRAMES for width in widths[:-1]) and 0 < widths[-1] <= TILE_FRAMES
+        start = 0
+        for i, (tile, width) in enumerate(zip(level["tiles"], widths)):
+            assert tile["start_time"] == i * TILE_FRAMES * level["column_time_span"]
+            assert tile["end_time"] == min(tile["start_time"] + width * level["column_time_span"], index["end_time"])
+            assert tile["positive"] == bool(mask[:, start:start + width].any())
+            start += width
+        # The last tile reaches the end of the last frame
+        assert level["tiles"][-1]["end_time"] == index["end_time"]
+
+
+def test_levels_match_the_spectrogram_and_each_other(pyramid):
+    audio_file, binary_file, output_dir, index, _ = pyramid
+    levels = [read_level(output_dir, level)[:2] for level in index["levels"]]
+
+    # Each tile of level 0 is the spectrogram and mask of the time range listed for it
+    audio = wavio.read(audio_file)
+    contours = tonalReader(binary_file).getTimeFrequencyContours()
+    parameters = {name: index[name] for name in ("frame_time_span", "step_time_span", "min_freq", "max_freq")}
+    column = 0
+    for tile in index["levels"][0]["tiles"]:
+        spectrogram, actual_end = getSpectrogram(audio, start_time=tile["start_time"], end_time=tile["end_time"], **parameters)
+        mask, _ = getAnnotationMask(contours, start_time=tile["start_time"], end_time=actual_end, **parameters)
+        assert actual_end == tile["end_time"]
+        width = spectrogram.shape[1]
+        assert np.array_equal(levels[0][0][:, column:column + width], np.round(spectrogram * 255).astype(np.uint8))
+        assert np.array_equal(levels[0][1][:, column:column + width], (mask > 0).astype(np.uint8) * 255)
+        column += width
+    assert column == levels[0][0].shape[1]
+
+    # Each further level max-pools pairs of columns of the one below, and a last unpaired one alone
+    for (finer_spectrogram, finer_mask), (spectrogram, mask) in zip(levels, levels[1:]):
+        assert spectrogram.shape[1] == -(-finer_spectrogram.shape[1] // 2)
+        for finer, coarser in ((finer_spectrogram, spectrogram), (finer_mask, mask)):
+            if finer.shape[1] % 2:
+                finer = np.concatenate([finer, finer[:, -1:]], axis=1)
+            assert np.array_equal(coarser, finer.reshape(finer.shape[0], -1, 2).max(axis=2))
@@ -0,0 +1,47 @@
+import numpy as np
+
+from silbidopy.raster import AnnotationRaster
+from silbidopy.render import getAnnotationMask
+
+
+def synthetic_contours(rng, count = 60):
+    # Whistles of random lengths and shapes, some leaving the 5-50 kHz band and some going back in time
+    contours = []
+    for _ in range(count):
+        nodes = rng.integers(2, 40)
+        times = rng.uniform(0, 2) + np.cumsum(rng.uniform(0.0005, 0.004, nodes))
+        if rng.random() < 0.1:
+            times[nodes // 2:] -= 0.01
+        freqs = rng.uniform(2000, 52000) + np.cumsum(rng.normal(0, 400, nodes))
+        contours.append([(t, f) for t, f in zip(times, freqs)])
+    contours.sort(key=lambda contour: contour[0][0])
+    return contours
+
+
+def test_raster_masks_match_getAnnotationMask():
+    rng = np.random.default_rng(0)
+    frame, step, min_freq = 8, 2, 5000
+    contours = synthetic_contours(rng)
+    raster = AnnotationRaster(contours, frame_time_span=frame, step_time_span=step, min_freq=min_freq)
+
+    resolution = 1000 / frame
+    positives = 0
+    for _ in range(400):
+        start_time = rng.integers(0, 1100) * step
+        start_freq = min_freq + rng.integers(0, 300) * resolution
+        if rng.random() < 0.1:
+            # Off the grid of the raster
+            start_time += 0.7
+            start_freq += 37.5
+        end_time, end_freq = start_time + 64 * step, start_freq + 64 * resolution
+
+        mask, positive_flag = raster.getAnnotationMask(min_freq=start_freq, max_freq=end_freq,
+                                                       start_time=start_time, end_time=end_time)
+        expected, expected_flag = getAnnotationMask(contours, frame_time_span=frame, step_time_span=step,
+                                                    min_freq=start_freq, max_freq=end_freq,
+                                                    start_time=start_time, end_time=end_time)
+        assert np.array_equal(mask, expected)
+        assert positive_flag == expected_flag
+        positives += expected_flag
+    # The patches must actually cover whistles for the comparison to mean anything
+    assert positives > 50
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from silbidopy.readBinaries import tonalReader
+from silbidopy.writeBinaries import writeTimeFrequencyBinary
+
+
+@pytest.fixture
+def contours():
+    # Whistles of random lengths, including one without nodes, in no particular order
+    rng = np.random.default_rng(0)
+    contours = []
+    for i in range(40):
+        nodes = 0 if i == 7 else int(rng.integers(1, 30))
+        times = rng.uniform(0, 20) + np.cumsum(rng.uniform(0.001, 0.01, nodes))
+        freqs = rng.uniform(5000, 45000) + np.cumsum(rng.normal(0, 300, nodes))
+        contours.append([(float(t), float(f)) for t, f in zip(times, freqs)])
+    return contours
+
+
+@pytest.fixture
+def bin_file(tmp_path, contours):
+    filename = str(tmp_path / "contours.bin")
+    writeTimeFrequencyBinary(filename, contours)
+    return filename
+
+
+def test_table_of_contents_matches_linear_read(bin_file, contours):
+    with tonalReader(bin_file) as reader:
+        linear = reader.getTimeFrequencyContours()
+        toc = reader.getTableOfContents()
+    assert linear == contours
+    assert len(toc) == len(contours)
+    for row, contour in zip(toc, linear):
+        assert row["nodes"] == len(contour)
+        if contour:
+            times, freqs = zip(*contour)
+            assert (row["start_time"], row["end_time"]) == (min(times), max(times))
+            assert (row["min_freq"], row["max_freq"]) == (min(freqs), max(freqs))
+        else:
+            assert np.isnan(row["start_time"]) and np.isnan(row["min_freq"])
+
+
+def test_table_of_contents_is_cached(bin_file, tmp_path):
+    toc_file = str(tmp_path / "contours.bin.toc.npz")
+    with tonalReader(bin_file, toc_file=toc_file) as reader:
+        built = reader.getTableOfContents()
+    with tonalReader(bin_file, toc_file=toc_file) as reader:
+        reader._readTableOfContents = None  # the table must come from toc_file
+        assert reader.getTableOfContents().tobytes() == built.tobytes()
+
+
+def test_seek_returns_the_tonal_of_a_linear_read(bin_file, contours):
+    with tonalReader(bin_file) as reader:
+        for i in [5, 0, 39, 7, 12, -1]:
+            reader.seek(i)
+            assert [(n["time"], n["freq"]) for n in next(reader)["tfnodes"]] == contours[i]
+        reader.seek(len(contours))
+        with pytest.raises(StopIteration):
+            next(reader)
+        with pytest.raises(IndexError):
+            reader.seek(len(contours) + 1)
+
+
+def test_contours_in_match_a_linear_scan(bin_file, contours):
+    rng = np.random.default_rng(1)
+    with tonalReader(bin_file) as reader:
+        for _ in range(50):
+            start_time, end_time = np.sort(rng.uniform(-1, 21, 2))
+            min_freq, max_freq = np.sort(rng.uniform(0, 50000, 2))
+            # As in getAnnotationMask, a contour overlaps if it ends at or after a range's start and begins before its end
+            expected = [i for i, contour in enumerate(contours) if contour
+                        and max(t for t, _ in contour) >= start_time and min(t for t, _ in contour) < end_time
+                        and max(f for _, f in contour) >= min_freq and min(f for _, f in contour) < max_freq]
+            assert list(reader.indicesIn(start_time, end_time, min_freq, max_freq)) == expected
+            assert reader.contoursIn(start_time, end_time, min_freq, max_freq) == [contours[i] for i in expected]
+        assert list(reader.indicesIn()) == [i for i, contour in enumerate(contours) if contour]
@@ -0,0 +1,60 @@
+import math
+import os
+
+import h5py
+import numpy as np
+import wavio
+
+from silbidopy.readBinaries import tonalReader
+from silbidopy.render import getSpectrogram, getAnnotationMask
+from strip_dataset import StripDataset
+
+
+def on_grid(start_time, end_time, rate, frame_time_span = 8, step_time_span = 2):
+    # Whether getSpectrogram frames this span on the grid of the strip, i.e. from a whole sample
+    # with a whole number of samples between frames
+    start_frame = int(start_time / 1000 * rate)
+    end_frame = int((end_time / 1000 + frame_time_span / 1000 - step_time_span / 1000) * rate)
+    frame_sample_span = int(math.floor(frame_time_span / 1000 * rate))
+    step_sample_span = step_time_span / 1000 * rate
+    columns = round((end_time - start_time) / step_time_span)
+    return (start_frame == round(start_time / 1000 * rate) and step_sample_span == int(step_sample_span)
+            and end_frame - start_frame - frame_sample_span == (columns - 1) * step_sample_span)
+
+
+def test_strip_patches_match_getSpectrogram(strips, corpus):
+    dataset = StripDataset(strips)
+    with h5py.File(strips, "r") as h5f:
+        provenance = h5f["provenance"][:]
+        wav_files = list(h5f["provenance"].attrs["wav_files"])
+        positive_flag = h5f["positive_flag"][:]
+    recordings = {name: wavio.read(os.path.join(corpus["audio_dir"], name)) for name in wav_files}
+
+    compared = 0
+    for i, row in enumerate(provenance):
+        wav = recordings[wav_files[row["recording"]]]
+        data, label = dataset[i]
+        assert positive_flag[i] == (row["positive_pixels"] > 0)
+        assert row["positive_pixels"] == (label > 0).sum()
+        if not on_grid(row["start_time"], row["end_time"], wav.rate):
+            continue
+        spectrogram, _ = getSpectrogram(wav, min_freq=row["start_freq"], max_freq=row["end_freq"],
+                                        start_time=row["start_time"], end_time=row["end_time"])
+        # The strip is stored in float32
+        assert np.array_equal(data, spectrogram.astype("f4"))
+        compared += 1
+    assert compared > len(provenance) // 2
+    dataset.close()
+
+
+def test_strip_labels_match_getAnnotationMask(strips, corpus):
+    with h5py.File(strips, "r") as h5f:
+        for group in h5f["recordings"].values():
+            label = group["label"][:]
+            with tonalReader(os.path.join(corpus["annotation_dir"], group.attrs["bin_file"])) as reader:
+                contours = reader.getTimeFrequencyContours()
+            # A mask of the whole recording clips no contour but at the edges of the strip
+            mask, positive_flag = getAnnotationMask(contours, min_freq=5000, max_freq=group.attrs["max_freq"],
+                                                    start_time=0, end_time=label.shape[1] * 2)
+            assert positive_flag
+            assert np.array_equal(label, mask)
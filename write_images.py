@@ -1,16 +1,30 @@
+import os
+import json
+import math
 import wavio
+import numpy as np
 from silbidopy.render import getSpectrogram, getAnnotationMask
 from silbidopy.readBinaries import tonalReader
+from silbidopy.raster import AnnotationRaster
 from PIL import Image
+from corpus_inventory import read_wav_header
+from strip_dataset import strip_max_freq
 def write_images(audio_filename, binary_filename, output_dir, frame_time_span = 8, step_time_span = 2,
                  spec_clip_min = 0, spec_clip_max = 6, min_freq = 5000, max_freq = 50000,
-                 split_time = 3000):
+                 split_time = 3000, decimate = False, cache = None):
     
-    wav= wavio.read(audio_filename)
     contours = tonalReader(binary_filename).getTimeFrequencyContours()
     
-    # Length in ms
-    audio_file_length = wav.data.shape[0] / wav.rate * 1000
+    if cache is not None:
+        # The cache reads the audio only if its spectrogram is not cached yet
+        audio = audio_filename
+        header = read_wav_header(audio_filename)
+        # Length in ms
+        audio_file_length = header["nframes"] / header["rate"] * 1000
+    else:
+        audio = wavio.read(audio_filename)
+        # Length in ms
+        audio_file_length = audio.data.shape[0] / audio.rate * 1000
 
     num_images = 0
     # write images
@@ -18,9 +32,9 @@ def write_images(audio_filename, binary_filename, output_dir, frame_time_span =
     while time < audio_file_length:
         end_time = min(time + split_time, audio_file_length)
 
-        spectrogram, actual_end = getSpectrogram(wav, frame_time_span=frame_time_span,step_time_span=step_time_span,
+        spectrogram, actual_end = getSpectrogram(audio, frame_time_span=frame_time_span,step_time_span=step_time_span,
                                      spec_clip_min=spec_clip_min, spec_clip_max=spec_clip_max, min_freq=min_freq,
-                                     max_freq=max_freq, start_time=time, end_time=end_time)
+                                     max_freq=max_freq, start_time=time, end_time=end_time, decimate=decimate, cache=cache)
         mask, positive_flag = getAnnotationMask(contours, frame_time_span=frame_time_span,step_time_span=step_time_span,
                                  min_freq=min_freq, max_freq=max_freq, start_time=time, end_time=actual_end)
         
@@ -38,4 +52,153 @@ def write_images(audio_filename, binary_filename, output_dir, frame_time_span =
     return num_images
 
 
+class _PyramidLevel:
+    def __init__(self, level, output_dir, tile_frames, step_time_span):
+        # Columns not yet written in a tile, and columns not yet pooled into the next level
+        self.level = level
+        self.output_dir = output_dir
+        self.tile_frames = tile_frames
+        self.column_time_span = step_time_span * 2 ** level
+        self.tile_spectrogram, self.tile_mask = [], []
+        self.pool_spectrogram, self.pool_mask = [], []
+        self.tiles = []
+        os.makedirs(output_dir, exist_ok=True)
 
+    def write_tile(self, spectrogram, mask):
+        i = len(self.tiles)
+        start_time = i * self.tile_frames * self.column_time_span
+        # Tiles are stored as 8-bit grayscale, so that every pooled value is visible
+        Image.fromarray(np.round(spectrogram * 255).astype(np.uint8)).save(self.output_dir + f"/{i}-spectogram.png")
+        Image.fromarray((mask > 0).astype(np.uint8) * 255).save(self.output_dir + f"/{i}-mask.png")
+        self.tiles.append({
+            "start_time": start_time,
+            "end_time": start_time + spectrogram.shape[1] * self.column_time_span,
+            "positive": bool((mask > 0).any()),
+        })
+
+
+def write_pyramid(audio_filename, binary_filename, output_dir, frame_time_span = 8, step_time_span = 2,
+                  spec_clip_min = 0, spec_clip_max = 6, min_freq = 5000, max_freq = 50000,
+                  tile_frames = 1024, levels = None, pooling = "max", decimate = False, cache = None):
+    '''
+    Writes a pyramid of quick-look tiles of the spectrogram and annotation mask of a whole
+    recording. Level 0 has one column per spectrogram frame, and each further level halves the
+    columns of the one below by pooling pairs of them, so the spectrogram is computed only
+    once. The tiles of level 0 are the spectrogram and mask that getSpectrogram and
+    getAnnotationMask give for their time range, as for write_images. Masks are max-pooled,
+    so that no annotation disappears when zoomed out.
+
+    Every tile of a level but the last has tile_frames columns, so tile i of level k starts at
+    i * tile_frames * 2**k * step_time_span ms. The tiles are written as
+    level_<k>/<i>-spectogram.png and level_<k>/<i>-mask.png, and listed with their start and
+    end times in pyramid.json.
+
+    :param audio_filename: the audio file in .wav format
+    :param binary_filename: the silbido .bin file of its annotations
+    :param output_dir: the directory in which the pyramid is written
+    :param tile_frames: the number of columns of each tile
+    :param levels: the number of levels. If None, levels are added until one tile holds the whole recording
+    :param pooling: "max" or "mean", how the spectrogram is pooled
+    :param max_freq: Hz, upper bound of frequency for spectrogram, lowered to the highest bin of
+                     the recording if its sample rate is too low
+    :param ...: as for write_images
+
+    :returns: the number of tiles written
+    '''
+    contours = tonalReader(binary_filename).getTimeFrequencyContours()
+    raster = AnnotationRaster(contours, frame_time_span=frame_time_span, step_time_span=step_time_span, min_freq=min_freq)
+
+    if cache is not None:
+        # The cache reads the audio only if its spectrogram is not cached yet
+        audio = audio_filename
+        header = read_wav_header(audio_filename)
+        rate = header["rate"]
+        # Length in ms
+        audio_file_length = header["nframes"] / header["rate"] * 1000
+    else:
+        audio = wavio.read(audio_filename)
+        rate = audio.rate
+        # Length in ms
+        audio_file_length = audio.data.shape[0] / audio.rate * 1000
+    # The masks must have as many rows as the spectrogram has bins below max_freq
+    max_freq = float(strip_max_freq(rate, frame_time_span=frame_time_span, max_freq=max_freq))
+
+    if levels is None:
+        # The number of columns of level 0, each with a full frame of audio after its start
+        frames = max(1, math.floor((audio_file_length - frame_time_span) / step_time_span) + 1)
+        levels = 1 + max(0, math.ceil(math.log2(frames / tile_frames)))
+    pyramid = [_PyramidLevel(k, output_dir + f"/level_{k}", tile_frames, step_time_span) for k in range(levels)]
+    pool = np.max if pooling == "max" else np.mean
+
+    def add_columns(k, spectrogram, mask):
+        level = pyramid[k]
+        level.tile_spectrogram.append(spectrogram)
+        level.tile_mask.append(mask)
+        columns = sum(s.shape[1] for s in level.tile_spectrogram)
+        if columns >= tile_frames:
+            tile_spectrogram = np.concatenate(level.tile_spectrogram, axis=1)
+            tile_mask = np.concatenate(level.tile_mask, axis=1)
+            for start in range(0, columns - tile_frames + 1, tile_frames):
+                level.write_tile(tile_spectrogram[:, start:start + tile_frames], tile_mask[:, start:start + tile_frames])
+            rest = columns - columns % tile_frames
+            level.tile_spectrogram, level.tile_mask = [tile_spectrogram[:, rest:]], [tile_mask[:, rest:]]
+
+        if k + 1 < levels:
+            level.pool_spectrogram.append(spectrogram)
+            level.pool_mask.append(mask)
+            pool_spectrogram = np.concatenate(level.pool_spectrogram, axis=1)
+            pool_mask = np.concatenate(level.pool_mask, axis=1)
+            pairs = pool_spectrogram.shape[1] // 2
+            if pairs > 0:
+                height = pool_spectrogram.shape[0]
+                add_columns(k + 1, pool(pool_spectrogram[:, :2 * pairs].reshape(height, pairs, 2), axis=2),
+                            pool_mask[:, :2 * pairs].reshape(height, pairs, 2).max(axis=2))
+            level.pool_spectrogram, level.pool_mask = [pool_spectrogram[:, 2 * pairs:]], [pool_mask[:, 2 * pairs:]]
+
+    # The spectrogram is computed a tile of level 0 at a time, each frame once, up to the
+    # last whole frame
+    time = 0
+    while audio_file_length - time >= frame_time_span:
+        end_time = min(time + tile_frames * step_time_span, audio_file_length)
+        spectrogram, actual_end = getSpectrogram(audio, frame_time_span=frame_time_span,step_time_span=step_time_span,
+                                     spec_clip_min=spec_clip_min, spec_clip_max=spec_clip_max, min_freq=min_freq,
+                                     max_freq=max_freq, start_time=time, end_time=end_time, decimate=decimate, cache=cache)
+        if spectrogram.shape[1] == 0:
+            break
+        mask, _ = raster.getAnnotationMask(min_freq=min_freq, max_freq=max_freq, start_time=time, end_time=actual_end)
+        add_columns(0, spectrogram, mask)
+        time = actual_end
+
+    # Columns left over at the end make the last, narrower tile of each level, and a last
+    # unpaired column is pooled alone
+    for k, level in enumerate(pyramid):
+        spectrogram = np.concatenate(level.tile_spectrogram, axis=1) if level.tile_spectrogram else None
+        if spectrogram is not None and spectrogram.shape[1] > 0:
+            level.write_tile(spectrogram, np.concatenate(level.tile_mask, axis=1))
+        level.tile_spectrogram, level.tile_mask = [], []
+        if k + 1 < levels and level.pool_spectrogram and level.pool_spectrogram[0].shape[1] > 0:
+            remaining_spectrogram, remaining_mask = level.pool_spectrogram[0], level.pool_mask[0]
+            level.pool_spectrogram, level.pool_mask = [], []
+            add_columns(k + 1, pool(remaining_spectrogram, axis=1, keepdims=True), remaining_mask.max(axis=1, keepdims=True))
+
+    # The last column of a level may be pooled from fewer frames than the others
+    for level in pyramid:
+        for tile in level.tiles:
+            tile["end_time"] = min(tile["end_time"], time)
+
+    index = {
+        "audio_file": os.path.basename(audio_filename),
+        "frame_time_span": frame_time_span,
+        "step_time_span": step_time_span,
+        "min_freq": min_freq,
+        "max_freq": max_freq,
+        "tile_frames": tile_frames,
+        "pooling": pooling,
+        "end_time": time,
+        "levels": [{"level": level.level, "column_time_span": level.column_time_span,
+                    "directory": f"level_{level.level}", "tiles": level.tiles} for level in pyramid],
+    }
+    with open(output_dir + "/pyramid.json", 'w') as file:
+        json.dump(index, file, indent=1)
+
+    return sum(len(level.tiles) for level in pyramid)